@@ -169,6 +169,19 @@ class DataBusPump(object):
     
     def __init__(self, **kwargs):
         super(DataBusPump, self).__init__(**kwargs)
+        self._sample_listeners = []
+
+    def add_sample_listener(self, callback):
+        """Register a callback receiving every Sample as it is received,
+        in the thread delivering the sample. The Sample object is reused
+        """
+        self._sample_listeners.append(callback)
+
+    def remove_sample_listener(self, callback):
+        try:
+            self._sample_listeners.remove(callback)
+        except ValueError:
+            pass
 
     def startDataPump(self, data_bus, rc_api):
         if self._sample_thread == None:
@@ -200,6 +213,8 @@ class DataBusPump(object):
             dataBus.update_samples(sample)
             if sample.updated_meta:
                 dataBus.update_channel_meta(sample.metas)
+            for listener in self._sample_listeners:
+                listener(sample)
             self._sample_event.set()
         except SampleMetaException:
             #this is to prevent repeated sample meta requests
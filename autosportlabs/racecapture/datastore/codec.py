@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""
+Compressed encoding of channel chunks for the DataStore
+
+Desparsified channels are mostly short decimals that repeat while a slow
+channel is carried forward, or that step by a constant amount. A chunk is
+encoded as:
+
+    1. the values scaled by the smallest power of ten that makes them
+       integers without losing anything
+    2. the differences between consecutive integers
+    3. run-length coded: each run of equal differences is stored once
+       with its length, unless that doesn't save anything
+    4. the run values and lengths packed at the narrowest integer width
+       that holds them, and the whole thing compressed with zlib if that
+       at least halves it
+
+The integer width is picked per chunk rather than per value (as a varint
+would), which keeps decoding to a frombuffer per array.
+
+Chunks that can't be scaled exactly (or hold blanks) are stored as
+float64, zlib compressed on the same terms. Decoding is a handful of
+whole-array numpy operations; inflating bodies that barely shrink would
+cost more than the rest of it.
+
+Layout: header '<BBBBI' encoding (ZLIB_FLAG set when the body is
+compressed), decimals, value width, length width, value count, then the
+body: the first integer ('<i8'),
+the run values (signed) and the run lengths (unsigned). A length width
+of 0 means every difference is stored on its own and there are no
+lengths.
+"""
+import struct
+import zlib
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#Body encodings
+RAW_ENCODING = 0
+DELTA_ENCODING = 1
+
+#Set in the encoding byte when the body is zlib compressed
+ZLIB_FLAG = 0x80
+
+#Most decimal places tried when scaling a chunk to integers
+MAX_DECIMALS = 9
+
+#Scaled values must stay exactly representable as float64
+_MAX_SCALED = 2 ** 53
+
+ZLIB_LEVEL = 6
+
+#Bodies are only stored compressed when this small a fraction of their size
+ZLIB_MIN_RATIO = 0.5
+
+_HEADER = struct.Struct('<BBBBI')
+
+_UNSIGNED = {1: '<u1', 2: '<u2', 4: '<u4', 8: '<u8'}
+_SIGNED = {1: '<i1', 2: '<i2', 4: '<i4', 8: '<i8'}
+
+def _narrowest(values, signed=False):
+    """
+    Returns the narrowest integer byte width holding all of the values
+    """
+    if not len(values):
+        return 1
+    low, high = int(values.min()), int(values.max())
+    for width in sorted(_UNSIGNED):
+        bits = 8 * width
+        if signed and -(1 << (bits - 1)) <= low and high < 1 << (bits - 1):
+            return width
+        if not signed and high < 1 << bits:
+            return width
+    return 8
+
+def _pack(encoding, decimals, value_width, length_width, count, body):
+    compressed = zlib.compress(body, ZLIB_LEVEL)
+    if len(compressed) <= len(body) * ZLIB_MIN_RATIO:
+        encoding |= ZLIB_FLAG
+        body = compressed
+    return _HEADER.pack(encoding, decimals, value_width, length_width, count) + body
+
+def _scale(values):
+    """
+    Returns (decimals, integers) for the fewest decimal places that turn
+    every value into an integer and back without loss, or None
+    """
+    if not np.isfinite(values).all():
+        return None
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10.0 ** decimals
+        scaled = np.round(values * scale)
+        if np.abs(scaled).max() >= _MAX_SCALED:
+            return None
+        if np.array_equal(scaled / scale, values):
+            return decimals, scaled.astype(np.int64)
+    return None
+
+def encode(values):
+    """
+    Encodes a chunk of float64 values, returns a byte string
+    """
+    if np is None:
+        raise Exception("Compressed storage requires numpy")
+
+    values = np.asarray(values, dtype=np.float64)
+    count = len(values)
+    scaled = _scale(values) if count else None
+    if scaled is None:
+        return _pack(RAW_ENCODING, 0, 0, 0, count, values.astype('<f8').tostring())
+
+    decimals, integers = scaled
+    deltas = np.diff(integers)
+
+    #One entry per run of equal differences
+    starts = np.concatenate(([0], np.flatnonzero(deltas[1:] != deltas[:-1]) + 1)) \
+        if len(deltas) else np.empty(0, dtype=np.int64)
+    if len(starts) * 2 > len(deltas):
+        #Mostly runs of one, the lengths would cost more than they save
+        runs = deltas
+        lengths = None
+        length_width = 0
+    else:
+        runs = deltas[starts]
+        lengths = np.diff(np.concatenate((starts, [len(deltas)])))
+        length_width = _narrowest(lengths)
+
+    value_width = _narrowest(runs, signed=True)
+    body = integers[:1].astype('<i8').tostring() + runs.astype(_SIGNED[value_width]).tostring()
+    if lengths is not None:
+        body += lengths.astype(_UNSIGNED[length_width]).tostring()
+    return _pack(DELTA_ENCODING, decimals, value_width, length_width, count, body)
+
+def decode(data):
+    """
+    Decodes a chunk written by encode, returns a float64 array
+    """
+    if np is None:
+        raise Exception("Compressed storage requires numpy")
+
+    encoding, decimals, value_width, length_width, count = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if encoding & ZLIB_FLAG:
+        encoding &= ~ZLIB_FLAG
+        body = zlib.decompress(body)
+    if encoding == RAW_ENCODING:
+        return np.frombuffer(body, dtype='<f8')
+    if encoding != DELTA_ENCODING:
+        raise Exception("Unknown chunk encoding: {}".format(encoding))
+    if not count:
+        return np.empty(0)
+
+    run_count = (len(body) - 8) // (value_width + length_width)
+    runs = np.frombuffer(body, dtype=_SIGNED[value_width], count=run_count, offset=8)
+
+    integers = np.empty(count, dtype=np.int64)
+    integers[0] = np.frombuffer(body, dtype='<i8', count=1)[0]
+    if length_width:
+        lengths = np.frombuffer(body, dtype=_UNSIGNED[length_width], count=run_count,
+                                offset=8 + run_count * value_width)
+        integers[1:] = np.repeat(runs, lengths)
+    else:
+        integers[1:] = runs
+    np.cumsum(integers, out=integers)
+
+    if decimals:
+        return integers / (10.0 ** decimals)
+    return integers.astype(np.float64)
@@ -1,9 +1,93 @@
 #!/usr/bin/python
 import sqlite3
+import re
+import hashlib
 import logging
 import os, os.path
+import contextlib
 import time
 import datetime
+import math
+import itertools
+import multiprocessing
+import threading
+import weakref
+from collections import OrderedDict
+
+from autosportlabs.racecapture.datastore.sidecar import SidecarWriter, open_sidecar
+from autosportlabs.racecapture.datastore import codec
+from autosportlabs.racecapture.datastore.derived import compile_expression
+from autosportlabs.racecapture.datastore.export import CSV_EXPORT, write_export, resparsify_blocks
+from autosportlabs.racecapture.datastore.vacuum import VacuumScheduler
+from autosportlabs.racecapture.geo.geopoint import RADIUS_EARTH_KM
+from autosportlabs.racecapture.datastore.smoothing import create_smoother, \
+    _interp_dpoints, _smooth_dataset, INTERP_KERNEL, KERNELS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#Number of records written per transaction during a datalog import
+IMPORT_CHUNK_SIZE = 5000
+
+#Number of compiled query statements and channel metadata entries cached
+QUERY_CACHE_SIZE = 64
+
+#Stands in for the session of the partitions a query statement reads, so
+#one statement serves every session, see DataStore._bind_partition
+PARTITION_TOKEN = '<partition>'
+
+#Memory, in bytes, the query results cached by DataStore.query may take
+RESULT_CACHE_BYTES = 64 << 20
+
+#Number of rows read ahead from the cursor when streaming a DataSet
+DATASET_READ_SIZE = 10000
+
+#Bytes a value of a cached query result takes: a float64 array element,
+#or without numpy a list slot and a float object
+RESULT_VALUE_BYTES = 8 if np is not None else 32
+
+#Sample ids of a session, each session gets a block of this many of its
+#own, see DataStore._get_session_id_block
+SESSION_ID_BLOCK = 1 << 32
+
+#Bucket sizes, in samples, of the min/max decimation pyramid levels
+PYRAMID_FACTORS = [16, 256, 4096]
+
+#Bytes hashed at a time when fingerprinting a datalog
+FINGERPRINT_READ_SIZE = 1 << 20
+
+#Connection pragmas, see DataStore.open_db
+DEFAULT_SYNCHRONOUS = 'NORMAL'
+#Negative sizes are in KiB
+DEFAULT_CACHE_SIZE = -16000
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+#Storage layouts selectable in DataStore.new()
+#row: one wide 'datapoint' row per sample, in a table per session
+#columnar: one packed float64 array per channel per import chunk
+#compressed: columnar, with every array delta encoded, see codec.py
+#sparse: columnar, with each channel kept at the rate it was logged at:
+#        only the samples the datalog has a value for, with their sample
+#        offsets, where that is smaller
+ROW_STORAGE = 'row'
+COLUMNAR_STORAGE = 'columnar'
+COMPRESSED_STORAGE = 'compressed'
+SPARSE_STORAGE = 'sparse'
+STORAGE_LAYOUTS = [ROW_STORAGE, COLUMNAR_STORAGE, COMPRESSED_STORAGE, SPARSE_STORAGE]
+
+#Channels holding the GPS position indexed for position queries
+LATITUDE_CHANNEL = 'Latitude'
+LONGITUDE_CHANNEL = 'Longitude'
+
+#Groupings of DataStore.aggregate, besides a time bucket width in ms
+SESSION_GROUPS = 'session'
+LAP_GROUPS = 'lap'
+
+#Aggregate functions, by the name aggregate() takes them under
+AGGREGATE_FUNCTIONS = OrderedDict([('min', 'MIN'), ('max', 'MAX'), ('avg', 'AVG'),
+                                   ('sum', 'SUM'), ('count', 'COUNT')])
 
 def unix_time(dt):
     epoch = datetime.datetime.utcfromtimestamp(0)
@@ -13,107 +97,376 @@ def unix_time(dt):
 def unix_time_millis(dt):
     return unix_time(dt) * 1000.0
 
+def _distance_m(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in meters between two positions, None if either
+    is missing. Registered with sqlite as rc_distance()
+    """
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2000.0 * RADIUS_EARTH_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def _distance_m_array(lats, lons, lat, lon):
+    """
+    _distance_m from arrays of positions to a single one, NaN where the
+    position is blank
+    """
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    lat, lon = math.radians(lat), math.radians(lon)
+    a = np.sin((lat - lats) / 2) ** 2 + \
+        np.cos(lats) * math.cos(lat) * np.sin((lon - lons) / 2) ** 2
+    return 2000.0 * RADIUS_EARTH_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def _radius_box(point, radius_m):
+    """
+    Returns (min_lat, max_lat, min_lon, max_lon) of a box enclosing the
+    circle of radius_m around point
+    """
+    dlat = math.degrees(radius_m / (1000.0 * RADIUS_EARTH_KM))
+    cos_lat = math.cos(math.radians(point.latitude))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, dlat / cos_lat)
+    return (point.latitude - dlat, point.latitude + dlat,
+            point.longitude - dlon, point.longitude + dlon)
+
 def timing(f):
-    def wrap(*args):
+    def wrap(*args, **kwargs):
         time1 = time.time()
-        ret = f(*args)
+        ret = f(*args, **kwargs)
         time2 = time.time()
         print '%s function took %0.3f ms' % (f.func_name, (time2-time1)*1000.0)
         return ret
     return wrap
 
-def _get_interp_slope(start, finish, num_samples):
-    #print "Start, finish, num_samples", start, finish, num_samples
-    if start == finish:
-        return 0
-
-    return float(start - finish) / float(1 - num_samples)
-
-def _interp_dpoints(start, finish, sample_skip):
-    slope = _get_interp_slope(start, finish, sample_skip + 1)
-
-    nlist = [start]
-    for i in range(sample_skip - 1):
-        nlist.append(float(nlist[-1] + slope))
-
-    nlist.append(finish)
-
-    return nlist
-
-def _smooth_dataset(dset, smoothing_rate):
-    #Throw an error if we got a bad smoothing rate
-    if not smoothing_rate or smoothing_rate < 2:
-        raise Exception("Invalid smoothing rate")
-
-    #This is the dataset that we'll be returning
-    new_dset = []
-
-    #Get every nth sample from the dataset where n==smoothing_rate
-    dpoints = dset[0::smoothing_rate]
-
-    #Now, loop through the target datapoints, interpolate the values
-    #between, and store them to the new dataset that we'll be
-    #returning
-    for index, val in enumerate(dpoints[:-1]):
-        #Get the start and end points of the interpolation
-        start = val
-        end = dpoints[index+1]
-
-        #Generate the smoothed dataset
-        smoothed_samples = _interp_dpoints(start, end, smoothing_rate)
-
-        #Append everything but the last datapoint in the smoothed
-        #samples to the new dataset
-        #(This will be the first item in the next dataset)
-        new_dset.extend(smoothed_samples[:-1])
-
-        #If the end was the last datapoint in the original set, append
-        #it as well
-        if index + 1 == len(dpoints) - 1:
-            new_dset.append(end)
-
-    #Now we need to smooth out the tail end of the list (if necessary)
-    if len(new_dset) < len(dset):
-        #calculate the difference in lengths between the original and
-        #new datasets
-        len_diff = len(dset) - len(new_dset)
-
-        #generate a new smoothed dataset for the missing elements
-        tail_dset = _interp_dpoints(new_dset[-1], dset[-1], len_diff)
+def _parse_block(lines):
+    """
+    Parses a list of CSV lines into a block of records, blank entries
+    become NaN (numpy) or None
+    """
+    if np is not None:
+        tokens = np.array(','.join(lines).split(','))
+        tokens[tokens == ''] = 'nan'
+        try:
+            return tokens.astype(np.float64).reshape(len(lines), -1)
+        except ValueError:
+            raise Exception("Unable to import datalog, malformed data")
+
+    return [[None if x == '' else float(x) for x in line.split(',')] for line in lines]
+
+class _Desparsifier(object):
+    """
+    Stateful forward fill of record blocks.  The last known value of each
+    column is carried between blocks, blocks are held back until every
+    column has seen its first value so the head of the dataset can be
+    back filled
+    """
+    def __init__(self):
+        self._last = None
+        self._pending = []
+
+    def _ready(self):
+        if np is not None:
+            return not np.isnan(self._last).any()
+        return not None in self._last
+
+    def _ffill(self, block):
+        if np is not None:
+            work = np.vstack((self._last, block)) if self._last is not None else block
+            rows = np.arange(len(work))[:, None]
+            idx = np.where(np.isnan(work), 0, rows)
+            np.maximum.accumulate(idx, axis=0, out=idx)
+            work = work[idx, np.arange(work.shape[1])]
+            self._last = work[-1].copy()
+            return work[1:] if len(work) > len(block) else work
+
+        last = self._last if self._last is not None else [None] * len(block[0])
+        for row in block:
+            last = [l if v is None else v for v, l in zip(row, last)]
+            row[:] = last
+        self._last = last
+        return block
+
+    def _bfill(self, blocks):
+        if np is not None:
+            block = np.vstack(blocks)
+            missing = np.isnan(block)
+            first = np.argmax(~missing, axis=0)
+            return np.where(missing, block[first, np.arange(block.shape[1])], block)
+
+        block = [row for b in blocks for row in b]
+        for c in range(len(block[0])):
+            first = next((row[c] for row in block if row[c] is not None), None)
+            for row in block:
+                if row[c] is not None:
+                    break
+                row[c] = first
+        return block
+
+    def fill(self, block):
+        """
+        Returns the filled records that can be released after this block,
+        or None if we are still waiting on the first value of a column
+        """
+        ready = self._last is not None and self._ready()
+        block = self._ffill(block)
+        if ready:
+            return block
 
-        #Extend our return list with everything but the tail of the
-        #new_dataset (as this would cause a duplicate)
-        new_dset.extend(tail_dset[1:])
+        self._pending.append(block)
+        if self._ready():
+            return self.flush()
+        return None
 
-    return new_dset
+    def flush(self):
+        """
+        Returns any records still held back, columns that never saw a
+        value are left blank
+        """
+        if not self._pending:
+            return None
+        block = self._bfill(self._pending)
+        self._pending = []
+        return block
+
+def _desparsify_blocks(data_file, block_size=IMPORT_CHUNK_SIZE, last=None, logged=None):
+    """
+    Takes a racecapture pro CSV file (positioned after the header) and
+    yields blocks of records with the sparsity removed.
+
+    'extrapolated' means that we'll just carry all values forward: [3, nil, nil, nil, 7] -> [3, 3, 3, 3, 7, 7, 7...]
+
+    In the event of the 'start' of the dataset, we may have something like:
+    [nil, nil, nil, 5], in this case, we will just back extrapolate, so:
+    [nil, nil, nil, 5] becomes [5, 5, 5, 5]
+
+    Blocks are a 2D numpy array (NaN for blank columns) when numpy is
+    available, otherwise a list of record lists. When continuing a file
+    part way through, last is the last record already desparsified.
+
+    Every block is yielded right after the line that completes it has
+    been read, with all lines read so far in it or in earlier blocks.
+
+    If logged is a list, a boolean array marking the values each block
+    had in the file, before any were carried, is appended to it as the
+    block is yielded (numpy only)
+    """
+    desparsifier = _Desparsifier()
+    if last is not None:
+        desparsifier._last = np.array(last, dtype=np.float64) if np is not None else list(last)
+    lines = []
+    #Masks of the blocks parsed but held back by the desparsifier
+    held = []
+
+    def released(block):
+        if block is None or not len(block):
+            return None
+        if logged is not None:
+            logged.append(np.vstack(held))
+            del held[:]
+        return block
+
+    def release(lines):
+        parsed = _parse_block(lines)
+        if logged is not None:
+            held.append(~np.isnan(parsed))
+        return released(desparsifier.fill(parsed))
+
+    for line in data_file:
+        line = line.strip()
+        if not line:
+            continue
+        lines.append(line)
+        if len(lines) >= block_size:
+            block = release(lines)
+            lines = []
+            if block is not None:
+                yield block
+
+    if lines:
+        block = release(lines)
+        if block is not None:
+            yield block
+
+    #Whatever is left over is flushed out with the last values carried
+    block = released(desparsifier.flush())
+    if block is not None:
+        yield block
+
+def _as_list(values):
+    """
+    Returns a chunk of channel values as a list, the blanks (NaN) of a
+    numpy array become None, as NULL does
+    """
+    if not hasattr(values, 'tolist'):
+        return values
+    result = values.tolist()
+    for i in np.flatnonzero(np.isnan(values)):
+        result[i] = None
+    return result
+
+def _value_bounds(values):
+    """
+    Returns the smallest and largest of a float64 array, skipping blanks,
+    or (None, None) if it has no values
+    """
+    present = values[~np.isnan(values)]
+    if not len(present):
+        return None, None
+    return float(present.min()), float(present.max())
+
+def _check_interrupt(interrupt_check):
+    """
+    Aborts a read as sqlite aborts an interrupted statement if
+    interrupt_check, a progress handler, returns non zero
+    """
+    if interrupt_check is not None and interrupt_check():
+        raise sqlite3.OperationalError('interrupted')
+
+def _empty_buffer():
+    return np.empty(0) if np is not None else []
+
+def _extend_buffer(buffer, values):
+    """
+    Returns buffer with values appended: a float64 array with numpy, a
+    list without
+    """
+    if np is None:
+        buffer.extend(values)
+        return buffer
+    if not len(buffer):
+        return np.asarray(values, dtype=np.float64)
+    return np.concatenate((buffer, values))
 
 class DataSet(object):
-    def __init__(self, cursor, smoothing_map=None):
+    """
+    Streams the result of a DataStore query. Smoothing is carried across
+    fetches, so reading a channel in chunks returns the same values as
+    reading it in one go.
+
+    If on_complete is given, the values handed out are kept and passed
+    to it, as a dict of float64 arrays (lists without numpy), once the
+    whole result has been read; unless there turn out to be more than
+    record_limit of them.
+
+    interrupt_check is a progress handler called between reads, a non
+    zero return aborts the read with sqlite3.OperationalError
+    """
+    def __init__(self, cursor, smoothing_map=None, row_count=None, kernel_map=None,
+                 on_complete=None, record_limit=None, interrupt_check=None):
         self._cur = cursor
+        self._interrupt_check = interrupt_check
         self._smoothing_map = smoothing_map
+        self._row_count = row_count
+        self._channels = [x[0] for x in cursor.description]
+        #float64 arrays with numpy, blanks as NaN, so values never go
+        #through Python objects on their way to fetch_arrays and fetch_all
+        self._buffers = dict((c, _empty_buffer()) for c in self._channels)
+        self._smoothers = {}
+        self._eof = False
+        self._rows_emitted = 0
+        self._on_complete = on_complete
+        self._record_limit = record_limit
+        self._recorded = dict((c, []) for c in self._channels) if on_complete else None
+        self._recorded_count = 0
+
+        if smoothing_map:
+            for c in self._channels:
+                if smoothing_map.get(c) > 1:
+                    kernel = kernel_map.get(c, INTERP_KERNEL) if kernel_map else INTERP_KERNEL
+                    self._smoothers[c] = create_smoother(smoothing_map[c], kernel)
+
+        #How far the smoothers may lag behind what we have read
+        self._lookahead = max([x.lookahead for x in self._smoothers.values()] + [0])
 
     @property
     def channels(self):
-        return [x[0] for x in self._cur.description]
+        return self._channels[:]
 
-    #TODO: Do we want to offer a count of None to do a fetch all?
-    def fetch_columns(self, count):
+    def _fetch(self, size):
+        """
+        Returns the next size rows of the cursor as a list of columns, or
+        None at the end of the data
+        """
+        if hasattr(self._cur, 'fetch_columns'):
+            #Already in columns, no need to go through rows
+            columns = self._cur.fetch_columns(size)
+            return columns if columns and len(columns[0]) else None
+        rows = self._cur.fetchmany(size)
+        if not rows:
+            return None
+        if np is not None:
+            #Straight into float64, NULL becomes NaN
+            return np.array(rows, dtype=np.float64).T
+        return zip(*rows)
+
+    def _read(self, count):
+        """
+        Reads from the cursor until every channel has count values ready,
+        or the data runs out
+        """
+        buffers = self._buffers
+        while not self._eof:
+            ready = min(len(x) for x in buffers.values()) if buffers else count
+            if ready >= count:
+                break
+
+            _check_interrupt(self._interrupt_check)
+            columns = self._fetch(count - ready + self._lookahead)
+            if columns is None:
+                self._eof = True
+                for c, smoother in self._smoothers.items():
+                    buffers[c] = _extend_buffer(buffers[c], smoother.process([], final=True))
+                break
+
+            for c, values in zip(self._channels, columns):
+                smoother = self._smoothers.get(c)
+                buffers[c] = _extend_buffer(buffers[c], smoother.process(values) if smoother else values)
+
+    def _take(self, count):
+        self._read(count)
         chanmap = {}
-        channels = [x[0] for x in self._cur.description]
-
-        dset = self._cur.fetchmany(count)
-        for c in channels:
-            idx = channels.index(c)
-            chan_dataset =  [x[idx] for x in dset]
+        for c in self._channels:
+            chanmap[c] = self._buffers[c][:count]
+            if np is not None:
+                self._buffers[c] = self._buffers[c][count:]
+            else:
+                del self._buffers[c][:count]
+
+        if self._channels:
+            self._rows_emitted += len(chanmap[self._channels[0]])
+        if self._recorded is not None:
+            self._record(chanmap)
+        return chanmap
 
-            #If we received a smoothing map and the smoothing rate of
-            #the selected channel is > 1, smooth it out before
-            #returning it to the user
-            if self._smoothing_map and self._smoothing_map[c] > 1:
-                chan_dataset = _smooth_dataset(chan_dataset, self._smoothing_map[c])
-            chanmap[c] = chan_dataset
+    def _record(self, chanmap):
+        recorded = self._recorded
+        for c in self._channels:
+            #Kept a chunk at a time. A copy, the caller may change what it
+            #was handed
+            recorded[c].append(np.array(chanmap[c], dtype=np.float64) if np is not None else list(chanmap[c]))
+        if self._channels:
+            self._recorded_count += len(chanmap[self._channels[0]])
+        if self._record_limit is not None and \
+                self._recorded_count * len(self._channels) > self._record_limit:
+            #Too big to keep, stop recording
+            self._recorded = None
+        elif self._eof and not any(len(x) for x in self._buffers.values()):
+            self._recorded = None
+            if np is not None:
+                columns = dict((c, np.concatenate(v) if v else np.empty(0)) for c, v in recorded.iteritems())
+            else:
+                columns = dict((c, [x for chunk in v for x in chunk]) for c, v in recorded.iteritems())
+            self._on_complete(columns)
 
-        return chanmap
+    def fetch_columns(self, count):
+        """
+        Returns the next count values of each channel as a dict of lists,
+        blanks are None
+        """
+        return dict((c, _as_list(v)) for c, v in self._take(count).iteritems())
 
     def fetch_records(self, count):
         chanmap = self.fetch_columns(count)
@@ -126,6 +479,61 @@ class DataSet(object):
 
         return zip(*zlist)
 
+    def fetch_arrays(self, count):
+        """
+        Returns the next count values of each channel as a dict of
+        contiguous float64 numpy arrays, blanks become NaN
+        """
+        if np is None:
+            raise Exception("fetch_arrays requires numpy")
+
+        chanmap = self._take(count)
+        return dict((c, np.ascontiguousarray(v, dtype=np.float64)) for c, v in chanmap.iteritems())
+
+    def fetch_all(self):
+        """
+        Returns the remainder of the DataSet as a dict of float64 numpy
+        arrays, one per channel, preallocated from the row count
+        """
+        if np is None:
+            raise Exception("fetch_all requires numpy")
+
+        if self._row_count is None:
+            chunks = list(self.iter_chunks(DATASET_READ_SIZE, as_arrays=True))
+            return dict((c, np.concatenate([x[c] for x in chunks]) if chunks else np.empty(0))
+                        for c in self._channels)
+
+        remaining = self._row_count() - self._rows_emitted
+        arrays = dict((c, np.empty(remaining)) for c in self._channels)
+        pos = 0
+        while pos < remaining:
+            chanmap = self._take(min(DATASET_READ_SIZE, remaining - pos))
+            count = len(chanmap[self._channels[0]]) if self._channels else 0
+            if count == 0:
+                break
+            for c in self._channels:
+                arrays[c][pos:pos + count] = chanmap[c]
+            pos += count
+
+        if self._recorded is not None:
+            #Reading exactly the row count doesn't run into the end
+            self._read(1)
+            self._record(dict((c, _empty_buffer()) for c in self._channels))
+
+        return arrays
+
+    def iter_chunks(self, count, as_arrays=False):
+        """
+        Iterates over the DataSet count rows at a time, yielding a dict of
+        channel lists (or numpy arrays if as_arrays is set) per chunk
+        """
+        fetch = self.fetch_arrays if as_arrays else self.fetch_columns
+        while self._channels:
+            chanmap = fetch(count)
+            if not len(chanmap[self._channels[0]]):
+                break
+            yield chanmap
+
 
 #Filter container class
 class Filter(object):
@@ -133,57 +541,52 @@ class Filter(object):
         self._cmd_seq = ''
         self._comb_op = 'AND '
         self._channels = []
+        #Structured copy of the filter: comparisons, nested filters and
+        #the 'AND'/'OR' combining operators between them
+        self._terms = []
+        #The same filter as SQL with bound parameters, and its shape:
+        #everything but the values
+        self._param_seq = ''
+        self._params = []
+        self._shape = []
 
     @property
     def channels(self):
         return self._channels[:]
 
-    def add_combop(f):
-        def wrap(self, *args, **kwargs):
-            if len(self._cmd_seq):
-                self._cmd_seq += self._comb_op
-            ret = f(self, *args, **kwargs)
-            return ret
-        return wrap
-
-    def chan_adj(f):
-        def wrap(self, chan, val):
-            self._channels.append(chan)
-            prefix = 'datapoint.'
-            chan = prefix+str(chan)
-            ret = f(self, chan, val)
-            return ret
-        return wrap
-
-    @add_combop
-    @chan_adj
-    def eq(self, chan, val):
-        self._cmd_seq += '{} = {} '.format(chan, val)
+    def _add_term(self, sql, param_sql, params, shape, term):
+        if len(self._cmd_seq):
+            self._cmd_seq += self._comb_op
+            self._param_seq += self._comb_op
+            self._terms.append(self._comb_op.strip())
+            self._shape.append(self._comb_op.strip())
+        self._cmd_seq += sql
+        self._param_seq += param_sql
+        self._params.extend(params)
+        self._shape.append(shape)
+        self._terms.append(term)
         return self
 
-    @add_combop
-    @chan_adj
+    def _compare(self, chan, op, val):
+        self._channels.append(chan)
+        return self._add_term('datapoint.{} {} {} '.format(chan, op, val),
+                              'datapoint.{} {} ? '.format(chan, op),
+                              [val], (chan, op), (chan, op, val))
+
+    def eq(self, chan, val):
+        return self._compare(chan, '=', val)
+
     def lt(self, chan, val):
-        self._cmd_seq += '{} < {} '.format(chan, val)
-        return self
+        return self._compare(chan, '<', val)
 
-    @add_combop
-    @chan_adj
     def gt(self, chan, val):
-        self._cmd_seq += '{} > {} '.format(chan, val)
-        return self
+        return self._compare(chan, '>', val)
 
-    @add_combop
-    @chan_adj
     def lteq(self, chan, val):
-        self._cmd_seq += '{} <= {} '.format(chan, val)
-        return self
+        return self._compare(chan, '<=', val)
 
-    @add_combop
-    @chan_adj
     def gteq(self, chan, val):
-        self._cmd_seq += '{} >= {} '.format(chan, val)
-        return self
+        return self._compare(chan, '>=', val)
 
     def and_(self):
         self._comb_op = 'AND '
@@ -195,13 +598,571 @@ class Filter(object):
 
     def __str__(self):
         return self._cmd_seq
-        return self
 
-    @add_combop
     def group(self, filterchain):
-        self._cmd_seq += '({})'.format(str(filterchain).strip())
-        return self
+        self._channels.extend(filterchain.channels)
+        param_sql, params = filterchain.compile()
+        return self._add_term('({})'.format(str(filterchain).strip()),
+                              '({})'.format(param_sql.strip()),
+                              params, filterchain.shape, filterchain)
 
+    def compile(self):
+        """
+        Returns the filter as an SQL expression with '?' placeholders and
+        the list of values to bind to them
+        """
+        return self._param_seq, self._params[:]
+
+    @property
+    def shape(self):
+        """
+        A hashable key for the structure of the filter: channels,
+        operators and grouping, but not the values compared against.
+        Filters of the same shape compile to the same SQL
+        """
+        return tuple(self._shape)
+
+    def _evaluate(self, columns):
+        """
+        Evaluates the filter against a dict of channel arrays and returns
+        a boolean mask. AND binds tighter than OR, as it does in SQL
+        """
+        compare_ops = {'=': np.equal, '<': np.less, '>': np.greater,
+                       '<=': np.less_equal, '>=': np.greater_equal}
+        result = None
+        conjunction = None
+        comb_op = None
+
+        for term in self._terms:
+            if term in ('AND', 'OR'):
+                comb_op = term
+                continue
+
+            if isinstance(term, Filter):
+                mask = term._evaluate(columns)
+            else:
+                chan, op, val = term
+                #NaN (NULL) never matches, just as in SQL
+                with np.errstate(invalid='ignore'):
+                    mask = compare_ops[op](columns[chan], val)
+
+            if comb_op == 'OR':
+                result = conjunction if result is None else result | conjunction
+                conjunction = mask
+            else:
+                conjunction = mask if conjunction is None else conjunction & mask
+
+        return conjunction if result is None else result | conjunction
+
+
+class _ColumnCursor(object):
+    """
+    Minimal cursor over a set of channel arrays, lets a DataSet read from
+    columnar storage the same way it reads from an sqlite cursor
+    """
+    def __init__(self, channels, columns):
+        self.description = [(c, None, None, None, None, None, None) for c in channels]
+        #float64 arrays are handed out as they are, blanks (NaN) included
+        self._columns = columns
+        self._pos = 0
+        self.rowcount = len(columns[0]) if columns else 0
+
+    def fetch_columns(self, count):
+        end = self._pos + count
+        columns = [c[self._pos:end] for c in self._columns]
+        self._pos = min(end, len(self._columns[0])) if self._columns else 0
+        return columns
+
+    def fetchmany(self, count):
+        return zip(*[_as_list(c) for c in self.fetch_columns(count)])
+
+class _PartitionCursor(object):
+    """
+    Cursor over one statement per session partition, run one after the
+    other as the rows are read, lets a DataSet read a query of several
+    sessions as a single result
+    """
+    def __init__(self, conn, statements):
+        self._conn = conn
+        self._statements = list(statements)
+        self._cur = None
+        self._next()
+        self.description = self._cur.description
+
+    def _next(self):
+        sql, params = self._statements.pop(0)
+        self._cur = self._conn.cursor()
+        self._cur.execute(sql, params)
+
+    def fetchmany(self, count):
+        rows = self._cur.fetchmany(count)
+        while len(rows) < count and self._statements:
+            self._next()
+            rows += self._cur.fetchmany(count - len(rows))
+        return rows
+
+
+class _LRUCache(object):
+    """
+    Least recently used cache with hit/miss counters. If max_bytes is
+    set, entries are also evicted to keep the sizes given to put within
+    it, and an entry bigger than that isn't kept at all
+    """
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        #Queries may run on several threads at once
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+                self.bytes -= self._sizes.pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                evicted = self._entries.popitem(last=False)[0]
+                self.bytes -= self._sizes.pop(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'entries': len(self._entries), 'bytes': self.bytes}
+
+class ChannelStats(object):
+    """
+    Aggregates of a channel over a session (or over all sessions)
+    stddev is the population standard deviation
+    """
+    def __init__(self, count=0, min=None, max=None, mean=None, stddev=None,
+                 first_sample_id=None, last_sample_id=None):
+        self.count = count
+        self.min = min
+        self.max = max
+        self.mean = mean
+        self.stddev = stddev
+        self.first_sample_id = first_sample_id
+        self.last_sample_id = last_sample_id
+
+def _merge_stats(a, b):
+    """
+    Merges two (count, min, max, mean, m2, first_id, last_id) aggregates,
+    m2 being the sum of squared differences from the mean
+    """
+    if not a[0]:
+        return b
+    if not b[0]:
+        return a
+
+    count = a[0] + b[0]
+    delta = b[3] - a[3]
+    mean = a[3] + delta * b[0] / count
+    m2 = a[4] + b[4] + delta * delta * a[0] * b[0] / count
+    return (count, min(a[1], b[1]), max(a[2], b[2]), mean, m2,
+            min(a[5], b[5]), max(a[6], b[6]))
+
+class _ChannelStatsBuilder(object):
+    """
+    Accumulates per channel aggregates one block at a time while a
+    datalog streams in
+    """
+    def __init__(self, channel_count):
+        self._stats = [(0, None, None, None, None, None, None)] * channel_count
+
+    def _block_aggregates(self, block, first_sample_id):
+        if np is not None:
+            valid = ~np.isnan(block)
+            counts = valid.sum(axis=0)
+            filled = np.where(valid, block, 0.0)
+            means = filled.sum(axis=0) / np.maximum(counts, 1)
+            m2s = (np.where(valid, block - means, 0.0) ** 2).sum(axis=0)
+            mins = np.where(valid, block, np.inf).min(axis=0)
+            maxs = np.where(valid, block, -np.inf).max(axis=0)
+            firsts = valid.argmax(axis=0)
+            lasts = len(block) - 1 - valid[::-1].argmax(axis=0)
+            return [(int(counts[i]), float(mins[i]), float(maxs[i]), float(means[i]),
+                     float(m2s[i]), first_sample_id + int(firsts[i]), first_sample_id + int(lasts[i]))
+                    for i in range(block.shape[1])]
+
+        aggregates = []
+        for column in zip(*block):
+            present = [(i, x) for i, x in enumerate(column) if x is not None]
+            if not present:
+                aggregates.append((0, None, None, None, None, None, None))
+                continue
+            values = [x for i, x in present]
+            mean = sum(values) / len(values)
+            aggregates.append((len(values), min(values), max(values), mean,
+                               sum((x - mean) ** 2 for x in values),
+                               first_sample_id + present[0][0], first_sample_id + present[-1][0]))
+        return aggregates
+
+    def add_block(self, block, first_sample_id):
+        aggregates = self._block_aggregates(block, first_sample_id)
+        self._stats = [_merge_stats(a, b) for a, b in zip(self._stats, aggregates)]
+
+    def write(self, conn, session_id, channel_ids):
+        #Replaces the stats written so far, a recording writes them with
+        #every batch
+        conn.executemany("""INSERT OR REPLACE INTO channel_stats
+        (session_id, channel_id, count, min, max, mean, stddev, first_sample_id, last_sample_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [(session_id, channel_id, count, min_val, max_val, mean,
+          math.sqrt(m2 / count) if count else None, first_id, last_id)
+         for channel_id, (count, min_val, max_val, mean, m2, first_id, last_id)
+         in zip(channel_ids, self._stats)])
+
+class _LapIndexBuilder(object):
+    """
+    Finds lap boundaries while a datalog streams in. A lap is a run of
+    samples with the same LapCount; its lap time is the LapTime reported
+    as the next lap starts, the last lap of a session has none
+    """
+    def __init__(self, channels):
+        names = [x.name for x in channels]
+        self._lap_idx = names.index('LapCount') if 'LapCount' in names else None
+        self._time_idx = names.index('LapTime') if 'LapTime' in names else None
+        self._ts_idx = names.index('ts') if 'ts' in names else None
+        self._current = None
+        self._last = None
+        self.laps = []
+
+    def _value(self, block, row, idx):
+        if idx is None:
+            return None
+        value = block[row][idx]
+        if value is None or math.isnan(value):
+            return None
+        return float(value)
+
+    def add_block(self, block, first_sample_id):
+        if self._lap_idx is None or not len(block):
+            return
+
+        #Only the rows where LapCount changes are interesting
+        if np is not None:
+            column = block[:, self._lap_idx]
+            rows = [0] + (np.nonzero(column[1:] != column[:-1])[0] + 1).tolist()
+        else:
+            rows = [0] + [i for i in range(1, len(block))
+                          if block[i][self._lap_idx] != block[i - 1][self._lap_idx]]
+
+        for row in rows:
+            lap = self._value(block, row, self._lap_idx)
+            if lap is None or (self._current is not None and self._current[0] == lap):
+                continue
+
+            if self._current is not None:
+                if row > 0:
+                    end = (first_sample_id + row - 1, self._value(block, row - 1, self._ts_idx))
+                else:
+                    end = self._last
+                self._close(end, self._value(block, row, self._time_idx))
+
+            self._current = (lap, first_sample_id + row, self._value(block, row, self._ts_idx))
+
+        last_row = len(block) - 1
+        self._last = (first_sample_id + last_row, self._value(block, last_row, self._ts_idx))
+
+    def _close(self, end, lap_time):
+        lap, start_id, start_ts = self._current
+        end_id, end_ts = end
+        self.laps.append((int(lap), start_id, end_id, lap_time, start_ts, end_ts))
+
+    def flush(self, conn, session_id):
+        """
+        Writes the laps completed since the last flush
+        """
+        conn.executemany("""INSERT INTO lap
+        (session_id, lap, start_sample_id, end_sample_id, lap_time, start_ts, end_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""", [(session_id,) + x for x in self.laps])
+        self.laps = []
+
+    def write(self, conn, session_id):
+        if self._current is not None:
+            self._close(self._last, None)
+            self._current = None
+        self.flush(conn, session_id)
+
+def _empty_buckets(width):
+    if np is not None:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty((0, width)), np.empty((0, width)), np.empty((0, width)), np.empty((0, width)))
+    return []
+
+def _raw_buckets(block, first_sample_id):
+    """
+    Turns a block of samples into buckets of one sample each. Buckets are
+    (sample_ids, counts, mins, maxs, firsts, lasts), as arrays with one
+    row per bucket, or without numpy a list of such tuples
+    """
+    if np is not None:
+        ids = np.arange(first_sample_id, first_sample_id + len(block), dtype=np.int64)
+        return (ids, np.ones(len(block), dtype=np.int64), block, block, block, block)
+    return [(first_sample_id + i, 1, row, row, row, row) for i, row in enumerate(block)]
+
+def _concat_buckets(a, b):
+    if np is not None:
+        return tuple(np.concatenate((x, y)) for x, y in zip(a, b))
+    return a + b
+
+def _bucket_rows(buckets):
+    if np is not None:
+        return zip(*[x.tolist() for x in buckets])
+    return buckets
+
+def _present(fn, values):
+    present = [x for x in values if x is not None]
+    return fn(present) if present else None
+
+def _merge_buckets(buckets, ratio, final=False):
+    """
+    Merges every ratio consecutive buckets into one. Returns the merged
+    buckets and the ones left over, unless final is set in which case
+    the leftovers are merged into one last partial bucket
+    """
+    if np is not None:
+        ids, counts, mins, maxs, firsts, lasts = buckets
+        groups = len(ids) // ratio
+        full = groups * ratio
+        width = mins.shape[1]
+        merged = (ids[:full:ratio], counts[:full].reshape(groups, ratio).sum(axis=1),
+                  np.fmin.reduce(mins[:full].reshape(groups, ratio, width), axis=1),
+                  np.fmax.reduce(maxs[:full].reshape(groups, ratio, width), axis=1),
+                  firsts[:full:ratio], lasts[ratio - 1:full:ratio])
+        rest = tuple(x[full:] for x in buckets)
+        if final and len(rest[0]):
+            merged = _concat_buckets(merged, _merge_buckets(rest, len(rest[0]))[0])
+            rest = _empty_buckets(width)
+        return merged, rest
+
+    groups = [buckets[i:i + ratio] for i in range(0, len(buckets), ratio)]
+    rest = []
+    if groups and len(groups[-1]) < ratio and not final:
+        rest = groups.pop()
+
+    merged = []
+    for group in groups:
+        columns = range(len(group[0][2]))
+        merged.append((group[0][0], sum(x[1] for x in group),
+                       [_present(min, [x[2][i] for x in group]) for i in columns],
+                       [_present(max, [x[3][i] for x in group]) for i in columns],
+                       group[0][4], group[-1][5]))
+    return merged, rest
+
+class _PyramidBuilder(object):
+    """
+    Builds the min/max decimation pyramid of every channel while a
+    datalog streams in. Each level merges the buckets of the level below
+    it, so buckets of every level start at a multiple of their size from
+    the start of the session
+    """
+    def __init__(self, channel_count):
+        self._width = channel_count
+        self._pending = [_empty_buckets(channel_count) for x in PYRAMID_FACTORS]
+        self._levels = [[] for x in PYRAMID_FACTORS]
+
+    def _feed(self, buckets, final=False):
+        previous = 1
+        for level, factor in enumerate(PYRAMID_FACTORS):
+            pending = _concat_buckets(self._pending[level], buckets)
+            buckets, self._pending[level] = _merge_buckets(pending, factor // previous, final)
+            self._levels[level].append(buckets)
+            previous = factor
+
+    def add_block(self, block, first_sample_id):
+        self._feed(_raw_buckets(block, first_sample_id))
+
+    def flush(self, conn, table, session_id, channel_ids):
+        """
+        Writes the buckets finished since the last flush. The ones still
+        waiting on samples are kept
+        """
+        levels = self._levels
+        self._levels = [[] for x in PYRAMID_FACTORS]
+        for factor, level in zip(PYRAMID_FACTORS, levels):
+            for buckets in level:
+                rows = [(session_id, channel_id, factor, sample_id, count,
+                         mins[i], maxs[i], firsts[i], lasts[i])
+                        for sample_id, count, mins, maxs, firsts, lasts in _bucket_rows(buckets)
+                        for i, channel_id in enumerate(channel_ids)]
+                #A session without samples has no partition to write to
+                if rows:
+                    conn.executemany("""INSERT INTO {}
+                    (session_id, channel_id, factor, first_sample_id, count, min, max, first, last)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""".format(table), rows)
+
+    def write(self, conn, table, session_id, channel_ids):
+        self._feed(_empty_buckets(self._width), final=True)
+        self.flush(conn, table, session_id, channel_ids)
+
+class ChannelEnvelope(object):
+    """
+    Decimated view of a channel returned by DataStore.query_decimated.
+    Bucket i covers the samples from sample_ids[i] up to the next bucket,
+    with the smallest, largest, first and last value seen in it; plotting
+    min and max keeps the peaks visible at any zoom level
+    """
+    def __init__(self, factor, buckets):
+        self.factor = factor
+        if np is not None:
+            self.sample_ids = buckets[0]
+            self.min, self.max, self.first, self.last = [x[:, 0] for x in buckets[2:]]
+        else:
+            self.sample_ids = [x[0] for x in buckets]
+            self.min, self.max, self.first, self.last = \
+                [[x[i][0] for x in buckets] for i in range(2, 6)]
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+class Aggregates(object):
+    """
+    Result of DataStore.aggregate, one entry per group in group order.
+    keys names the group key columns: session, then lap or bucket (the
+    start of a time bucket, in ms) as grouped, and groups holds an
+    int64 array per key. values holds a float64 array per (channel,
+    function), NaN where a group has no values for the channel. Plain
+    lists, with None for NaN, without numpy
+    """
+    def __init__(self, keys, groups, values):
+        self.keys = keys
+        self.groups = groups
+        self.values = values
+
+    def get(self, channel, func):
+        return self.values[(channel, func)]
+
+    def __len__(self):
+        return len(self.groups[self.keys[0]])
+
+def _fingerprint(path):
+    """
+    Returns the SHA-1 of a file's contents, read a piece at a time
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(FINGERPRINT_READ_SIZE)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+def _read_datalog(args):
+    """
+    Reads and desparsifies a whole datalog, run in the import_datalogs
+    process pool. args are (index, path, keep_logged), returns (index,
+    header, blocks, logged, fingerprint, error); logged holds the masks
+    of the values logged in each block if keep_logged is set, see
+    _desparsify_blocks
+    """
+    index, path, keep_logged = args
+    try:
+        fingerprint = _fingerprint(path)
+        with open(path, 'rb') as dl:
+            header = dl.readline()
+            logged = [] if keep_logged else None
+            blocks = list(_desparsify_blocks(dl, logged=logged))
+            return index, header, blocks, logged, fingerprint, None
+    except Exception as e:
+        return index, None, None, None, None, "Unable to import datalog {}: {}".format(path, e)
+
+class _InFlightLimit(object):
+    """
+    Hands out the items of an iterable no more than limit at a time: once
+    limit of them are out, the next one waits until done() is called for
+    one of those. A process pool's task thread iterates it, so files are
+    only read as fast as they are written
+    """
+    def __init__(self, iterable, limit):
+        self._iterable = iterable
+        self._slots = threading.Semaphore(limit)
+        self._stopped = False
+
+    def __iter__(self):
+        for item in self._iterable:
+            self._slots.acquire()
+            if self._stopped:
+                return
+            yield item
+
+    def done(self):
+        self._slots.release()
+
+    def stop(self):
+        """
+        Ends the iteration, whatever is still out
+        """
+        self._stopped = True
+        self._slots.release()
+
+class _ReaderHandle(object):
+    """
+    Holds a thread's reader connection in its thread local storage; it
+    goes away with the thread, which lets the DataStore close the
+    connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+class DatalogImportResult(object):
+    """
+    Outcome of importing one file with DataStore.import_datalogs: the new
+    session_id, or the error that stopped the import
+    """
+    def __init__(self, path, session_id=None, error=None):
+        self.path = path
+        self.session_id = session_id
+        self.error = error
+
+class SessionInfo(object):
+    """
+    A session as listed by DataStore.list_sessions: samples is its sample
+    count, bytes what its channel data and position index take in the
+    database
+    """
+    def __init__(self, session_id, name, notes, date, samples=0, bytes=0):
+        self.session_id = session_id
+        self.name = name
+        self.notes = notes
+        self.date = date
+        self.samples = samples
+        self.bytes = bytes
 
 class DatalogChannel(object):
     def __init__(self, channel_name='', units='', sample_rate=0, smoothing=0):
@@ -217,50 +1178,241 @@ class DataStore(object):
         self._isopen = False
         self.datalog_channels = {}
         self.datalogchanneltypes = {}
+        self.storage = ROW_STORAGE
+        self._columnar_bytes_read = 0
+        self._geo_index = False
+        #Expressions of the derived channels, by channel name
+        self._derived = {}
+        self._derived_cache = _LRUCache(QUERY_CACHE_SIZE)
+        self._statement_cache = _LRUCache(QUERY_CACHE_SIZE)
+        self._channel_meta_cache = _LRUCache(QUERY_CACHE_SIZE)
+        self._result_cache = _LRUCache(QUERY_CACHE_SIZE, RESULT_CACHE_BYTES)
+        #Bumped whenever the data changes, results read under an earlier
+        #generation aren't cached
+        self._data_generation = 0
+        self._readers = threading.local()
+        self._readers_lock = threading.Lock()
+        #Reader connections by a weak reference to their _ReaderHandle
+        self._reader_conns = {}
+        self._vacuum = None
 
     def close(self):
+        if self._vacuum is not None:
+            self._vacuum.stop()
+            self._vacuum = None
+        with self._readers_lock:
+            reader_conns = self._reader_conns.values()
+            self._reader_conns = {}
+        #Handles dropped from here on find nothing left to close
+        self._readers = threading.local()
+        for conn in reader_conns:
+            conn.close()
         self._conn.close()
         self._isopen = False
 
-    def open_db(self, name):
+    def _connect(self):
+        #Connections are handed between threads, but each is only ever
+        #used by one thread at a time
+        conn = sqlite3.connect(self.name, check_same_thread=False)
+        conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        conn.execute('PRAGMA cache_size={}'.format(self.cache_size))
+        conn.create_function('rc_distance', 4, _distance_m)
+        return conn
+
+    def open_db(self, name, synchronous=DEFAULT_SYNCHRONOUS, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Opens a datastore in WAL mode. The connection opened here is the
+        only one that writes; queries go through a reader connection per
+        thread, so they run alongside an import or a recording
+
+        :param name: path of the database file
+        :param synchronous: sqlite synchronous mode, one of SYNCHRONOUS_MODES
+        :param cache_size: sqlite page cache size of every connection,
+        in pages, or in KiB if negative
+        """
         if self._isopen:
             self.close()
 
+        synchronous = str(synchronous).upper()
+        if not synchronous in SYNCHRONOUS_MODES:
+            raise Exception("Unknown synchronous mode: {}".format(synchronous))
+
         self.name = name
-        self._conn = sqlite3.connect(self.name)
+        self.synchronous = synchronous
+        self.cache_size = int(cache_size)
+        self._conn = self._connect()
+        #Lets the pages of deleted sessions be released a few at a time.
+        #Only takes effect on a database without tables yet, before it
+        #switches to WAL: one new() is about to create
+        self._conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        if not name in (':memory:', ''):
+            self._vacuum = VacuumScheduler(name)
 
         self._isopen = True
+        self._load_store_info()
+
+    def _get_reader(self):
+        """
+        Returns the reader connection of the calling thread. An in memory
+        database can't be shared between connections, there the writer
+        connection does the reading as well
+        """
+        if self.name in (':memory:', ''):
+            return self._conn
+
+        handle = getattr(self._readers, 'handle', None)
+        if handle is None:
+            handle = _ReaderHandle(self._connect())
+            self._readers.handle = handle
+            with self._readers_lock:
+                self._reader_conns[weakref.ref(handle, self._release_reader)] = handle.conn
+        return handle.conn
+
+    def _set_interrupt_check(self, interrupt_check):
+        """
+        Sets a progress handler for the reads of the calling thread. As
+        sqlite calls a connection's between statement instructions, it is
+        called between the chunks decoded from columnar storage and the
+        reads of the DataSets queried, a non zero return aborts them with
+        sqlite3.OperationalError. None removes it
+        """
+        self._readers.interrupt_check = interrupt_check
+
+    def _get_interrupt_check(self):
+        return getattr(self._readers, 'interrupt_check', None)
+
+    def _release_reader(self, handle_ref):
+        """
+        Closes the reader connection of a thread that has exited
+        """
+        with self._readers_lock:
+            conn = self._reader_conns.pop(handle_ref, None)
+        if conn is not None:
+            conn.close()
+
+    def _data_changed(self):
+        """
+        Drops everything cached from the data: query results, evaluated
+        expressions and channel smoothing settings
+        """
+        self._data_generation += 1
+        self._result_cache.clear()
+        self._derived_cache.clear()
+        self._channel_meta_cache.clear()
+
+    def _check_data_version(self):
+        """
+        Notices changes committed through other connections, such as a
+        SessionRecorder's, since the calling thread last looked; our own
+        are dropped from the caches as they are made
+        """
+        version = self._get_reader().execute('PRAGMA data_version').fetchone()[0]
+        last_version = getattr(self._readers, 'data_version', version)
+        self._readers.data_version = version
+        if version != last_version:
+            self._data_changed()
+
+    @property
+    def _columnar(self):
+        return self.storage in [COLUMNAR_STORAGE, COMPRESSED_STORAGE, SPARSE_STORAGE]
 
-    def new(self, name=':memory:'):
-        self.open_db(name)
+    def refresh(self):
+        """
+        Reloads the storage layout and channels, picking up channels added
+        through another connection such as a SessionRecorder
+        """
+        self._load_store_info()
+
+    def new(self, name=':memory:', storage=ROW_STORAGE, synchronous=DEFAULT_SYNCHRONOUS,
+            cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Creates a new datastore
+
+        :param name: path of the database file, in memory by default
+        :param storage: ROW_STORAGE for one wide row per sample,
+        COLUMNAR_STORAGE for packed per-channel arrays,
+        COMPRESSED_STORAGE for delta encoded per-channel arrays or
+        SPARSE_STORAGE for per-channel arrays of the samples logged
+        (all three require numpy)
+        :param synchronous: sqlite synchronous mode, see open_db
+        :param cache_size: sqlite page cache size, see open_db
+        """
+        if not storage in STORAGE_LAYOUTS:
+            raise Exception("Unknown storage layout: {}".format(storage))
+        if storage != ROW_STORAGE and np is None:
+            raise Exception("Columnar storage requires numpy")
+
+        self.open_db(name, synchronous, cache_size)
+        self.storage = storage
         self._create_tables()
 
+    def _load_store_info(self):
+        """
+        Loads the storage layout and known channels of an existing database
+        """
+        self.storage = ROW_STORAGE
+        self._channels = []
+        self._statement_cache.clear()
+        self._data_changed()
+        self._derived = {}
+        c = self._conn.cursor()
+        try:
+            c.execute("SELECT value FROM datastore_info WHERE name='storage'")
+            res = c.fetchone()
+            if res:
+                self.storage = str(res[0])
+
+            c.execute("SELECT name, units, sample_rate FROM channel ORDER BY id")
+            self._channels = [DatalogChannel(str(name), units, sample_rate)
+                              for name, units, sample_rate in c.fetchall()]
+
+            c.execute("SELECT name, expression FROM channel WHERE expression IS NOT NULL")
+            self._derived = dict((str(name), expression) for name, expression in c.fetchall())
+
+            c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='sample_geo_template'")
+            self._geo_index = c.fetchone()[0] > 0
+        except sqlite3.OperationalError:
+            #A brand new database, nothing to load yet
+            pass
+
     def _create_tables(self):
 
+        self._conn.execute("""CREATE TABLE datastore_info
+        (name TEXT PRIMARY KEY, value TEXT NOT NULL)""")
+
+        self._conn.execute("""INSERT INTO datastore_info (name, value)
+        VALUES ('storage', ?)""", (self.storage,))
+
         self._conn.execute("""CREATE TABLE session
         (id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL,
         notes TEXT NULL,
-        date INTEGER NOT NULL)""")
+        date INTEGER NOT NULL,
+        first_sample_id INTEGER NULL, last_sample_id INTEGER NULL)""")
 
         self._conn.execute("""CREATE TABLE datalog_info
         (id INTEGER PRIMARY KEY AUTOINCREMENT,
         max_sample_rate INTEGER NOT NULL, time_offset INTEGER NOT NULL,
-        name TEXT NOT NULL, notes TEXT NULL)""")
-
-        self._conn.execute("""CREATE TABLE datapoint
-        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sample_id INTEGER NOT NULL)""")
+        name TEXT NOT NULL, notes TEXT NULL,
+        fingerprint TEXT NULL, session_id INTEGER NULL,
+        checkpoint_offset INTEGER NOT NULL DEFAULT 0, checkpoint_sample_id INTEGER NULL,
+        complete INTEGER NOT NULL DEFAULT 0)""")
 
-        self._conn.execute("""CREATE TABLE sample
-        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id INTEGER NOT NULL)""")
+        self._conn.execute("""CREATE UNIQUE INDEX datalog_info_index_fingerprint
+        on datalog_info(fingerprint)""")
 
-        self._conn.execute("""CREATE INDEX sample_index_id on sample(id)""")
+        #Every session gets its own copy of this table, see
+        #_create_partitions, so a session can be deleted by dropping it
+        self._conn.execute("""CREATE TABLE datapoint_template
+        (id INTEGER PRIMARY KEY,
+        sample_id INTEGER NOT NULL, session_id INTEGER NOT NULL)""")
 
         self._conn.execute("""CREATE TABLE channel
         (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
-        units TEXT NOT NULL, smoothing INTEGER NOT NULL)""")
+        units TEXT NOT NULL, sample_rate INTEGER NOT NULL DEFAULT 0,
+        smoothing INTEGER NOT NULL, smoothing_kernel TEXT NOT NULL DEFAULT '{}',
+        expression TEXT NULL)""".format(INTERP_KERNEL))
 
         self._conn.execute("""CREATE TABLE datalog_channel_map
         (datalog_id INTEGER NOT NULL, channel_id INTEGER NOT NULL)""")
@@ -268,37 +1420,205 @@ class DataStore(object):
         self._conn.execute("""CREATE TABLE datalog_event_map
         (datalog_id INTEGER NOT NULL, event_id INTEGER NOT NULL)""")
 
+        #offsets, for sparse storage, holds the offsets from
+        #first_sample_id of the values in data; NULL when data has a value
+        #for every sample. min and max bound the chunk's values, ahead of
+        #data so they are read without it, see _read_time_window_columns
+        self._conn.execute("""CREATE TABLE channel_data
+        (session_id INTEGER NOT NULL, channel_id INTEGER NOT NULL,
+        chunk INTEGER NOT NULL, first_sample_id INTEGER NOT NULL,
+        count INTEGER NOT NULL, min REAL NULL, max REAL NULL,
+        data BLOB NOT NULL, offsets BLOB NULL)""")
+
+        #Session first, so a session's chunks are deleted without a scan
+        self._conn.execute("""CREATE INDEX channel_data_index_session on
+        channel_data(session_id, channel_id, chunk)""")
+
+        self._conn.execute("""CREATE TABLE channel_stats
+        (session_id INTEGER NOT NULL, channel_id INTEGER NOT NULL,
+        count INTEGER NOT NULL, min REAL NULL, max REAL NULL,
+        mean REAL NULL, stddev REAL NULL,
+        first_sample_id INTEGER NULL, last_sample_id INTEGER NULL,
+        PRIMARY KEY (channel_id, session_id))""")
+
+        self._conn.execute("""CREATE INDEX channel_stats_index_session on
+        channel_stats(session_id)""")
+
+        self._conn.execute("""CREATE TABLE lap
+        (session_id INTEGER NOT NULL, lap INTEGER NOT NULL,
+        start_sample_id INTEGER NOT NULL, end_sample_id INTEGER NOT NULL,
+        lap_time REAL NULL, start_ts REAL NULL, end_ts REAL NULL)""")
+
+        self._conn.execute("""CREATE INDEX lap_index_session on lap(session_id, lap)""")
+
+        #GPS position of every sample, keyed by sample id, for position
+        #queries, partitioned by session like datapoint. Not every sqlite
+        #is built with R*Tree support
+        try:
+            self._conn.execute("""CREATE VIRTUAL TABLE sample_geo_template USING rtree
+            (id, min_lat, max_lat, min_lon, max_lon)""")
+            self._geo_index = True
+        except sqlite3.OperationalError as e:
+            logging.warn("DataStore: no R*Tree support, position queries are unavailable: {}".format(e))
+            self._geo_index = False
+
         self._conn.commit()
 
     def _extend_datalog_channels(self, channels):
-        #print "Adding channels: ", channel_names
+        """
+        Adds the channels to the channel table and, for row storage, as
+        columns of the datapoint tables. Runs inside _register_channels'
+        transaction
+        """
+        if self.storage == ROW_STORAGE and channels:
+            tables = ['datapoint_template'] + [self._partition_name('datapoint', x)
+                                               for x in self._get_partitions('datapoint', self._conn)]
+            c = self._conn.cursor()
+            columns = {}
+            for table in tables:
+                c.execute("PRAGMA table_info({})".format(table))
+                columns[table] = [str(x[1]) for x in c.fetchall()]
         for channel in channels:
-            #Extend the datapoint table to include the channel as a
-            #new field
-            self._conn.execute("""ALTER TABLE datapoint
-            ADD {} REAL""".format(channel.name))
+            #Extend the datapoint tables to include the channel as a
+            #new field, columnar storage keeps its data in channel_data
+            if self.storage == ROW_STORAGE:
+                for table in tables:
+                    if channel.name in columns[table]:
+                        continue
+                    self._conn.execute("""ALTER TABLE {}
+                    ADD {} REAL""".format(table, channel.name))
+
+                    #Time window queries go through this index
+                    if channel.name == 'ts':
+                        self._create_ts_index(table)
 
             #Add the channel to the 'channel' table
-            self._conn.execute("""INSERT INTO channel (name, units, smoothing)
-            VALUES (?,?,?)""", (channel.name, channel.units, 1))
+            self._conn.execute("""INSERT INTO channel (name, units, sample_rate, smoothing)
+            VALUES (?,?,?,?)""", (channel.name, channel.units, channel.sample_rate, 1))
+
+    def _partition_name(self, table, session_id):
+        return '{}_{}'.format(table, int(session_id))
+
+    def _get_partitions(self, table, conn=None):
+        """
+        Returns the ids of the sessions that have a partition of table
+        ('datapoint', 'sample_geo' or 'channel_pyramid'), in session order
+        """
+        c = (conn or self._get_reader()).cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB ?",
+                  (table + '_[0-9]*',))
+        pattern = re.compile(r'^{}_(\d+)$'.format(table))
+        matches = [pattern.match(str(x[0])) for x in c.fetchall()]
+        return sorted(int(x.group(1)) for x in matches if x)
+
+    def _create_ts_index(self, table):
+        suffix = table[len('datapoint'):] if table != 'datapoint_template' else ''
+        self._conn.execute("""CREATE INDEX datapoint_index_session_ts{}
+        on {}(session_id, ts)""".format(suffix, table))
+
+    def _create_partitions(self, session_id):
+        """
+        Creates the session's own datapoint table, with the columns and
+        indexes of datapoint_template, sample_geo index and
+        channel_pyramid table, unless it has them already. Rows of
+        different sessions never share a table, so deleting a session is
+        a DROP TABLE rather than a DELETE through every index, and a query
+        of one session only touches its own
+        """
+        tables = ['channel_pyramid']
+        if self.storage == ROW_STORAGE:
+            tables.append('datapoint')
+        if self._geo_index:
+            tables.append('sample_geo')
+        c = self._conn.cursor()
+        missing = []
+        for table in tables:
+            name = self._partition_name(table, session_id)
+            c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name=?", (name,))
+            if not c.fetchone()[0]:
+                missing.append((table, name))
+        if not missing:
+            return
+
+        with self._transaction():
+            for table, name in missing:
+                if table == 'sample_geo':
+                    self._conn.execute("""CREATE VIRTUAL TABLE {} USING rtree
+                    (id, min_lat, max_lat, min_lon, max_lon)""".format(name))
+                    continue
+                if table == 'channel_pyramid':
+                    self._conn.execute("""CREATE TABLE {}
+                    (session_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, factor INTEGER NOT NULL,
+                    first_sample_id INTEGER NOT NULL, count INTEGER NOT NULL,
+                    min REAL NULL, max REAL NULL, first REAL NULL, last REAL NULL)""".format(name))
+                    self._conn.execute("""CREATE INDEX channel_pyramid_index_channel_{}
+                    on {}(channel_id, factor, first_sample_id)""".format(session_id, name))
+                    continue
 
+                c.execute("PRAGMA table_info(datapoint_template)")
+                columns = [str(x[1]) for x in c.fetchall()][3:]
+                self._conn.execute("""CREATE TABLE {}
+                (id INTEGER PRIMARY KEY,
+                sample_id INTEGER NOT NULL, session_id INTEGER NOT NULL{})""".format(
+                    name, ''.join(', {} REAL'.format(x) for x in columns)))
+                self._conn.execute("""CREATE INDEX datapoint_index_sample_id_{}
+                on {}(sample_id)""".format(session_id, name))
+                if 'ts' in columns:
+                    self._create_ts_index(name)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Runs the block as a single transaction on the writer connection,
+        schema changes included, which the sqlite3 module would otherwise
+        commit on their own. The block must not commit
+        """
         self._conn.commit()
+        isolation_level = self._conn.isolation_level
+        self._conn.isolation_level = None
+        try:
+            #Takes the write lock up front, waiting for it if need be. A
+            #deferred transaction that reads first can't wait for it later
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        finally:
+            self._conn.isolation_level = isolation_level
+
+    def _register_channels(self, channels):
+        """
+        Adds the channels the datastore doesn't have yet. Another
+        connection, a SessionRecorder's or another DataStore's, may have
+        added some since ours were loaded, so the channel table is read
+        again under the write lock
+        """
+        with self._transaction():
+            c = self._conn.cursor()
+            c.execute("SELECT name, units, sample_rate FROM channel ORDER BY id")
+            self._channels = [DatalogChannel(str(name), units, sample_rate)
+                              for name, units, sample_rate in c.fetchall()]
+            new_channels = []
+            for channel in channels:
+                if not channel.name in [x.name for x in self._channels + new_channels]:
+                    new_channels.append(channel)
+            self._extend_datalog_channels(new_channels)
+        self._channels += new_channels
 
     def _parse_datalog_headers(self, header):
         raw_channels = header.split(',')
         channels = []
 
         try:
-            new_channels = []
             for i in range(1, len(raw_channels)+1):
                 name, units, samplerate = raw_channels[i -1].replace('"', '').split('|')
                 #print name, units, samplerate
                 channel = DatalogChannel(name, units, int(samplerate), 0)
                 channels.append(channel)
-                if not name in [x.name for x in self._channels]:
-                    new_channels.append(channel)
-                    self._channels.append(channel)
-            self._extend_datalog_channels(new_channels)
+            self._register_channels(channels)
         except:
             import sys, traceback
             print "Exception in user code:"
@@ -329,181 +1649,160 @@ class DataStore(object):
         #print "Last datapoint ID =", dp_id
         return dl_id
 
-    def _insert_record(self, record, channels, session_id):
+    def _get_session_id_block(self, session_id):
         """
-        Takes a record of interpolated+extrapolated channels and their header metadata
-        and inserts it into the database
+        Returns the first and last sample id a session may use. Every
+        session has a block of ids of its own, so sessions written at the
+        same time, a recording and an import say, never compete for ids
+        and each one stays a single run of consecutive ids
         """
-        datalog_id = self._get_last_table_id('sample') + 1
-
-        #First, insert into the datalog table to give us a reference
-        #point for the datapoint insertions
+        first_id = (session_id - 1) * SESSION_ID_BLOCK + 1
+        return first_id, first_id + SESSION_ID_BLOCK - 1
 
-        self._conn.execute("""INSERT INTO sample
-        (session_id) VALUES (?)""", [session_id])
+    def _get_sample_session(self, sample_id):
+        """
+        Returns the id of the session a sample id belongs to
+        """
+        return (sample_id - 1) // SESSION_ID_BLOCK + 1
 
-        #Insert the datapoints into their tables
-        extrap_vals = [datalog_id] + record
+    def _get_session_range(self, session_id, conn=None):
+        """
+        Returns the first and last sample id written for a session, or
+        (None, None) if it has none
+        """
+        c = (conn or self._get_reader()).cursor()
+        c.execute("SELECT first_sample_id, last_sample_id FROM session WHERE id=?", (session_id,))
+        return c.fetchone() or (None, None)
 
-        #Now, insert the record into the datalog table using the ID
-        #list we built up in the previous iteration
+    def _next_sample_id(self, session_id):
+        """
+        Returns the sample id the next record written for a session gets.
+        Only the connection writing a session adds to it, so the answer
+        holds until that connection writes again
+        """
+        last_id = self._get_session_range(session_id, self._conn)[1]
+        if last_id is None:
+            return self._get_session_id_block(session_id)[0]
+        return last_id + 1
 
-        #Put together an insert statement containing the column names
-        base_sql = "INSERT INTO datapoint ("
-        base_sql += ','.join(['sample_id'] + [x.name for x in channels])
+    def _get_datapoint_insert_sql(self, channels, session_id):
+        """
+        Returns a parameterized INSERT statement into the session's
+        datapoint table for a record of the specified channels, prefixed
+        by the sample_id and session_id
+        """
+        columns = ['sample_id', 'session_id'] + [x.name for x in channels]
+        base_sql = "INSERT INTO {} (".format(self._partition_name('datapoint', session_id))
+        base_sql += ','.join(columns)
         base_sql += ') VALUES ('
-
-        #insert the values
-        base_sql += ','.join([str(x) for x in extrap_vals])
+        base_sql += ','.join(['?'] * len(columns))
         base_sql += ')'
 
-        #print "Executing SQL Statement: \n{}".format(base_sql)
-        self._conn.execute(base_sql)
+        return base_sql
 
-    def _extrap_datapoints(self, datapoints):
+    def _get_channel_ids(self, channels, conn=None):
+        c = (conn or self._conn).cursor()
+        ids = []
+        for channel in channels:
+            c.execute("SELECT id FROM channel WHERE name=?", (channel,))
+            res = c.fetchone()
+            if res == None:
+                raise Exception("Unknown channel: {}".format(channel))
+            ids.append(res[0])
+        return ids
+
+    def _insert_positions(self, block, sample_ids, session_id, lat_index, lon_index):
         """
-        Takes a list of datapoints, and returns a new list of extrapolated datapoints
-
-        i.e: '3, nil, nil, nil, 7' (as a column) will become:
-        [3, 3, 3, 3, 7]
-
-         In the event of the 'start' of the dataset, we may have something like:
-        [nil, nil, nil, 5], in this case, we will just back extrapolate, so:
-        [nil, nil, nil, 5] becomes [5, 5, 5, 5]
-
+        Adds the GPS positions of a block to the session's sample_geo
+        index. Samples without a fix, blank or at 0,0, are left out
         """
+        if np is not None:
+            lats = block[:, lat_index]
+            lons = block[:, lon_index]
+            valid = ~(np.isnan(lats) | np.isnan(lons) | ((lats == 0) & (lons == 0)))
+            ids = np.array(sample_ids, dtype=np.int64)[valid].tolist()
+            positions = zip(ids, lats[valid].tolist(), lons[valid].tolist())
+        else:
+            positions = [(i, x[lat_index], x[lon_index]) for i, x in zip(sample_ids, block)
+                         if x[lat_index] is not None and x[lon_index] is not None and
+                         (x[lat_index] != 0 or x[lon_index] != 0)]
 
-        ret_list = []
-
-        # first we need to handle the 'start of dataset, begin on a
-        # miss' case
-        if datapoints[0] == None:
-            ret_list = [datapoints[-1] for x in datapoints]
-            return ret_list
-
-        # Next, we need to handle the case where there are only two
-        # entries and both are hits, if this is the case, we just
-        # duplicate the values in the tuple for each entry and return
-        # that
-        if len(datapoints) == 2:
-            ret_list = [x for x in datapoints]
-            return ret_list
-
-        # If we're here, it means we actually have a start and end
-        # point to this data sample, have blanks in between and need
-        # to interpolate+extrapolate the bits in between
-
-        extrap_list = []
-        for e in range(len(datapoints) - 1):
-            extrap_list.append(datapoints[0])
-        extrap_list.append(datapoints[-1])
+        self._conn.executemany("""INSERT INTO {}
+        (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)""".format(
+            self._partition_name('sample_geo', session_id)),
+        [(i, lat, lat, lon, lon) for i, lat, lon in positions])
 
-        return extrap_list
+    def _pack_column(self, values, logged=None):
+        """
+        Returns a chunk of one channel's float64 values as stored in
+        channel_data: (data, offsets). For sparse storage logged marks
+        the values the datalog had, the others were carried forward
+        """
+        if self.storage == COMPRESSED_STORAGE:
+            return sqlite3.Binary(codec.encode(values)), None
+        if self.storage == SPARSE_STORAGE and logged is not None and len(values):
+            #The channel at the rate it was logged at, and the first value
+            #of the chunk so the chunk reads on its own; reads carry the
+            #values forward again
+            keep = logged.copy()
+            keep[0] = True
+            offsets = np.flatnonzero(keep)
+            offset_type = '<u2' if len(values) <= 1 << 16 else '<u4'
+            if len(offsets) * (8 + np.dtype(offset_type).itemsize) < len(values) * 8:
+                return (sqlite3.Binary(values[offsets].astype('<f8').tostring()),
+                        sqlite3.Binary(offsets.astype(offset_type).tostring()))
+        return sqlite3.Binary(values.astype('<f8').tostring()), None
+
+    def _insert_block(self, block, channels, session_id, chunk, commit=True, logged=None):
+        """
+        Takes a block of interpolated+extrapolated records and their header
+        metadata and inserts it into the database as a single transaction,
+        left open if commit isn't set. The records are given the session's
+        next consecutive sample IDs, the first of which is returned.
+        logged marks the values of the block that were logged, as
+        _desparsify_blocks gives them, sparse storage keeps only those
+        """
+        self._create_partitions(session_id)
+        first_sample_id = self._next_sample_id(session_id)
+        if first_sample_id + len(block) - 1 > self._get_session_id_block(session_id)[1]:
+            raise Exception("Session {} has no sample ids left".format(session_id))
+        sample_ids = range(first_sample_id, first_sample_id + len(block))
+
+        #A session's samples are a single run of ids, only its ends are kept
+        self._conn.execute("""UPDATE session SET first_sample_id=IFNULL(first_sample_id, ?),
+        last_sample_id=? WHERE id=?""", (first_sample_id, sample_ids[-1], session_id))
+
+        names = [x.name for x in channels]
+        if self._geo_index and LATITUDE_CHANNEL in names and LONGITUDE_CHANNEL in names:
+            self._insert_positions(block, sample_ids, session_id, names.index(LATITUDE_CHANNEL),
+                                   names.index(LONGITUDE_CHANNEL))
+
+        if self._columnar:
+            channel_ids = self._get_channel_ids([x.name for x in channels])
+            self._conn.executemany("""INSERT INTO channel_data
+            (session_id, channel_id, chunk, first_sample_id, count, min, max, data, offsets)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [(session_id, channel_id, chunk, first_sample_id, len(block)) +
+             _value_bounds(block[:, i]) +
+             self._pack_column(block[:, i], logged[:, i] if logged is not None else None)
+             for i, channel_id in enumerate(channel_ids)])
+        else:
+            if np is not None:
+                block = block.tolist()
+            records = [[sample_id, session_id] + record for sample_id, record in zip(sample_ids, block)]
+            self._conn.executemany(self._get_datapoint_insert_sql(channels, session_id), records)
 
+        if commit:
+            self._conn.commit()
+        return first_sample_id
 
-    def _desparsified_data_generator(self, data_file):
+    def _desparsified_data_generator(self, data_file, last=None, logged=None):
         """
         Takes a racecapture pro CSV file and removes sparsity from the dataset.
-        This function yields samples that have been extrapolated from the
-        parent dataset.
-
-        'extrapolated' means that we'll just carry all values forward: [3, nil, nil, nil, 7] -> [3, 3, 3, 3, 7, 7, 7...]
-
-        So to summarize: '3, nil, nil, nil, 7' (as a column) will become:
-        [3, 3, 3, 3, 7]
-
-        In the event of the 'start' of the dataset, we may have something like:
-        [nil, nil, nil, 5], in this case, we will just back extrapolate, so:
-        [nil, nil, nil, 5] becomes [5, 5, 5, 5]
-        """
-
-        # Notes on this algorithm: The basic idea is that we're going
-        # 100% bob barker on this data...Think Plinko.
-        # We maintain 2 lists of n lists where n = the number
-        # of columns we're playing with.
-        # Container list 1 holds our work space, we file records into
-        # it one by one into their respective columnar lists.
-        # A data point containing a NIL is a 'miss', a data point
-        # containing some value is a 'hit'.  We continue to file until
-        # we get a 'hit'.  When that happens, we take the slice of the
-        # columnar list [0:hit], extrapolate the
-        # values in between, then take the slice [0:hit-1] and insert
-        # it into the second container list (in the same respective
-        # column).  We shift container list 1's respective columnar
-        # list by [hit:], then continue on.  We do this for EACH
-        # columnar list in container list 1. (In the event that we're
-        # just starting out and have misses at the head of the column,
-        # instead of interpolating/extrapolating between hits, we just
-        # back-extrapolate and shift as expected)
-        # After this operation, we shift our attention to container
-        # list 2.  If there is data in each column (i.e. len(col) > 0
-        # for each column), we yield a new list containing:
-        # [col0[0], col1[0], col2[0],...,coln[0]] and shift each
-        # column down by 1 (i.e.: [1, 2, 3] becomes [2, 3])
-        # That's right, this is a generator.  Booya.
-
-        work_list = []
-        yield_list = []
-
-        for line in data_file:
-
-            # Strip the line and break it down into it's component
-            # channels, replace all blank entries with None
-            channels = [None if x == '' else float(x) for x in line.strip().split(',')]
-            #print channels
-
-            # Now, if this is the first entry (characterized by
-            # work_list being an empty list), we need to create all of
-            # our 'plinko slots' for each channel in both the work and
-            # yield lists
-            if len(work_list) == 0:
-                work_list = [[] for x in channels]
-                yield_list = [[] for x in channels]
-
-            # Down to business, first, we stuff each channel's sample
-            # into the work list
-            for c in range(len(channels)):
-                work_list[c].append(channels[c])
-
-            # At this point, we need to walk through each channel
-            # column in the work list.  If the length of the column is
-            # 1, we simply move onto the next column.  If the length
-            # is > 1, we check if column[-1] is a miss (None) or a
-            # hit(anything else).  If it is a hit, we
-            # interpolate/extrapolate the column, then move everything
-            # EXCEPT the last item into the yield list
-
-            # TODO: See about moving this part into the above loop to
-            # reduce algorithmic complexity
-            for c in range(len(work_list)):
-                if len(work_list[c]) == 1:
-                    continue
-
-                # If we have a hit at the end of the list, get the
-                # extraploated/interpolated list of datapoints
-                if not work_list[c][-1] == None:
-                    mod_list = self._extrap_datapoints(work_list[c])
-
-                    #Now copy everything but the last point in the
-                    #modified list into the yield_list
-                    yield_list[c].extend(mod_list[:-1])
-
-                    #And remove everything BUT the last datapoint from
-                    #the current list in work_list
-                    work_list[c] = work_list[c][-1:]
-
-
-            # Ok, we now have THINGS in our yield list, if we have
-            # something in EVERY column of the yield list, create a
-            # new list containing the first item in every column,
-            # shift all columns down one, and yield the new list
-            if not 0 in [len(x) for x in yield_list]:
-                ds_to_yield = [x[0] for x in yield_list]
-                map(lambda x: x.pop(0), yield_list)
-                yield ds_to_yield
-
-        #TODO: Finish off by extrapolating out the rest of the columns
-        #and yielding them
+        This function yields blocks of records that have been extrapolated
+        from the parent dataset, see _desparsify_blocks
+        """
+        return _desparsify_blocks(data_file, last=last, logged=logged)
 
     def _create_session(self, name, notes=''):
         """
@@ -511,60 +1810,437 @@ class DataStore(object):
         """
 
         current_time = unix_time(datetime.datetime.now())
-        self._conn.execute("""INSERT INTO session
+        c = self._conn.cursor()
+        c.execute("""INSERT INTO session
         (name, notes, date)
         VALUES (?, ?, ?)""", (name, notes, current_time))
 
         self._conn.commit()
-        ses_id = self._get_last_table_id('session')
+        #Another connection may have created a session since
+        ses_id = c.lastrowid
 
         print "Created session with ID: ", ses_id
         return ses_id
 
-    def _handle_data(self, data_file, headers, session_id):
+    def _get_sidecar_path(self, session_id):
+        """
+        Returns where the sidecar of a session lives, next to the database,
+        or None for an in memory database
+        """
+        if self.name in (':memory:', ''):
+            return None
+        return '{}.session{}.rcs'.format(os.path.splitext(self.name)[0], session_id)
+
+    def _write_blocks(self, blocks, headers, session_id, block_listener=None, source_path=None,
+                      checkpoint=None, resume_from=None, logged=None):
+        """
+        Writes blocks of desparsified records into a session, with a single
+        prepared statement per block. block_listener, if provided, is called with
+        the number of rows written so far after every block, checkpoint
+        with the last sample id written. If the source_path of the
+        datalog is given and numpy is available a sidecar is written for
+        the session as well.
+
+        resume_from is the first sample id of a session being continued;
+        its rows already in the database are read back first so the
+        stats, laps, pyramid and sidecar cover the whole session.
+        logged, for sparse storage, has the mask of the values logged in
+        each block by the time the block is reached
+        """
+        logged = iter(logged) if logged is not None else itertools.repeat(None)
+        row_count = 0
+        stats = _ChannelStatsBuilder(len(headers))
+        laps = _LapIndexBuilder(headers)
+        pyramid = _PyramidBuilder(len(headers))
+        first_sample_id = resume_from if resume_from is not None else self._next_sample_id(session_id)
+        first_chunk = 0
+
+        sidecar = None
+        sidecar_path = self._get_sidecar_path(session_id)
+        if np is not None and source_path and sidecar_path:
+            sidecar = SidecarWriter(sidecar_path, source_path, headers)
+
+        try:
+            if resume_from is not None:
+                replay_id = resume_from
+                last_id = self._get_session_range(session_id, self._conn)[1]
+                for block in self._read_session_blocks(headers, resume_from, last_id):
+                    if sidecar:
+                        sidecar.add_block(block)
+                    stats.add_block(block, replay_id)
+                    laps.add_block(block, replay_id)
+                    pyramid.add_block(block, replay_id)
+                    replay_id += len(block)
+                c = self._conn.execute("SELECT MAX(chunk) FROM channel_data WHERE session_id=?",
+                                       (session_id,))
+                last_chunk = c.fetchone()[0]
+                first_chunk = last_chunk + 1 if last_chunk is not None else 0
+
+            for chunk, block in enumerate(blocks, first_chunk):
+                sample_id = self._insert_block(block, headers, session_id, chunk, logged=next(logged))
+                if sidecar:
+                    sidecar.add_block(block)
+                stats.add_block(block, sample_id)
+                laps.add_block(block, sample_id)
+                pyramid.add_block(block, sample_id)
+                row_count += len(block)
+
+                if checkpoint:
+                    checkpoint(sample_id + len(block) - 1)
+                if block_listener:
+                    block_listener(row_count)
+
+            channel_ids = self._get_channel_ids([x.name for x in headers])
+            stats.write(self._conn, session_id, channel_ids)
+            laps.write(self._conn, session_id)
+            pyramid.write(self._conn, self._partition_name('channel_pyramid', session_id),
+                          session_id, channel_ids)
+            self._conn.commit()
+            self._data_changed()
+            self._materialize_derived(session_id, [x.name for x in headers])
+        except:
+            if sidecar:
+                sidecar.abort()
+            raise
+
+        if sidecar:
+            sidecar.close(first_sample_id)
+
+        return row_count
+
+    def _handle_data(self, data_file, headers, session_id, progress_listener=None, file_size=0,
+                     source_path=None, datalog_id=None, resume=None):
         """
         takes a raw dataset in the form of a CSV file and inserts the data
         into the sqlite database
+
+        Records arrive in blocks of up to IMPORT_CHUNK_SIZE. If a
+        progress_listener is provided it is called after every block with
+        the percentage of file_size read and the rows/sec rate.
+
+        If datalog_id is given, the file offset reached and the last
+        sample id are checkpointed in datalog_info after every block.
+        resume is (first sample id, last record) of a session being
+        continued, with data_file positioned at its checkpoint
         """
+        #Offsets are counted from the start of the file
+        progress = {'bytes': data_file.tell()}
+
+        def count_bytes(lines):
+            for line in lines:
+                progress['bytes'] += len(line)
+                yield line
 
         #Create the generator for the desparsified data
-        newdata_gen = self._desparsified_data_generator(data_file)
+        logged = [] if self.storage == SPARSE_STORAGE else None
+        newdata_gen = self._desparsified_data_generator(count_bytes(data_file),
+                                                        resume[1] if resume else None, logged)
+
+        start_time = time.time()
+
+        def block_written(row_count):
+            if progress_listener:
+                elapsed = time.time() - start_time
+                rate = row_count / elapsed if elapsed > 0 else 0
+                pct = 100.0 * progress['bytes'] / file_size if file_size else 0
+                progress_listener(min(pct, 100.0), rate)
+
+        checkpoint = None
+        if datalog_id is not None:
+            #A block is yielded as soon as its last line is read, so the
+            #offset reached is where the next block starts
+            def checkpoint(sample_id):
+                self._checkpoint_datalog(datalog_id, progress['bytes'], sample_id)
+
+        return self._write_blocks(newdata_gen, headers, session_id, block_written, source_path,
+                                  checkpoint, resume[0] if resume else None, logged)
+
+    def _discard_session(self, session_id):
+        """
+        Removes a session and everything written for it, used to clean up
+        after an import that failed part way and by delete_session. The
+        session's partitions are dropped whole, and what's left are a few
+        rows per channel, found through indexes that lead with the
+        session; the pages freed are handed back to the file system later
+        by the vacuum scheduler
+        """
+        self._conn.rollback()
+        c = self._conn.cursor()
+        with self._transaction():
+            for table in ['datapoint', 'sample_geo', 'channel_pyramid']:
+                name = self._partition_name(table, session_id)
+                c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name=?", (name,))
+                if c.fetchone()[0]:
+                    self._conn.execute("DROP TABLE {}".format(name))
+
+            for table in ['channel_data', 'channel_stats', 'lap']:
+                self._conn.execute("DELETE FROM {} WHERE session_id=?".format(table), (session_id,))
+            self._conn.execute("DELETE FROM session WHERE id=?", (session_id,))
+            self._conn.execute("DELETE FROM datalog_info WHERE session_id=?", (session_id,))
+        self._data_changed()
+        self.schedule_vacuum()
+
+        sidecar_path = self._get_sidecar_path(session_id)
+        if sidecar_path and os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+
+    def delete_session(self, session_id):
+        """
+        Deletes a session and everything stored for it. Its tables are
+        dropped whole, so this takes about as long however long the
+        session was; the space it took is released in the background
+        afterwards, see schedule_vacuum
+        """
+        c = self._conn.cursor()
+        c.execute("SELECT COUNT(*) FROM session WHERE id=?", (session_id,))
+        if not c.fetchone()[0]:
+            raise Exception("Unknown session: {}".format(session_id))
+        self._discard_session(session_id)
 
-        for record in newdata_gen:
-            self._insert_record(record, headers, session_id)
-            #print record
+    def list_sessions(self):
+        """
+        Returns a SessionInfo for every session, in session order
+        """
+        ranges = dict((x[0], x[1:]) for x in self._get_session_ranges())
+        c = self._get_reader().cursor()
+        c.execute("SELECT id, name, notes, date FROM session ORDER BY id")
+        sessions = []
+        for session_id, name, notes, date in c.fetchall():
+            first_id, last_id = ranges.get(session_id, (None, None))
+            samples = last_id - first_id + 1 if first_id is not None else 0
+            sessions.append(SessionInfo(session_id, name, notes, date, samples,
+                                        self._get_session_bytes(session_id, samples)))
+        return sessions
+
+    def _get_session_bytes(self, session_id, samples):
+        """
+        Returns the bytes a session's channel data and position index take:
+        the pages of its partitions, as sqlite's dbstat table counts them,
+        plus its channel_data arrays for columnar storage
+        """
+        c = self._get_reader().cursor()
+        size = 0
+        if self._columnar:
+            c.execute("""SELECT SUM(LENGTH(data) + IFNULL(LENGTH(offsets), 0)) FROM channel_data
+            WHERE session_id=?""", (session_id,))
+            size = c.fetchone()[0] or 0
+
+        #The datapoint and channel_pyramid partitions and their indexes,
+        #and the tables the R*Tree module keeps the sample_geo partition in
+        c.execute("SELECT name FROM sqlite_master WHERE tbl_name IN (?, ?) OR tbl_name GLOB ?",
+                  (self._partition_name('datapoint', session_id),
+                   self._partition_name('channel_pyramid', session_id),
+                   self._partition_name('sample_geo', session_id) + '_*'))
+        names = [x[0] for x in c.fetchall()]
+        try:
+            for name in names:
+                c.execute("SELECT SUM(pgsize) FROM dbstat WHERE name=? AND aggregate=1", (name,))
+                size += c.fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            #No dbstat in this sqlite, make do with 8 bytes a value
+            if not self._columnar:
+                size = samples * (len(self._channels) + 3) * 8
+        return size
+
+    def schedule_vacuum(self):
+        """
+        Has the free pages of the database file, left by deleted sessions,
+        released in the background; returns right away. Nothing to do
+        for an in memory database
+        """
+        if self._vacuum is not None:
+            self._vacuum.request()
+
+    def wait_for_vacuum(self, timeout=None):
+        """
+        Waits for scheduled vacuuming to finish, returns whether it did
+        """
+        return self._vacuum.wait(timeout) if self._vacuum is not None else True
 
+    def add_derived_channel(self, name, expression, units=''):
+        """
+        Adds a channel computed from an expression over other channels,
+        see derived.py. It is stored like a logged channel, for every
+        session already in the datastore and every one imported or
+        recorded later, so it can be queried, filtered on and smoothed
+        like any other
+
+        :param name: name of the new channel
+        :param expression: e.g. 'RPM / Speed' or 'AccelX^2 + AccelY^2'
+        :param units: units of the new channel
+        """
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+            raise Exception("Invalid channel name: {}".format(name))
+        if name in [x.name for x in self._channels]:
+            raise Exception("Channel already exists: {}".format(name))
+
+        derived = compile_expression(expression)
+        known_channels = dict((x.name, x) for x in self._channels)
+        for channel in derived.channels:
+            if not channel in known_channels:
+                raise Exception("Unknown channel in expression: {}".format(channel))
+
+        #As fast as the fastest channel it is computed from
+        sample_rate = max([known_channels[x].sample_rate for x in derived.channels] + [0])
+        self._register_channels([DatalogChannel(name, units, sample_rate)])
+        self._conn.execute("UPDATE channel SET expression=? WHERE name=?", (expression, name))
         self._conn.commit()
+        self._derived[name] = expression
 
-    def get_channel_max(self, channel):
         c = self._conn.cursor()
+        c.execute("SELECT id FROM session ORDER BY id")
+        for session_id in [x[0] for x in c.fetchall()]:
+            self._materialize_derived(session_id, names=[name])
+        self._statement_cache.clear()
 
-        base_sql = "SELECT {} from datapoint ORDER BY {} DESC LIMIT 1;".format(channel, channel)
-        c.execute(base_sql)
+    def _materialize_derived(self, session_id, logged=[], names=None):
+        """
+        Computes and stores the derived channels (all, or those in names)
+        for a session. Channels the session logged itself are left alone.
+        Anything stored for them before is replaced, so a session can be
+        materialized again after a resumed import
+        """
+        derived = [x.name for x in self._channels if x.name in self._derived and
+                   not x.name in logged and (names is None or x.name in names)]
+        if not derived:
+            return
+
+        first_id, last_id = self._get_session_range(session_id, self._conn)
+        if first_id is None:
+            return
+
+        known_channels = dict((x.name, x) for x in self._channels)
+        for name in derived:
+            expression = compile_expression(self._derived[name])
+            channel_id = self._get_channel_ids([name])[0]
+            for table in ['channel_data', 'channel_stats']:
+                self._conn.execute("DELETE FROM {} WHERE session_id=? AND channel_id=?".format(table),
+                                   (session_id, channel_id))
+            self._conn.execute("DELETE FROM {} WHERE channel_id=?".format(
+                self._partition_name('channel_pyramid', session_id)), (channel_id,))
+
+            stats = _ChannelStatsBuilder(1)
+            pyramid = _PyramidBuilder(1)
+            headers = [known_channels[x] for x in expression.channels]
+            sample_id = first_id
+            for chunk, values in enumerate(self._evaluate_blocks(expression, headers, first_id, last_id)):
+                if self._columnar:
+                    self._conn.execute("""INSERT INTO channel_data
+                    (session_id, channel_id, chunk, first_sample_id, count, min, max, data, offsets)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (session_id, channel_id, chunk, sample_id, len(values)) +
+                    _value_bounds(values) + self._pack_column(values))
+                else:
+                    stored = np.where(np.isnan(values), None, values).tolist() if np is not None else values
+                    self._conn.executemany("UPDATE {} SET {}=? WHERE sample_id=?".format(
+                        self._partition_name('datapoint', session_id), name),
+                                           zip(stored, range(sample_id, sample_id + len(values))))
+
+                column = values.reshape(-1, 1) if np is not None else [[x] for x in values]
+                stats.add_block(column, sample_id)
+                pyramid.add_block(column, sample_id)
+                sample_id += len(values)
+
+            stats.write(self._conn, session_id, [channel_id])
+            pyramid.write(self._conn, self._partition_name('channel_pyramid', session_id),
+                          session_id, [channel_id])
+            self._conn.commit()
+        self._data_changed()
+
+    def _evaluate_blocks(self, expression, headers, first_sample_id, last_sample_id):
+        """
+        Evaluates a compiled expression over the samples between the first
+        and last sample id, yielding the results a block at a time
+        """
+        if not headers:
+            #Nothing to read, just a constant
+            for start in range(first_sample_id, last_sample_id + 1, IMPORT_CHUNK_SIZE):
+                count = min(IMPORT_CHUNK_SIZE, last_sample_id + 1 - start)
+                yield expression.evaluate({'': np.zeros(count) if np is not None else [0.0] * count})
+            return
+
+        names = [x.name for x in headers]
+        for block in self._read_session_blocks(headers, first_sample_id, last_sample_id):
+            if np is not None:
+                columns = dict((x, block[:, i]) for i, x in enumerate(names))
+            else:
+                columns = dict((x, [r[i] for r in block]) for i, x in enumerate(names))
+            yield expression.evaluate(columns)
+
+    def evaluate_expression(self, expression, session=None):
+        """
+        Evaluates an expression (see derived.py) over the raw, unsmoothed
+        channels of a session, or of all sessions one after the other.
+        Returns a float64 array (a list without numpy) with a value per
+        sample, NaN (None) where it is undefined. Results are cached per
+        session and expression until the datastore changes; the array
+        returned is shared and read only
+        """
+        key = (session, expression)
+        self._check_data_version()
+        result = self._derived_cache.get(key)
+        if result is not None:
+            return result if np is not None else list(result)
+
+        derived = compile_expression(expression)
+        known_channels = dict((x.name, x) for x in self._channels)
+        for channel in derived.channels:
+            if not channel in known_channels:
+                raise Exception("Unknown channel in expression: {}".format(channel))
+        headers = [known_channels[x] for x in derived.channels]
+
+        ranges = [x[1:] for x in self._get_session_ranges(session)]
+
+        parts = []
+        for first_id, last_id in ranges:
+            parts.extend(self._evaluate_blocks(derived, headers, first_id, last_id))
+
+        if np is not None:
+            result = np.concatenate(parts) if parts else np.empty(0)
+            result.flags.writeable = False
+        else:
+            result = [x for part in parts for x in part]
+        self._derived_cache.put(key, result)
+        return result if np is not None else list(result)
 
-        res = c.fetchone()
+    def get_channel_stats(self, channel, session=None):
+        """
+        Returns the ChannelStats for a channel, computed at import time.
+        Stats cover the specified session id, or all sessions if None
+        """
+        if not channel in [x.name for x in self._channels]:
+            raise Exception("Unknown channel: {}".format(channel))
 
-        if res == None:
-            chan_max = None
-        else:
-            chan_max = res[0]
-        return chan_max
+        base_sql = """SELECT count, min, max, mean, stddev, first_sample_id, last_sample_id
+        FROM channel_stats JOIN channel ON channel_stats.channel_id=channel.id
+        WHERE channel.name=?"""
+        params = [channel]
+        if session is not None:
+            base_sql += " AND channel_stats.session_id=?"
+            params.append(session)
 
-    def get_channel_min(self, channel):
-        c = self._conn.cursor()
+        c = self._get_reader().cursor()
+        c.execute(base_sql, params)
 
-        base_sql = "SELECT {} from datapoint ORDER BY {} ASC LIMIT 1;".format(channel, channel)
-        c.execute(base_sql)
+        merged = (0, None, None, None, None, None, None)
+        for count, min_val, max_val, mean, stddev, first_id, last_id in c.fetchall():
+            m2 = stddev * stddev * count if count else None
+            merged = _merge_stats(merged, (count, min_val, max_val, mean, m2, first_id, last_id))
 
-        res = c.fetchone()
+        count, min_val, max_val, mean, m2, first_id, last_id = merged
+        stddev = math.sqrt(m2 / count) if count else None
+        return ChannelStats(count, min_val, max_val, mean, stddev, first_id, last_id)
 
-        if res == None:
-            chan_min = None
-        else:
-            chan_min = res[0]
-        return chan_min
+    def get_channel_max(self, channel, session=None):
+        return self.get_channel_stats(channel, session).max
 
-    def set_channel_smoothing(self, channel, smoothing):
+    def get_channel_min(self, channel, session=None):
+        return self.get_channel_stats(channel, session).min
+
+    def get_channel_average(self, channel, session=None):
+        return self.get_channel_stats(channel, session).mean
+
+    def set_channel_smoothing(self, channel, smoothing, kernel=None):
         """
         Sets the smoothing rate on a per channel basis, this will be reflected in the returned dataset
 
@@ -573,6 +2249,10 @@ class DataStore(object):
          0* 1  2  3  4*
         [1, x, x, x, 5], which would then be interpolated as:
         [1, 2, 3, 4, 5]
+
+        That is the default INTERP_KERNEL, kernel selects one of the other
+        smoothing.KERNELS, for which the rate is the window size in samples.
+        If kernel is None the channel keeps its current kernel
         """
         if smoothing < 1:
             smoothing = 1
@@ -580,16 +2260,28 @@ class DataStore(object):
         if not channel in [x.name for x in self._channels]:
             raise Exception("Unknown channel: {}".format(channel))
 
+        if kernel is not None and not kernel in KERNELS:
+            raise Exception("Unknown smoothing kernel: {}".format(kernel))
+
         self._conn.execute("""UPDATE channel
-        SET smoothing={}
-        WHERE name='{}'
-        """.format(smoothing, channel))
+        SET smoothing=?
+        WHERE name=?""", (smoothing, channel))
+
+        if kernel is not None:
+            self._conn.execute("""UPDATE channel
+            SET smoothing_kernel=?
+            WHERE name=?""", (kernel, channel))
+
+        #Committed right away, queries read through other connections
+        self._conn.commit()
+        self._channel_meta_cache.clear()
+        self._result_cache.clear()
 
     def get_channel_smoothing(self, channel):
         if not channel in [x.name for x in self._channels]:
             raise Exception("Unknown channel: {}".format(channel))
 
-        c = self._conn.cursor()
+        c = self._get_reader().cursor()
 
         
         base_sql = "SELECT smoothing from channel WHERE channel.name='{}';".format(channel)
@@ -602,68 +2294,1126 @@ class DataStore(object):
         else:
             return res[0]
 
+    def get_channel_smoothing_kernel(self, channel):
+        if not channel in [x.name for x in self._channels]:
+            raise Exception("Unknown channel: {}".format(channel))
+
+        c = self._get_reader().cursor()
+        c.execute("SELECT smoothing_kernel from channel WHERE channel.name=?", (channel,))
+        res = c.fetchone()
+
+        if res == None:
+            raise Exception("Unable to retrieve smoothing kernel for channel: {}".format(channel))
+        else:
+            return str(res[0])
+
+    def _find_datalog(self, fingerprint):
+        """
+        Returns (id, session_id, checkpoint_offset, checkpoint_sample_id,
+        complete) of the import of the file with this fingerprint, or None
+        """
+        c = self._conn.cursor()
+        c.execute("""SELECT id, session_id, checkpoint_offset, checkpoint_sample_id, complete
+        FROM datalog_info WHERE fingerprint=?""", (fingerprint,))
+        return c.fetchone()
+
+    def _create_datalog_info(self, fingerprint, session_id, headers, name, notes):
+        max_sample_rate = max([x.sample_rate for x in headers] + [0])
+        c = self._conn.cursor()
+        c.execute("""INSERT INTO datalog_info
+        (max_sample_rate, time_offset, name, notes, fingerprint, session_id)
+        VALUES (?, ?, ?, ?, ?, ?)""", (max_sample_rate, 0, name, notes, fingerprint, session_id))
+        self._conn.commit()
+        return c.lastrowid
+
+    def _checkpoint_datalog(self, datalog_id, offset, sample_id, complete=False):
+        self._conn.execute("""UPDATE datalog_info
+        SET checkpoint_offset=?, checkpoint_sample_id=?, complete=?
+        WHERE id=?""", (offset, sample_id, 1 if complete else 0, datalog_id))
+        self._conn.commit()
+
+    def _read_session_blocks(self, headers, first_sample_id, last_sample_id):
+        """
+        Reads stored records of a session back as blocks, with the columns
+        in the order of the datalog headers
+        """
+        names = [x.name for x in headers]
+        session_id = self._get_sample_session(first_sample_id)
+        if self._columnar:
+            for start in range(first_sample_id, last_sample_id + 1, IMPORT_CHUNK_SIZE):
+                end = min(start + IMPORT_CHUNK_SIZE - 1, last_sample_id)
+                columns = self._read_channel_columns(names, (start, end), session_id)
+                yield np.column_stack([columns[x] for x in names])
+            return
+
+        c = self._conn.cursor()
+        table = self._partition_name('datapoint', session_id)
+        c.execute("""SELECT {} FROM {} WHERE sample_id BETWEEN ? AND ?
+        ORDER BY sample_id""".format(', '.join(names), table), (first_sample_id, last_sample_id))
+        while True:
+            rows = c.fetchmany(IMPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield np.array(rows, dtype=np.float64) if np is not None else [list(x) for x in rows]
+
+    def _prepare_resume(self, datalog, headers):
+        """
+        Gets an interrupted import ready to continue from its checkpoint.
+        Returns (first sample id, last record) of the session, or None if
+        it has to start over as nothing was checkpointed. Samples written
+        to other sessions since don't matter, the session continues in
+        its own block of sample ids
+        """
+        datalog_id, session_id, offset, last_id, complete = datalog
+
+        #Rows written after the last checkpoint are written again, and the
+        #session aggregates are rebuilt once the import completes
+        c = self._conn.cursor()
+        for table in ['datapoint', 'sample_geo', 'channel_pyramid']:
+            name = self._partition_name(table, session_id)
+            c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name=?", (name,))
+            if c.fetchone()[0]:
+                if table == 'channel_pyramid':
+                    self._conn.execute("DELETE FROM {}".format(name))
+                    continue
+                column = 'sample_id' if table == 'datapoint' else 'id'
+                self._conn.execute("DELETE FROM {} WHERE {}>?".format(name, column), (last_id,))
+        if last_id is not None:
+            self._conn.execute("UPDATE session SET last_sample_id=? WHERE id=?", (last_id, session_id))
+        self._conn.execute("DELETE FROM channel_data WHERE session_id=? AND first_sample_id>?",
+                           (session_id, last_id))
+        self._conn.execute("DELETE FROM channel_stats WHERE session_id=?", (session_id,))
+        self._conn.execute("DELETE FROM lap WHERE session_id=?", (session_id,))
+        self._conn.commit()
+
+        if last_id is None:
+            self._discard_session(session_id)
+            return None
+
+        first_id = self._get_session_range(session_id, self._conn)[0]
+        last_record = list(self._read_session_blocks(headers, last_id, last_id))[0][0]
+        return first_id, last_record
+
     @timing
     def import_datalog(self, path, name, notes='', progress_listener=None):
+        """
+        Imports a RaceCapture CSV datalog into a new session
+
+        Files are recognized by a hash of their contents: importing a file
+        that was imported before returns its existing session, and an
+        import that was interrupted continues from its last checkpoint
+
+        :param path: path to the datalog file
+        :param name: name of the new session
+        :param notes: optional notes for the session
+        :param progress_listener: optional callback receiving
+        (percent_complete, rows_per_sec) as the import progresses
+        :returns: the id of the session
+        """
         try:
+            fingerprint = _fingerprint(path)
             dl = open(path, 'rb')
         except:
             raise Exception("Unable to open file")
 
-        header = dl.readline()
-
+        with dl:
+            datalog = self._find_datalog(fingerprint)
+            if datalog and datalog[4]:
+                logging.info("Datalog {} already imported as session {}".format(path, datalog[1]))
+                return datalog[1]
+
+            header = dl.readline()
+
+            headers = self._parse_datalog_headers(header)
+
+            resume = self._prepare_resume(datalog, headers) if datalog else None
+            if resume:
+                datalog_id, ses_id = datalog[:2]
+                dl.seek(datalog[2])
+            else:
+                #Create an event to be tagged to these records
+                ses_id = self._create_session(name, notes)
+                datalog_id = self._create_datalog_info(fingerprint, ses_id, headers, name, notes)
+
+            file_size = os.path.getsize(path)
+            try:
+                self._handle_data(dl, headers, ses_id, progress_listener, file_size, path,
+                                  datalog_id, resume)
+            except Exception:
+                self._discard_session(ses_id)
+                raise
+
+            self._checkpoint_datalog(datalog_id, file_size, self._get_session_range(ses_id, self._conn)[1],
+                                     True)
+            return ses_id
+
+    def _import_parsed_datalog(self, path, name, notes, header, blocks, logged, fingerprint,
+                               progress_listener):
         headers = self._parse_datalog_headers(header)
-
-        #Create an event to be tagged to these records
         ses_id = self._create_session(name, notes)
+        datalog_id = self._create_datalog_info(fingerprint, ses_id, headers, name, notes)
+        start_time = time.time()
+
+        def block_written(row_count):
+            if progress_listener:
+                elapsed = time.time() - start_time
+                rate = row_count / elapsed if elapsed > 0 else 0
+                progress_listener(path, 100.0 * row_count / total_rows, rate)
+
+        total_rows = max(sum(len(x) for x in blocks), 1)
+        try:
+            self._write_blocks(blocks, headers, ses_id, block_written, path, logged=logged)
+        except:
+            self._discard_session(ses_id)
+            raise
+
+        self._checkpoint_datalog(datalog_id, os.path.getsize(path),
+                                 self._get_session_range(ses_id, self._conn)[1], True)
+        return ses_id
+
+    def import_datalogs(self, paths, names=None, notes='', progress_listener=None, processes=None):
+        """
+        Imports several datalogs, each into its own session. The files are
+        read and desparsified in parallel by a pool of processes while this
+        DataStore writes the results, one file at a time, as they arrive.
+        The pool only reads ahead a file per process, so memory use
+        doesn't grow with the number of files. Without a pool, where
+        processes can't be started, the files are read one at a time.
+        A file that fails to import does not affect the others, one that
+        was imported before gets its existing session
+
+        :param paths: paths of the datalog files
+        :param names: session names, the file names by default
+        :param notes: optional notes for the sessions
+        :param progress_listener: optional callback receiving
+        (path, percent_complete, rows_per_sec) as each file is written
+        :param processes: size of the process pool, one per CPU by default
+        :returns: a DatalogImportResult per path, in the same order
+        """
+        if names is None:
+            names = [os.path.splitext(os.path.basename(x))[0] for x in paths]
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        results = [DatalogImportResult(x) for x in paths]
+
+        pool = None
+        if processes > 1 and len(paths) > 1:
+            pool_size = min(processes, len(paths))
+            try:
+                pool = multiprocessing.Pool(pool_size)
+            except Exception as e:
+                #Some sandboxes and frozen builds can't start processes
+                logging.warn("DataStore: no process pool, importing one file at a time: {}".format(e))
+
+        keep_logged = self.storage == SPARSE_STORAGE
+        jobs = [(index, path, keep_logged) for index, path in enumerate(paths)]
+        in_flight = None
+        if pool:
+            #A whole parsed file comes back from a worker, so only a file
+            #per process plus the one being written are held at a time
+            in_flight = _InFlightLimit(jobs, pool_size + 1)
+            parsed = pool.imap_unordered(_read_datalog, in_flight)
+        else:
+            parsed = itertools.imap(_read_datalog, jobs)
+
+        try:
+            for index, header, blocks, logged, fingerprint, error in parsed:
+                result = results[index]
+                try:
+                    if error:
+                        result.error = Exception(error)
+                        continue
+                    datalog = self._find_datalog(fingerprint)
+                    if datalog and datalog[4]:
+                        result.session_id = datalog[1]
+                    elif datalog:
+                        #Continuing an interrupted import works from the file
+                        result.session_id = self.import_datalog(paths[index], names[index], notes)
+                    else:
+                        result.session_id = self._import_parsed_datalog(paths[index], names[index], notes,
+                                                                        header, blocks, logged, fingerprint,
+                                                                        progress_listener)
+                except Exception as e:
+                    result.error = e
+                finally:
+                    #Let go of the parsed file before waiting for the next
+                    blocks = logged = None
+                    if in_flight:
+                        in_flight.done()
+        finally:
+            if pool:
+                #Every result has been read unless the import failed, and
+                #then a job left unfinished would keep close() and join()
+                #waiting, so the workers are stopped either way
+                in_flight.stop()
+                pool.terminate()
+                pool.join()
+
+        return results
+
+    def _read_area_columns(self, channels, area, sample_range=None):
+        """
+        Reads channels out of columnar storage for the samples the
+        sample_geo index places in area (min_lat, max_lat, min_lon,
+        max_lon), within sample_range if specified. Returns a dict of
+        float64 arrays, one value per sample found
+        """
+        c = self._get_reader().cursor()
+        sql = """SELECT id FROM {}
+        WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?"""
+        params = list(area)
+        if sample_range is not None:
+            sql += ' AND id BETWEEN ? AND ?'
+            params += list(sample_range)
+        parts = []
+        for session_id in self._get_partitions('sample_geo'):
+            c.execute(sql.format(self._partition_name('sample_geo', session_id)) + ' ORDER BY id', params)
+            ids = np.array([x[0] for x in c.fetchall()], dtype=np.int64)
+
+            #Passes through an area are runs of consecutive samples, each
+            #is read on its own
+            breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+            runs = np.split(ids, breaks) if len(ids) else []
+            parts += [self._read_session_columns(channels, session_id, int(run[0]), int(run[-1]))
+                      for run in runs]
+        return dict((x, np.concatenate([part[x] for part in parts]) if parts else np.empty(0))
+                    for x in channels)
+
+    def _read_channel_columns(self, channels, sample_range=None, session=None):
+        """
+        Reads channels out of columnar storage, returns a dict of float64
+        arrays with a value per sample, in sample order. Only the chunks
+        belonging to the requested channels, to the session if specified,
+        and overlapping sample_range (first and last sample id, inclusive)
+        if specified, are read
+        """
+        if session is None and sample_range is not None and \
+                self._get_sample_session(sample_range[0]) == self._get_sample_session(sample_range[1]):
+            session = self._get_sample_session(sample_range[0])
+        if session is not None:
+            ranges = [(session,) + tuple(self._get_session_range(session))]
+        else:
+            ranges = self._get_session_ranges()
+
+        #Each session is a run of sample ids of its own, the ids between
+        #them are never used
+        parts = []
+        for session_id, first_id, last_id in ranges:
+            if sample_range is not None and first_id is not None:
+                first_id, last_id = max(first_id, sample_range[0]), min(last_id, sample_range[1])
+            if first_id is not None and first_id <= last_id:
+                parts.append(self._read_session_columns(channels, session_id, first_id, last_id))
+        if len(parts) == 1:
+            return parts[0]
+        return dict((ch, np.concatenate([x[ch] for x in parts]) if parts else np.empty(0))
+                    for ch in channels)
+
+    def _read_time_window_columns(self, channels, time_range, sample_range=None, session=None):
+        """
+        Reads channels out of columnar storage for the samples a time
+        window (first and last ts) can match, within sample_range if
+        specified. ts only moves forward through a session, so the chunks
+        of ts whose bounds overlap the window are a single run; only the
+        chunks of the channels over that run are read
+        """
+        c = self._get_reader().cursor()
+        ts_id = self._get_channel_ids(['ts'], c.connection)[0]
+        if session is not None:
+            ranges = [(session,) + tuple(self._get_session_range(session))]
+        else:
+            ranges = self._get_session_ranges()
+        parts = []
+        for session_id, first_id, last_id in ranges:
+            if first_id is None:
+                continue
+            c.execute("""SELECT MIN(first_sample_id), MAX(first_sample_id + count - 1) FROM channel_data
+            WHERE session_id=? AND channel_id=? AND max >= ? AND min <= ?""",
+                      (session_id, ts_id, time_range[0], time_range[1]))
+            window_first, window_last = c.fetchone()
+            if window_first is None:
+                continue
+            first_id, last_id = max(first_id, window_first), min(last_id, window_last)
+            if sample_range is not None:
+                first_id, last_id = max(first_id, sample_range[0]), min(last_id, sample_range[1])
+            if first_id <= last_id:
+                parts.append(self._read_session_columns(channels, session_id, first_id, last_id))
+        return dict((ch, np.concatenate([x[ch] for x in parts]) if parts else np.empty(0))
+                    for ch in channels)
+
+    def _read_session_columns(self, channels, session_id, min_id, max_id):
+        """
+        Reads channels out of columnar storage for the samples of a session
+        from min_id to max_id, inclusive
+        """
+        c = self._get_reader().cursor()
+        sample_count = max_id - min_id + 1
+
+        columns = {}
+        for channel, channel_id in zip(channels, self._get_channel_ids(channels, c.connection)):
+            column = np.empty(max(sample_count, 0))
+            #Samples from sessions that didn't log this channel are blank
+            column.fill(np.nan)
+            c.execute("""SELECT first_sample_id, count, data, offsets FROM channel_data
+            WHERE channel_id=? AND session_id=? AND first_sample_id <= ? AND first_sample_id + count > ?
+            ORDER BY chunk""", (channel_id, session_id, max_id, min_id))
+            for first_sample_id, count, data, offsets in c:
+                _check_interrupt(self._get_interrupt_check())
+                self._columnar_bytes_read += len(data)
+                if self.storage == COMPRESSED_STORAGE:
+                    values = codec.decode(data)
+                else:
+                    values = np.frombuffer(data, dtype='<f8')
+                if offsets is not None:
+                    #Carry the sparse values forward to every sample
+                    self._columnar_bytes_read += len(offsets)
+                    offsets = np.frombuffer(offsets, dtype='<u{}'.format(len(offsets) // len(values)))
+                    values = np.repeat(values, np.diff(np.append(offsets, count)))
+                #Clip the chunk to the range we are after
+                skip = max(min_id - first_sample_id, 0)
+                values = values[skip:max_id - first_sample_id + 1]
+                start = first_sample_id + skip - min_id
+                column[start:start + len(values)] = values
+            columns[channel] = column
+
+        return columns
+
+    def _query_columnar(self, channels, data_filter, sample_range=None, time_range=None,
+                        area=None, near=None, session=None):
+        filter_channels = data_filter.channels if data_filter else []
+        if time_range is not None:
+            filter_channels = filter_channels + ['ts']
+        if area is not None:
+            filter_channels = filter_channels + [LATITUDE_CHANNEL, LONGITUDE_CHANNEL]
+        read_channels = channels + [x for x in filter_channels if not x in channels]
+        if area is not None:
+            columns = self._read_area_columns(read_channels, area, sample_range)
+        elif time_range is not None:
+            columns = self._read_time_window_columns(read_channels, time_range, sample_range, session)
+        else:
+            columns = self._read_channel_columns(read_channels, sample_range, session)
+
+        selected = [columns[ch] for ch in channels]
+        mask = None
+        if data_filter:
+            mask = data_filter._evaluate(columns)
+        if time_range is not None:
+            ts = columns['ts']
+            in_range = (ts >= time_range[0]) & (ts <= time_range[1])
+            mask = in_range if mask is None else mask & in_range
+        if area is not None:
+            lats = columns[LATITUDE_CHANNEL]
+            lons = columns[LONGITUDE_CHANNEL]
+            in_area = (lats >= area[0]) & (lats <= area[1]) & (lons >= area[2]) & (lons <= area[3])
+            if near is not None:
+                in_area &= _distance_m_array(lats, lons, near[0], near[1]) <= near[2]
+            mask = in_area if mask is None else mask & in_area
+        if mask is not None:
+            selected = [x[mask] for x in selected]
+
+        return _ColumnCursor(channels, selected)
+
+    def _from_partition(self, table):
+        """
+        Returns what to select FROM for a session's partition of table,
+        under the name of the table. The session is left to
+        _bind_partition
+        """
+        return '{}_{} AS {}'.format(table, PARTITION_TOKEN, table)
 
-        self._handle_data(dl, headers, ses_id)
+    def _bind_partition(self, sql, partition):
+        """
+        Returns statement text built over _from_partition, reading the
+        partitions of session partition, or the empty template tables if
+        None
+        """
+        return sql.replace(PARTITION_TOKEN, str(int(partition)) if partition is not None else 'template')
 
-    def query(self, channels=[], data_filter=None):
+    def _build_select(self, channels, data_filter, sample_range=False, session=False,
+                      time_range=False, area=False, near=False):
+        """
+        Builds the SELECT statement text for the channels, over the
+        partitions of a session, see _bind_partition, with the
+        filter compiled to bound parameters. The first and last sample id (if
+        sample_range is set), the session id (if session is set), the
+        first and last ts (if time_range is set), the box min_lat,
+        max_lat, min_lon, max_lon twice over (if area is set) and the
+        latitude, longitude and radius in meters (if near is set) are
+        bound ahead of the filter parameters, in that order
+        """
         #Build our select statement
         sel_st  = 'SELECT '
 
         columns = []
-        joins = []
-
-        #If there are no channels, or if a '*' is passed, select all
-        #of the channels
-        if len(channels) == 0 or '*' in channels:
-            channels = [x.chan_name for x in self._channels]
-
         for ch in channels:
-            if not ch in [x.name for x in self._channels]:
-                raise Exception("Unable to complete query. Unknown channel: {}".format(ch))
             chanst = str(ch)
             tbl_prefix = 'datapoint.'
             alias = ' as {}'.format(chanst)
             columns.append(tbl_prefix+chanst+alias)
-            joins.append(tbl_prefix+chanst)
 
         #Add the columns to the select statement
         sel_st += ','.join(columns)
 
         #Point out where we're pulling this from
-        sel_st += '\nFROM sample\n'
-
-        #Add our joins
-        sel_st += 'JOIN datapoint ON datapoint.sample_id=sample.id\n'
+        sel_st += '\nFROM {}\n'.format(self._from_partition('datapoint'))
+
+        conditions = []
+        if sample_range:
+            conditions.append('datapoint.sample_id BETWEEN ? AND ?')
+        if session:
+            conditions.append('datapoint.session_id = ?')
+        if time_range:
+            conditions.append('datapoint.ts BETWEEN ? AND ?')
+        if area:
+            #The R*Tree narrows things down to the samples in the box, its
+            #coordinates are rounded outwards so the box is checked again
+            conditions.append("""datapoint.sample_id IN (SELECT id FROM {}
+            WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?)""".format(
+                self._from_partition('sample_geo')))
+            conditions.append('datapoint.{} BETWEEN ? AND ? AND datapoint.{} BETWEEN ? AND ?'.format(
+                LATITUDE_CHANNEL, LONGITUDE_CHANNEL))
+        if near:
+            conditions.append('rc_distance(datapoint.{}, datapoint.{}, ?, ?) <= ?'.format(
+                LATITUDE_CHANNEL, LONGITUDE_CHANNEL))
 
         #Add our filter
-        sel_st += 'WHERE '
+        if not data_filter == None:
+            conditions.append('({})'.format(data_filter.compile()[0].strip()))
+
+        if conditions:
+            sel_st += 'WHERE '
+            sel_st += ' AND '.join(conditions)
+            sel_st += '\n'
 
+        sel_st += 'ORDER BY datapoint.id'
+
+        return sel_st
+
+    def _build_histogram_select(self, channel, data_filter, session=False):
+        """
+        Builds the histogram statement for a channel, over the partition
+        of a session, see _bind_partition. The low end of the
+        range, bins / (high - low), the last bin index, low and high, then
+        the session id (if session is set) are bound ahead of the filter
+        parameters
+        """
+        sql = """SELECT MIN(CAST((datapoint.{0} - ?) * ? AS INTEGER), ?) AS bin, COUNT(*)
+        FROM {1}
+        WHERE datapoint.{0} BETWEEN ? AND ?""".format(channel, self._from_partition('datapoint'))
+        if session:
+            sql += ' AND datapoint.session_id = ?'
+        if data_filter:
+            sql += ' AND ({})'.format(data_filter.compile()[0].strip())
+        return sql + '\nGROUP BY bin'
+
+    def _build_aggregate_select(self, channels, group_by, funcs, data_filter, session=False):
+        """
+        Builds the aggregate statement over the partition of a session,
+        see _bind_partition, the group key columns first then
+        one column per channel and function. The time bucket width twice
+        (if grouping by time bucket), then the session id (if session is
+        set) are bound ahead of the filter parameters
+        """
+        selects = ['{}(datapoint.{})'.format(AGGREGATE_FUNCTIONS[func], ch)
+                   for ch in channels for func in funcs]
+        conditions = []
+        if group_by == LAP_GROUPS:
+            keys = ['lap.session_id', 'lap.lap']
+            sql = """SELECT {}
+            FROM lap JOIN {}
+            ON datapoint.sample_id BETWEEN lap.start_sample_id AND lap.end_sample_id"""
+            session_column = 'lap.session_id'
+        else:
+            keys = ['datapoint.session_id']
+            if group_by != SESSION_GROUPS:
+                keys.append('CAST(datapoint.ts / ? AS INTEGER) * ? AS bucket')
+                conditions.append('datapoint.ts IS NOT NULL')
+            sql = 'SELECT {}\nFROM {}'
+            session_column = 'datapoint.session_id'
+        sql = sql.format(', '.join(keys + selects), self._from_partition('datapoint'))
+
+        if session:
+            conditions.append('{} = ?'.format(session_column))
+        if data_filter:
+            conditions.append('({})'.format(data_filter.compile()[0].strip()))
+        if conditions:
+            sql += '\nWHERE ' + ' AND '.join(conditions)
+
+        group_columns = ', '.join(str(i + 1) for i in range(len(keys)))
+        return sql + '\nGROUP BY {0}\nORDER BY {0}'.format(group_columns)
+
+    def _get_smoothing_maps(self, channels):
+        """
+        Returns the smoothing rate and kernel maps for the channels,
+        cached until a channel's smoothing is changed
+        """
+        key = tuple(channels)
+        maps = self._channel_meta_cache.get(key)
+        if maps is None:
+            smoothing_map = {}
+            kernel_map = {}
+            #Put together the smoothing map
+            for ch in channels:
+                sr = self.get_channel_smoothing(ch)
+                smoothing_map[ch] = sr
+                if sr > 1:
+                    kernel_map[ch] = self.get_channel_smoothing_kernel(ch)
+            maps = (smoothing_map, kernel_map)
+            self._channel_meta_cache.put(key, maps)
+
+        return maps
+
+    def get_query_cache_stats(self):
+        """
+        Returns the hit/miss counters of the compiled statement, channel
+        metadata and result caches used by query()
+        """
+        return {'statements': self._statement_cache.stats(),
+                'channel_metadata': self._channel_meta_cache.stats(),
+                'results': self._result_cache.stats()}
+
+    def set_result_cache_size(self, max_bytes):
+        """
+        Sets the memory, in bytes, the results cached by query() may
+        take. 0 turns the result cache off
+        """
+        self._result_cache.max_bytes = max(int(max_bytes), 0)
+        self._result_cache.clear()
+
+    def _cache_result(self, key, generation, columns):
+        """
+        Keeps a fully read query result, unless the data changed while it
+        was being read
+        """
+        if generation != self._data_generation:
+            return
+        channels = columns.keys()
+        size = RESULT_VALUE_BYTES * len(channels) * (len(columns[channels[0]]) if channels else 0)
+        self._result_cache.put(key, columns, size)
+
+    def query(self, channels=[], data_filter=None, start_ms=None, end_ms=None, session=None):
+        """
+        Queries channels, optionally limited to the samples matching
+        data_filter, to a time window of the logged ts channel (start_ms
+        and end_ms inclusive, either may be left open) and to one session
+        """
+        time_range = None
+        if start_ms is not None or end_ms is not None:
+            if not 'ts' in [x.name for x in self._channels]:
+                raise Exception("Time window queries require a ts channel")
+            time_range = (float('-inf') if start_ms is None else start_ms,
+                          float('inf') if end_ms is None else end_ms)
+
+        return self._query(channels, data_filter, session=session, time_range=time_range)
+
+    def query_lap(self, session, lap, channels=[], data_filter=None):
+        """
+        Queries the samples of a single lap of a session, found through
+        the lap index built at import time
+        """
+        c = self._get_reader().cursor()
+        c.execute("""SELECT start_sample_id, end_sample_id FROM lap
+        WHERE session_id=? AND lap=?""", (session, lap))
+        res = c.fetchone()
+        if res == None:
+            raise Exception("Unknown lap {} in session {}".format(lap, session))
+
+        return self._query(channels, data_filter, sample_range=res, session=session)
+
+    def query_near(self, point, radius_m, channels=[], data_filter=None, session=None):
+        """
+        Queries the samples whose GPS position is within radius_m meters of
+        point (a GeoPoint), across all sessions or within one, through the
+        sample_geo R*Tree index built at import time
+        """
+        return self._query_area(_radius_box(point, radius_m), channels, data_filter, session,
+                                (point.latitude, point.longitude, radius_m))
+
+    def query_bbox(self, south_west, north_east, channels=[], data_filter=None, session=None):
+        """
+        Queries the samples whose GPS position is within the box between
+        the south_west and north_east GeoPoints, inclusive, across all
+        sessions or within one
+        """
+        area = (south_west.latitude, north_east.latitude, south_west.longitude, north_east.longitude)
+        return self._query_area(area, channels, data_filter, session)
+
+    def _query_area(self, area, channels, data_filter, session, near=None):
+        if not self._geo_index:
+            raise Exception("Position queries require SQLite R*Tree support")
+        known_channels = [x.name for x in self._channels]
+        if not LATITUDE_CHANNEL in known_channels or not LONGITUDE_CHANNEL in known_channels:
+            raise Exception("Position queries require {} and {} channels".format(
+                LATITUDE_CHANNEL, LONGITUDE_CHANNEL))
+        return self._query(channels, data_filter, session=session, area=area, near=near)
+
+    def _check_channels(self, channels, data_filter):
         if not data_filter == None:
             if not 'Filter' in type(data_filter).__name__:
                 raise TypeError("data_filter must be of class Filter")
 
-            sel_st += str(data_filter)
+        #Channel names end up in the SQL text, so only known ones pass
+        known_channels = set(x.name for x in self._channels)
+        for ch in channels + (data_filter.channels if data_filter else []):
+            if not ch in known_channels:
+                raise Exception("Unable to complete query. Unknown channel: {}".format(ch))
 
-        c = self._conn.cursor()
-        c.execute(sel_st)
+    def _get_session_ranges(self, session=None):
+        """
+        Returns (session id, first sample id, last sample id) for the
+        session, or for every session if None, in session order
+        """
+        if session is not None:
+            session_range = self._get_session_range(session)
+            if session_range[0] is None:
+                raise Exception("Unknown session: {}".format(session))
+            return [(session,) + tuple(session_range)]
+
+        c = self._get_reader().cursor()
+        #Sessions without samples yet have no range
+        c.execute("""SELECT id, first_sample_id, last_sample_id FROM session
+        WHERE first_sample_id IS NOT NULL ORDER BY id""")
+        return c.fetchall()
+
+    def histogram(self, channel, bins, data_filter=None, session=None, value_range=None):
+        """
+        Counts the values of a channel, optionally limited to the samples
+        matching data_filter and to one session, in bins equally wide bins
+        over value_range (low, high), by default the channel's range from
+        its import time stats. A value x goes in bin
+        int((x - low) * bins / (high - low)), high goes in the last bin.
+        The counting is done by sqlite with a GROUP BY, or by numpy over
+        the channel's column for columnar storage.
+        Returns (counts, edges): bins counts and the bins + 1 bin edges
+        """
+        self._check_channels([channel], data_filter)
+        if bins < 1:
+            raise Exception("Invalid bins: {}".format(bins))
+
+        if value_range is None:
+            stats = self.get_channel_stats(channel, session)
+            value_range = (stats.min, stats.max) if stats.count else (0.0, 1.0)
+        low, high = float(value_range[0]), float(value_range[1])
+        if high < low:
+            raise Exception("Invalid value range: {}".format(value_range))
+        if high == low:
+            #As numpy does, a single value sits in the middle of a unit range
+            low, high = low - 0.5, high + 0.5
+        norm = bins / (high - low)
+
+        session_ranges = self._get_session_ranges(session)
+        if self._columnar:
+            read_channels = [channel] + [x for x in (data_filter.channels if data_filter else [])
+                                         if x != channel]
+            columns = self._read_channel_columns(read_channels, session=session)
+            values = columns[channel]
+            with np.errstate(invalid='ignore'):
+                mask = (values >= low) & (values <= high)
+            if data_filter:
+                mask &= data_filter._evaluate(columns)
+            indexes = np.minimum(((values[mask] - low) * norm).astype(np.int64), bins - 1)
+            counts = np.bincount(indexes, minlength=bins)
+        else:
+            partitions = self._get_partitions('datapoint')
+            counts = [0] * bins
+            c = self._get_reader().cursor()
+            sql = self._build_histogram_select(channel, data_filter)
+            params = [low, norm, bins - 1, low, high]
+            params += data_filter.compile()[1] if data_filter else []
+            for partition, first_id, last_id in session_ranges:
+                if not partition in partitions:
+                    continue
+                c.execute(self._bind_partition(sql, partition), params)
+                for index, count in c:
+                    counts[index] += count
+            if np is not None:
+                counts = np.array(counts, dtype=np.int64)
+
+        if np is not None:
+            return counts, np.linspace(low, high, bins + 1)
+        return counts, [low + (high - low) * i / bins for i in range(bins)] + [high]
+
+    def aggregate(self, channels, group_by=SESSION_GROUPS, funcs=['min', 'max', 'avg'],
+                  data_filter=None, session=None):
+        """
+        Aggregates channels per group of samples, optionally limited to
+        the samples matching data_filter and to one session. group_by is
+        SESSION_GROUPS, LAP_GROUPS (the laps of the lap index, samples
+        outside of a lap are left out) or the width in ms of time buckets
+        of the ts channel, per session. funcs are names from
+        AGGREGATE_FUNCTIONS; as in SQL, blank values are skipped.
+        Computed by sqlite with a GROUP BY, or by numpy over the channel
+        columns for columnar storage. Returns Aggregates
+        """
+        if not channels:
+            raise Exception("No channels specified")
+        for func in funcs:
+            if not func in AGGREGATE_FUNCTIONS:
+                raise Exception("Unknown aggregate function: {}".format(func))
+        if group_by == SESSION_GROUPS:
+            keys = ['session']
+        elif group_by == LAP_GROUPS:
+            keys = ['session', 'lap']
+        elif isinstance(group_by, (int, long)) and not isinstance(group_by, bool) and group_by > 0:
+            if not 'ts' in [x.name for x in self._channels]:
+                raise Exception("Time bucket aggregates require a ts channel")
+            keys = ['session', 'bucket']
+        else:
+            raise Exception("Invalid group_by: {}".format(group_by))
+        self._check_channels(channels, data_filter)
+
+        if self._columnar:
+            groups, values = self._aggregate_columnar(channels, group_by, funcs, data_filter, session)
+            return Aggregates(keys, groups, values)
+
+        #Groups never span sessions, each partition is aggregated on its own
+        rows = []
+        c = self._get_reader().cursor()
+        partitions = self._get_partitions('datapoint')
+        #Only the laps of the partition's session are joined to it
+        laps = group_by == LAP_GROUPS
+        sql = self._build_aggregate_select(channels, group_by, funcs, data_filter, laps)
+        for partition in [session] if session is not None else partitions:
+            if not partition in partitions:
+                continue
+            params = [group_by, group_by] if not group_by in (SESSION_GROUPS, LAP_GROUPS) else []
+            params += [partition] if laps else []
+            params += data_filter.compile()[1] if data_filter else []
+            c.execute(self._bind_partition(sql, partition), params)
+            rows += c.fetchall()
+
+        columns = zip(*rows) if rows else [()] * (len(keys) + len(channels) * len(funcs))
+        if np is not None:
+            groups = dict((key, np.array(columns[i], dtype=np.int64)) for i, key in enumerate(keys))
+            columns = [np.array(x, dtype=np.float64) for x in columns[len(keys):]]
+        else:
+            groups = dict((key, [int(x) for x in columns[i]]) for i, key in enumerate(keys))
+            columns = [list(x) for x in columns[len(keys):]]
+        names = [(ch, func) for ch in channels for func in funcs]
+        return Aggregates(keys, groups, dict(zip(names, columns)))
 
-        smoothing_map = {}
-        #Put together the smoothing map
+    def _aggregate_columnar(self, channels, group_by, funcs, data_filter, session):
+        """
+        aggregate() over columnar storage: every sample gets its group
+        keys, the samples are sorted by group and each function is one
+        reduceat over the sorted values
+        """
+        session_ranges = self._get_session_ranges(session)
+        if not session_ranges:
+            groups = {'session': np.empty(0, dtype=np.int64)}
+            if group_by == LAP_GROUPS:
+                groups['lap'] = np.empty(0, dtype=np.int64)
+            elif group_by != SESSION_GROUPS:
+                groups['bucket'] = np.empty(0, dtype=np.int64)
+            return groups, dict(((ch, func), np.empty(0)) for ch in channels for func in funcs)
+
+        read_channels = list(channels)
+        for ch in (data_filter.channels if data_filter else []) + \
+                ([] if group_by in (SESSION_GROUPS, LAP_GROUPS) else ['ts']):
+            if not ch in read_channels:
+                read_channels.append(ch)
+        #The sessions' samples one after the other, in session order
+        columns = self._read_channel_columns(read_channels, session=session)
+
+        lengths = [end - start + 1 for session_id, start, end in session_ranges]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        count = int(offsets[-1])
+        sessions = np.repeat(np.array([x[0] for x in session_ranges], dtype=np.int64), lengths)
+        mask = np.ones(count, dtype=bool)
+        keys = {'session': sessions}
+
+        if group_by == LAP_GROUPS:
+            laps = np.empty(count, dtype=np.int64)
+            laps.fill(-1)
+            c = self._get_reader().cursor()
+            for (session_id, first, last), offset in zip(session_ranges, offsets):
+                c.execute("""SELECT lap, start_sample_id, end_sample_id FROM lap
+                WHERE session_id=? AND start_sample_id <= ? AND end_sample_id >= ?""",
+                          (session_id, last, first))
+                for lap, start, end in c.fetchall():
+                    laps[offset + max(start, first) - first:offset + min(end, last) - first + 1] = lap
+            mask &= laps >= 0
+            keys['lap'] = laps
+        elif group_by != SESSION_GROUPS:
+            ts = columns['ts']
+            mask &= ~np.isnan(ts)
+            keys['bucket'] = (np.trunc(np.where(mask, ts, 0) / group_by) * group_by).astype(np.int64)
+
+        if data_filter:
+            mask &= data_filter._evaluate(columns)
+
+        key_names = ['session'] + [x for x in ('lap', 'bucket') if x in keys]
+        key_columns = [keys[x][mask] for x in key_names]
+        #lexsort sorts by its last key first
+        order = np.lexsort(key_columns[::-1])
+        key_columns = [x[order] for x in key_columns]
+        if len(order):
+            changes = np.zeros(len(order) - 1, dtype=bool)
+            for x in key_columns:
+                changes |= x[1:] != x[:-1]
+            starts = np.concatenate(([0], np.flatnonzero(changes) + 1))
+        else:
+            starts = np.empty(0, dtype=np.int64)
+        groups = dict((name, x[starts]) for name, x in zip(key_names, key_columns))
+
+        values = {}
         for ch in channels:
-            sr = self.get_channel_smoothing(ch)
-            smoothing_map[ch] = sr
-        
-        return DataSet(c, smoothing_map)
+            column = columns[ch][mask][order]
+            valid = ~np.isnan(column)
+            if not len(starts):
+                for func in funcs:
+                    values[(ch, func)] = np.empty(0)
+                continue
+            counts = np.add.reduceat(valid.astype(np.int64), starts)
+            sums = np.add.reduceat(np.where(valid, column, 0.0), starts)
+            empty = counts == 0
+            results = {'min': np.fmin.reduceat(column, starts),
+                       'max': np.fmax.reduceat(column, starts),
+                       'sum': np.where(empty, np.nan, sums),
+                       'avg': np.where(empty, np.nan, sums / np.maximum(counts, 1)),
+                       'count': counts.astype(np.float64)}
+            for func in funcs:
+                values[(ch, func)] = results[func]
+        return groups, values
+
+    def get_sidecar(self, session):
+        """
+        Returns the memory mapped sidecar of a session, or None if there is
+        none or its source datalog has changed since the import
+        """
+        sidecar_path = self._get_sidecar_path(session)
+        return open_sidecar(sidecar_path) if sidecar_path else None
+
+    def export(self, session, channels, path, export_format=CSV_EXPORT, native_rates=False):
+        """
+        Streams the raw, unsmoothed records of a session to a file, a
+        chunk at a time
+
+        :param session: id of the session
+        :param channels: channels to export, all of the session's if empty.
+        ts, when the session has it, always comes first
+        :param path: file to write
+        :param export_format: CSV_EXPORT or BINARY_EXPORT, see export.py
+        :param native_rates: re-sparsify the channels to their sample rates
+        rather than writing every channel on every row
+        :returns: the number of rows written
+        """
+        session_range = self._get_session_ranges(session)[0][1:]
+
+        #The channels a session logged are the ones with stats for it
+        c = self._get_reader().cursor()
+        c.execute("""SELECT channel.name FROM channel_stats
+        JOIN channel ON channel_stats.channel_id=channel.id
+        WHERE channel_stats.session_id=? ORDER BY channel.id""", (session,))
+        session_channels = [str(x[0]) for x in c.fetchall()]
+
+        channels = list(channels) if channels else session_channels
+        known_channels = dict((x.name, x) for x in self._channels)
+        for channel in channels:
+            if not channel in known_channels:
+                raise Exception("Unknown channel: {}".format(channel))
+        if 'ts' in channels or 'ts' in session_channels:
+            channels = ['ts'] + [x for x in channels if x != 'ts']
+        elif native_rates:
+            raise Exception("Re-sparsifying requires the ts channel")
+        headers = [known_channels[x] for x in channels]
+
+        blocks = self._read_session_blocks(headers, *session_range)
+        if native_rates:
+            blocks = resparsify_blocks(blocks, headers, 0)
+        return write_export(blocks, headers, path, export_format, session_range[0])
+
+    def get_channel_array(self, channel, session):
+        """
+        Returns the raw, unsmoothed values of a channel over a session as
+        an array. They come straight out of the session's sidecar when it
+        is current, otherwise they are read from the database
+        """
+        if np is None:
+            raise Exception("Channel arrays require numpy")
+
+        sidecar = self.get_sidecar(session)
+        if sidecar and channel in [x.name for x in sidecar.channels]:
+            return sidecar.get(channel)
+
+        if not channel in [x.name for x in self._channels]:
+            raise Exception("Unknown channel: {}".format(channel))
+
+        session_range = self._get_session_ranges(session)[0][1:]
+        return self._read_raw_buckets([channel], *session_range)[channel][2][:, 0]
+
+    def _read_raw_buckets(self, channels, start, end):
+        """
+        Reads the samples between start and end as buckets of one sample,
+        one set of buckets per channel
+        """
+        c = self._get_reader().cursor()
+        #The sessions between start and end, each a run of sample ids
+        ranges = [(x[0], max(x[1], start), min(x[2], end)) for x in self._get_session_ranges()
+                  if x[1] <= end and x[2] >= start]
+        rows = []
+        for partition, first_id, last_id in ranges:
+            if self._columnar:
+                columns = self._read_session_columns(channels, partition, first_id, last_id)
+                rows += zip(range(first_id, last_id + 1), *[columns[ch].tolist() for ch in channels])
+            else:
+                c.execute("""SELECT sample_id, {} FROM {} WHERE sample_id BETWEEN ? AND ?
+                ORDER BY sample_id""".format(', '.join(channels), self._partition_name('datapoint', partition)),
+                          (first_id, last_id))
+                rows += c.fetchall()
+
+        buckets = {}
+        for i, channel in enumerate(channels):
+            if np is not None:
+                values = np.array([x[i + 1] for x in rows], dtype=np.float64).reshape(len(rows), 1)
+                buckets[channel] = (np.array([x[0] for x in rows], dtype=np.int64),
+                                    np.ones(len(rows), dtype=np.int64), values, values, values, values)
+            else:
+                buckets[channel] = [(x[0], 1, [x[i + 1]], [x[i + 1]], [x[i + 1]], [x[i + 1]]) for x in rows]
+        return buckets
+
+    def _read_pyramid_buckets(self, channels, start, end, factor):
+        c = self._get_reader().cursor()
+        #The sessions between start and end, each has a partition of its own
+        partitions = [x[0] for x in self._get_session_ranges() if x[1] <= end and x[2] >= start]
+        buckets = {}
+        for channel, channel_id in zip(channels, self._get_channel_ids(channels, c.connection)):
+            rows = []
+            for partition in partitions:
+                c.execute("""SELECT first_sample_id, count, min, max, first, last FROM {}
+                WHERE channel_id=? AND factor=? AND first_sample_id <= ? AND first_sample_id + count > ?
+                ORDER BY first_sample_id""".format(self._partition_name('channel_pyramid', partition)),
+                          (channel_id, factor, end, start))
+                rows += c.fetchall()
+            if np is not None:
+                buckets[channel] = (np.array([x[0] for x in rows], dtype=np.int64),
+                                    np.array([x[1] for x in rows], dtype=np.int64)) + \
+                    tuple(np.array([x[i] for x in rows], dtype=np.float64).reshape(len(rows), 1)
+                          for i in range(2, 6))
+            else:
+                buckets[channel] = [(x[0], x[1], [x[2]], [x[3]], [x[4]], [x[5]]) for x in rows]
+        return buckets
+
+    def query_decimated(self, channels, start, end, target_points):
+        """
+        Returns an OrderedDict of ChannelEnvelope, one per channel, covering
+        the samples from start to end (sample ids, inclusive) in about
+        target_points buckets. The coarsest pyramid level that still
+        gives target_points buckets over the range is read, so the cost
+        depends on target_points rather than on the length of the range.
+        Values are raw, channel smoothing is not applied
+        """
+        if not channels:
+            raise Exception("No channels specified")
+        if target_points < 1:
+            raise Exception("Invalid target_points: {}".format(target_points))
+
+        known_channels = set(x.name for x in self._channels)
+        for ch in channels:
+            if not ch in known_channels:
+                raise Exception("Unable to complete query. Unknown channel: {}".format(ch))
+
+        #The samples the range holds, the ids between sessions are unused
+        samples = sum(min(x[2], end) - max(x[1], start) + 1 for x in self._get_session_ranges()
+                      if x[1] <= end and x[2] >= start)
+        factor = 1
+        for level_factor in PYRAMID_FACTORS:
+            if samples // level_factor >= target_points:
+                factor = level_factor
+
+        if factor == 1:
+            buckets = self._read_raw_buckets(channels, start, end)
+        else:
+            buckets = self._read_pyramid_buckets(channels, start, end, factor)
+
+        envelopes = OrderedDict()
+        for channel in channels:
+            channel_buckets = buckets[channel]
+            #Bring the level down to the number of points asked for
+            ratio = len(channel_buckets if np is None else channel_buckets[0]) // target_points
+            if ratio > 1:
+                channel_buckets = _merge_buckets(channel_buckets, ratio, final=True)[0]
+                envelope_factor = factor * ratio
+            else:
+                envelope_factor = factor
+            envelopes[channel] = ChannelEnvelope(envelope_factor, channel_buckets)
+
+        return envelopes
+
+    def _query(self, channels=[], data_filter=None, sample_range=None, session=None,
+               time_range=None, area=None, near=None):
+        #If there are no channels, or if a '*' is passed, select all
+        #of the channels
+        if len(channels) == 0 or '*' in channels:
+            channels = [x.name for x in self._channels]
+
+        self._check_channels(channels, data_filter)
+
+        #Results are cached by everything that goes into them
+        self._check_data_version()
+        smoothing_map, kernel_map = self._get_smoothing_maps(channels)
+        generation = self._data_generation
+        filter_sql, filter_params = data_filter.compile() if data_filter else (None, [])
+        result_key = (tuple(channels), filter_sql, tuple(filter_params),
+                      tuple(sample_range) if sample_range is not None else None, session,
+                      time_range, area, near,
+                      tuple(sorted(smoothing_map.items())), tuple(sorted(kernel_map.items())))
+        columns = self._result_cache.get(result_key)
+        if columns is not None:
+            cursor = _ColumnCursor(channels, [columns[ch] for ch in channels])
+            return DataSet(cursor, row_count=lambda: cursor.rowcount,
+                           interrupt_check=self._get_interrupt_check())
+
+        if session is not None:
+            session_range = self._get_session_ranges(session)[0][1:]
+
+        if self._columnar:
+            #Sessions occupy a contiguous run of sample ids
+            if session is not None:
+                sample_range = session_range if sample_range is None else \
+                    (max(sample_range[0], session_range[0]), min(sample_range[1], session_range[1]))
+            c = self._query_columnar(channels, data_filter, sample_range, time_range, area, near, session)
+            row_count = lambda: c.rowcount
+        else:
+            #Queries of the same shape share the same statement text, the
+            #session's partition is filled in for each one it reads
+            key = (tuple(channels), data_filter.shape if data_filter else None,
+                   sample_range is not None, time_range is not None,
+                   area is not None, near is not None)
+            #A partition holds one session, its id only matters to the
+            #(session_id, ts) index of a time window
+            session_column = time_range is not None
+            sel_st = self._statement_cache.get(key)
+            if sel_st is None:
+                sel_st = self._build_select(channels, data_filter, sample_range is not None,
+                                            session_column, time_range is not None,
+                                            area is not None, near is not None)
+                self._statement_cache.put(key, sel_st)
+
+            #One statement per session partition, read in session order.
+            #Without any the template tables still give the result its
+            #columns
+            partitions = [session] if session is not None else self._get_partitions('datapoint')
+            statements = []
+            for partition in partitions or [None]:
+                params = list(sample_range) if sample_range is not None else []
+                params += [partition or 0] if session_column else []
+                params += list(time_range) if time_range is not None else []
+                params += list(area) * 2 if area is not None else []
+                params += list(near) if near is not None else []
+                params += data_filter.compile()[1] if data_filter else []
+                statements.append((self._bind_partition(sel_st, partition), params))
+
+            conn = self._get_reader()
+            c = _PartitionCursor(conn, statements)
+            row_count = lambda: sum(conn.execute('SELECT COUNT(*) FROM ({})'.format(sql), params).fetchone()[0]
+                                    for sql, params in statements)
+
+        record_limit = self._result_cache.max_bytes // RESULT_VALUE_BYTES
+        if record_limit and self._columnar and c.rowcount * len(channels) > record_limit:
+            #Known up front to be too big to keep
+            record_limit = 0
+        on_complete = (lambda columns: self._cache_result(result_key, generation, columns)) \
+            if record_limit else None
+        return DataSet(c, smoothing_map, row_count, kernel_map, on_complete, record_limit,
+                       self._get_interrupt_check())
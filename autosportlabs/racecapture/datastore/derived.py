@@ -0,0 +1,203 @@
+#!/usr/bin/python
+"""
+Expressions over datastore channels, such as 'RPM / Speed',
+'AccelX^2 + AccelY^2' or 'Brake > 50'
+
+Expressions are parsed with the Python parser and only a small set of
+node types is accepted: numbers, channel names, arithmetic (^ is a power,
+as users of the device's scripting expect), comparisons and and/or/not,
+which give 1.0 or 0.0, and the functions in FUNCTIONS. Nothing is ever
+passed to eval.
+
+A compiled expression evaluates a whole block of values at once: numpy
+arrays, NaN where a channel is blank, when numpy is available, otherwise
+lists with None for blanks and an evaluation per value.
+"""
+import ast
+import math
+import operator
+import re
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _where(condition, a, b):
+    if np is not None and hasattr(condition, 'shape'):
+        return np.where(condition != 0, a, b)
+    return a if condition else b
+
+#Functions available to expressions: (numpy version, scalar version)
+FUNCTIONS = {
+    'abs': ('absolute', abs),
+    'sqrt': ('sqrt', math.sqrt),
+    'exp': ('exp', math.exp),
+    'log': ('log', math.log),
+    'sin': ('sin', math.sin),
+    'cos': ('cos', math.cos),
+    'tan': ('tan', math.tan),
+    'atan2': ('arctan2', math.atan2),
+    'min': ('fmin', min),
+    'max': ('fmax', max),
+    'if': (_where, _where),
+}
+
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_COMPARE_OPS = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+def _as_float(value):
+    if np is not None and hasattr(value, 'astype'):
+        return value.astype(np.float64)
+    return 1.0 if value else 0.0
+
+def _truth(value):
+    if np is not None and hasattr(value, 'shape'):
+        return value != 0
+    return bool(value)
+
+def _negate(value):
+    if np is not None and hasattr(value, 'shape'):
+        return ~value
+    return not value
+
+class DerivedExpression(object):
+    """
+    A compiled expression. channels lists the channel names it reads
+    """
+    def __init__(self, text):
+        self.text = text
+        self.channels = []
+        #'if' is a keyword to Python, expressions spell it if_ underneath
+        source = re.sub(r'\bif\s*\(', 'if_(', text.replace('^', '**'))
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise Exception("Invalid expression '{}': {}".format(text, e))
+        self._fn = self._compile(tree.body)
+
+    def _compile(self, node):
+        if isinstance(node, ast.Num):
+            value = float(node.n)
+            return lambda columns: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            if not name in self.channels:
+                self.channels.append(name)
+            return lambda columns: columns[name]
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            op = _BINARY_OPS[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda columns: op(left(columns), right(columns))
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda columns: -operand(columns)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Not):
+                return lambda columns: _as_float(_negate(_truth(operand(columns))))
+
+        if isinstance(node, ast.Compare):
+            terms = [self._compile(node.left)] + [self._compile(x) for x in node.comparators]
+            ops = []
+            for op in node.ops:
+                if not type(op) in _COMPARE_OPS:
+                    raise Exception("Unsupported comparison in '{}'".format(self.text))
+                ops.append(_COMPARE_OPS[type(op)])
+            def compare(columns):
+                values = [x(columns) for x in terms]
+                result = None
+                for op, a, b in zip(ops, values, values[1:]):
+                    term = op(a, b)
+                    result = term if result is None else result & term
+                return _as_float(result)
+            return compare
+
+        if isinstance(node, ast.BoolOp):
+            values = [self._compile(x) for x in node.values]
+            both = isinstance(node.op, ast.And)
+            def combine(columns):
+                result = None
+                for value in values:
+                    term = _truth(value(columns))
+                    if result is None:
+                        result = term
+                    else:
+                        result = (result & term) if both else (result | term)
+                return _as_float(result)
+            return combine
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+                not node.keywords and not node.starargs and not node.kwargs:
+            name = 'if' if node.func.id == 'if_' else node.func.id
+            if not name in FUNCTIONS:
+                raise Exception("Unknown function '{}' in '{}'".format(node.func.id, self.text))
+            vectorized, scalar = FUNCTIONS[name]
+            if np is not None and isinstance(vectorized, str):
+                vectorized = getattr(np, vectorized)
+            args = [self._compile(x) for x in node.args]
+            def call(columns):
+                values = [x(columns) for x in args]
+                if np is not None and any(hasattr(x, 'shape') for x in values):
+                    return vectorized(*values)
+                return scalar(*values)
+            return call
+
+        raise Exception("Unsupported syntax in '{}': {}".format(self.text, type(node).__name__))
+
+    def evaluate(self, columns):
+        """
+        Evaluates the expression over columns, a dict of channel name to
+        equally long float64 arrays (or lists without numpy). Returns an
+        array (or list) of the results, NaN (or None) where an input is
+        blank or the result is undefined
+        """
+        length = len(columns.values()[0]) if columns else 0
+        if np is not None:
+            columns = dict((k, np.asarray(v, dtype=np.float64)) for k, v in columns.iteritems())
+            with np.errstate(all='ignore'):
+                result = np.array(self._fn(columns), dtype=np.float64)
+            if not result.shape:
+                result = np.repeat(result, length)
+            blank = np.isinf(result)
+            for name in self.channels:
+                blank |= np.isnan(columns[name])
+            result[blank] = np.nan
+            return result
+
+        results = []
+        for i in range(length):
+            row = dict((name, columns[name][i]) for name in self.channels)
+            if None in row.values():
+                results.append(None)
+                continue
+            try:
+                value = float(self._fn(row))
+                results.append(None if math.isnan(value) or math.isinf(value) else value)
+            except (ZeroDivisionError, ValueError, OverflowError):
+                results.append(None)
+        return results
+
+def compile_expression(text):
+    """
+    Compiles an expression, raises an Exception if it isn't one we accept
+    """
+    return DerivedExpression(text)
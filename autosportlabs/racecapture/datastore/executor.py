@@ -0,0 +1,294 @@
+#!/usr/bin/python
+"""
+Background execution of DataStore queries for the analysis views
+
+A QueryExecutor runs DataStore calls on a small pool of worker threads, so
+the UI thread never waits on sqlite. Each worker reads through a sqlite
+connection of its own, the one DataStore._get_reader hands its thread.
+Calls return a QueryFuture. Callbacks added to a future are delivered on
+the UI thread through Kivy's Clock, or straight from the worker when
+Kivy isn't around, as in tests and scripts.
+
+A call can be cancelled at any time. If it is still queued it is
+dropped. If it is running, a sqlite progress handler on the worker's
+connection aborts the statement in progress, and the same handler,
+given to the DataStore, aborts decoding columnar storage and reading a
+DataSet between chunks. Calls submitted under the
+same key supersede each other: each cancels the one before it, so a
+slider dragged across a session only leaves the latest query running.
+"""
+import logging
+import sqlite3
+import threading
+import Queue
+from autosportlabs.racecapture.datastore.datastore import np
+try:
+    from kivy.clock import Clock
+except ImportError:
+    Clock = None
+
+#Worker threads of an executor
+DEFAULT_WORKERS = 2
+
+#sqlite virtual machine instructions between checks for cancellation
+PROGRESS_INTERVAL = 1000
+
+#Records read at a time when a query is fetched without numpy
+FETCH_SIZE = 10000
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+
+class CancelledError(Exception):
+    """
+    Raised by QueryFuture.result() when the call was cancelled
+    """
+    pass
+
+def ui_thread_dispatch(fn):
+    """
+    Runs fn on the UI thread, at the next frame, or right away when Kivy
+    isn't available
+    """
+    if Clock is not None:
+        Clock.schedule_once(lambda dt: fn())
+    else:
+        fn()
+
+class QueryFuture(object):
+    """
+    The pending result of a call submitted to a QueryExecutor
+    """
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._state = PENDING
+        self._cancel_requested = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Cancels the call: a queued one never runs, a running one has its
+        sqlite statement aborted. Returns False if it already finished
+        """
+        with self._lock:
+            if self._state == FINISHED:
+                return False
+            self._cancel_requested = True
+            if self._state != PENDING:
+                return True
+        self._finish(CANCELLED)
+        return True
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    def running(self):
+        return self._state == RUNNING
+
+    def done(self):
+        return self._state in (FINISHED, CANCELLED)
+
+    def result(self, timeout=None):
+        """
+        Waits for the call and returns its result. Raises CancelledError
+        if it was cancelled, the call's exception if it failed, or an
+        Exception if it isn't done within timeout seconds
+        """
+        if not self._done.wait(timeout):
+            raise Exception("Query not done within {} seconds".format(timeout))
+        if self._state == CANCELLED:
+            raise CancelledError()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Waits for the call and returns the exception it raised, or None
+        """
+        if not self._done.wait(timeout):
+            raise Exception("Query not done within {} seconds".format(timeout))
+        if self._state == CANCELLED:
+            raise CancelledError()
+        return self._error
+
+    def add_done_callback(self, fn):
+        """
+        Has fn(future) called on the UI thread once the call has finished
+        or been cancelled
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        self._dispatch(lambda: self._call(fn))
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logging.exception("QueryFuture: error in done callback")
+
+    def _start(self):
+        """
+        Marks the call running, returns False if it was cancelled while
+        queued
+        """
+        with self._lock:
+            if self._state != PENDING:
+                return False
+            self._state = RUNNING
+            return True
+
+    def _interrupt(self):
+        #sqlite progress handler, a non zero return aborts the statement
+        return 1 if self._cancel_requested else 0
+
+    def _finish(self, state, result=None, error=None):
+        with self._lock:
+            if self.done():
+                return
+            self._result = result
+            self._error = error
+            self._state = state
+            callbacks = self._callbacks
+            self._callbacks = []
+        self._done.set()
+        for fn in callbacks:
+            self._dispatch(lambda fn=fn: self._call(fn))
+
+class QueryExecutor(object):
+    """
+    Runs DataStore calls on worker threads. An in memory datastore has a
+    single connection, there one worker runs the calls in turn, and its
+    statements can't be aborted part way
+    """
+    def __init__(self, datastore, workers=DEFAULT_WORKERS, dispatch=ui_thread_dispatch):
+        self._ds = datastore
+        self._dispatch = dispatch
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._futures = set()
+        self._shutdown = False
+        if datastore.name in (':memory:', ''):
+            workers = 1
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name='QueryExecutor {}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on a worker, returns a QueryFuture
+        """
+        future = QueryFuture(self._dispatch)
+        with self._lock:
+            if self._shutdown:
+                raise Exception("QueryExecutor is shut down")
+            self._futures.add(future)
+            self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def submit_latest(self, key, fn, *args, **kwargs):
+        """
+        As submit, cancelling the call last submitted under the same key,
+        for views that only care about the latest result
+        """
+        future = self.submit(fn, *args, **kwargs)
+        with self._lock:
+            previous = self._latest.get(key)
+            self._latest[key] = future
+        if previous is not None:
+            previous.cancel()
+        future.add_done_callback(lambda x: self._forget(key, x))
+        return future
+
+    def query(self, channels=[], data_filter=None, start_ms=None, end_ms=None, session=None, key=None):
+        """
+        Runs DataStore.query in the background. The future's result is
+        the whole result, read on the worker: a dict of channel arrays as
+        DataSet.fetch_all returns it, or of lists without numpy. Queries
+        given a key supersede the last one with the same key
+        """
+        args = (channels, data_filter, start_ms, end_ms, session)
+        if key is not None:
+            return self.submit_latest(key, self._fetch_query, *args)
+        return self.submit(self._fetch_query, *args)
+
+    def _fetch_query(self, *args):
+        dataset = self._ds.query(*args)
+        if np is not None:
+            return dataset.fetch_all()
+        columns = dataset.fetch_columns(FETCH_SIZE)
+        for chunk in dataset.iter_chunks(FETCH_SIZE):
+            for c, values in chunk.iteritems():
+                columns[c].extend(values)
+        return columns
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._latest.get(key) is future:
+                del self._latest[key]
+
+    def shutdown(self, wait=True):
+        """
+        Cancels the calls still queued, aborts the running ones and stops
+        the workers, waiting for them if wait is set. Shut down the
+        executor before closing its datastore
+        """
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _worker(self):
+        conn = self._ds._get_reader()
+        #Sharing the writer connection, a progress handler would abort
+        #the writer's statements as well
+        interruptible = conn is not self._ds._conn
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if future._start():
+                self._run(conn, interruptible, future, fn, args, kwargs)
+            with self._lock:
+                self._futures.discard(future)
+
+    def _run(self, conn, interruptible, future, fn, args, kwargs):
+        if interruptible:
+            conn.set_progress_handler(future._interrupt, PROGRESS_INTERVAL)
+        #Reading and decoding outside of sqlite is aborted between chunks
+        self._ds._set_interrupt_check(future._interrupt)
+        try:
+            result = fn(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if future._cancel_requested:
+                future._finish(CANCELLED)
+            else:
+                future._finish(FINISHED, error=e)
+        except Exception as e:
+            future._finish(FINISHED, error=e)
+        else:
+            #Superseded results aren't delivered, even complete ones
+            future._finish(CANCELLED if future._cancel_requested else FINISHED, result)
+        finally:
+            self._ds._set_interrupt_check(None)
+            if interruptible:
+                conn.set_progress_handler(None, 0)
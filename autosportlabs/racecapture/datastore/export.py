@@ -0,0 +1,133 @@
+#!/usr/bin/python
+"""
+Streaming export of DataStore sessions
+
+An export is a pipeline of generators over blocks of records, the same
+blocks an import produces: read from the datastore a chunk at a time,
+optionally re-sparsified to the native sample rates of the channels, and
+written out as they come. Only one block is held at a time, whatever the
+length of the session.
+
+Formats:
+    csv     a RaceCapture datalog, '"name"|"units"|rate' headers and blank
+            entries for channels not sampled on a row
+    binary  the sidecar layout (see sidecar.py): one little-endian array
+            per channel, readable with sidecar.Sidecar
+"""
+import math
+import os
+from autosportlabs.racecapture.datastore.sidecar import SidecarWriter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CSV_EXPORT = 'csv'
+BINARY_EXPORT = 'binary'
+EXPORT_FORMATS = [CSV_EXPORT, BINARY_EXPORT]
+
+def _blank(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def _format_value(value):
+    if _blank(value):
+        return ''
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def resparsify_blocks(blocks, channels, ts_index):
+    """
+    Blanks the values a channel wouldn't have logged at its sample rate.
+    A value is kept where it changes and on the first row of each 1/rate
+    second slot of the ts channel, at ts_index, so carrying the values
+    forward again gives back exactly what was exported. Channels without
+    a sample rate are kept whole
+    """
+    intervals = [1000.0 / x.sample_rate if x.sample_rate else None for x in channels]
+    last_slots = [None] * len(channels)
+    last_values = [None] * len(channels)
+
+    for block in blocks:
+        if not len(block):
+            continue
+
+        if np is not None:
+            block = np.array(block, dtype=np.float64)
+            ts = block[:, ts_index]
+            for i, interval in enumerate(intervals):
+                if interval is None or i == ts_index:
+                    continue
+                values = block[:, i].copy()
+                slots = np.floor(ts / interval)
+                keep = np.empty(len(slots), dtype=bool)
+                keep[0] = slots[0] != last_slots[i] or values[0] != last_values[i]
+                keep[1:] = (slots[1:] != slots[:-1]) | (values[1:] != values[:-1])
+                block[~keep, i] = np.nan
+                last_slots[i] = slots[-1]
+                last_values[i] = values[-1]
+        else:
+            block = [list(x) for x in block]
+            for record in block:
+                ts = record[ts_index]
+                for i, interval in enumerate(intervals):
+                    if interval is None or i == ts_index or ts is None:
+                        continue
+                    slot = math.floor(ts / interval)
+                    value = record[i]
+                    if slot == last_slots[i] and value == last_values[i]:
+                        record[i] = None
+                    last_slots[i] = slot
+                    last_values[i] = value
+        yield block
+
+def write_csv(blocks, channels, path):
+    """
+    Writes blocks as a RaceCapture CSV datalog, returns the row count
+    """
+    rows = 0
+    with open(path, 'wb') as f:
+        f.write(','.join('"{}"|"{}"|{}'.format(x.name, x.units, x.sample_rate) for x in channels) + '\r\n')
+        for block in blocks:
+            if np is not None and hasattr(block, 'tolist'):
+                block = block.tolist()
+            f.write(''.join(','.join(_format_value(x) for x in record) + '\r\n' for record in block))
+            rows += len(block)
+    return rows
+
+def write_binary(blocks, channels, path, first_sample_id):
+    """
+    Writes blocks in the sidecar layout, returns the row count
+    """
+    if np is None:
+        raise Exception("Binary export requires numpy")
+
+    writer = SidecarWriter(path, None, channels)
+    rows = 0
+    try:
+        for block in blocks:
+            block = np.array(block, dtype=np.float64)
+            writer.add_block(block)
+            rows += len(block)
+    except:
+        writer.abort()
+        raise
+    writer.close(first_sample_id)
+    return rows
+
+def write_export(blocks, channels, path, export_format, first_sample_id):
+    """
+    Writes blocks to path in export_format, removing the partial file if
+    anything goes wrong. Returns the row count
+    """
+    if not export_format in EXPORT_FORMATS:
+        raise Exception("Unknown export format: {}".format(export_format))
+
+    try:
+        if export_format == CSV_EXPORT:
+            return write_csv(blocks, channels, path)
+        return write_binary(blocks, channels, path, first_sample_id)
+    except:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""
+Live recording of DataBus samples into a DataStore session
+
+A SessionRecorder is registered as a DataBusPump sample listener. Samples
+are queued as they arrive and a writer thread, with its own connection to
+the datastore, turns them into rows and commits them in batches, so the
+thread feeding samples never waits on sqlite.
+"""
+import logging
+import threading
+import Queue
+from autosportlabs.racecapture.datastore.datastore import DataStore, DatalogChannel, \
+    _ChannelStatsBuilder, _LapIndexBuilder, _PyramidBuilder, SPARSE_STORAGE, np
+
+#How often, in ms, the writer thread commits a batch of samples
+DEFAULT_COMMIT_INTERVAL = 250
+
+#Samples held while waiting for the writer thread, beyond this they are
+#dropped. 10000 samples is 10s at the maximum sample rate of 1000Hz
+DEFAULT_QUEUE_SIZE = 10000
+
+class SessionRecorder(object):
+    """
+    Records the samples of a DataBusPump into a new session of an on-disk
+    DataStore. The channels of the session are those of the channel meta
+    in effect when the first sample arrives; channels are carried forward
+    from their last value, as they are when a datalog is imported, and
+    the sample tick is recorded as ts
+
+    Counters, safe to read from any thread:
+    recorded: samples written to the datastore
+    dropped: samples dropped because the queue was full
+    """
+    def __init__(self, datastore, name, notes='', data_bus_pump=None,
+                 commit_interval=DEFAULT_COMMIT_INTERVAL, queue_size=DEFAULT_QUEUE_SIZE):
+        if datastore.name in (':memory:', ''):
+            raise Exception("Recording requires an on-disk datastore")
+        self._db_name = datastore.name
+        self._name = name
+        self._notes = notes
+        self._pump = data_bus_pump
+        self._commit_interval = commit_interval / 1000.0
+        self._queue = Queue.Queue(queue_size)
+        self._metas = None
+        self._stop_event = threading.Event()
+        self._started = threading.Event()
+        self._thread = None
+        self._error = None
+        self.session_id = None
+        self.recorded = 0
+        self.dropped = 0
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def start(self):
+        """
+        Starts the writer thread and returns the id of the new session
+        """
+        if self._thread:
+            raise Exception("Recorder already started")
+
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+        if self._error:
+            raise self._error
+
+        if self._pump:
+            self._pump.add_sample_listener(self.on_sample)
+        return self.session_id
+
+    def stop(self):
+        """
+        Stops listening, writes what is still queued along with the
+        session's last lap and partial pyramid buckets, and waits for the
+        writer thread
+        """
+        if self._pump:
+            self._pump.remove_sample_listener(self.on_sample)
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        if self._error:
+            raise self._error
+
+    def on_sample(self, sample):
+        """
+        DataBusPump sample listener. The sample object is reused by the
+        pump, so only its values are kept
+        """
+        if self._metas is None and sample.metas.channel_metas:
+            self._metas = [(x.name, x.units, x.sampleRate) for x in sample.metas.channel_metas]
+
+        values = dict((x.channelMeta.name, x.value) for x in sample.samples)
+        try:
+            self._queue.put_nowait((sample.tick, values))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        ds = DataStore()
+        try:
+            ds.open_db(self._db_name)
+            self.session_id = ds._create_session(self._name, self._notes)
+        except Exception as e:
+            self._error = e
+            self._started.set()
+            return
+        self._started.set()
+
+        writer = _SessionWriter(ds, self.session_id)
+        try:
+            while not self._stop_event.is_set():
+                self._stop_event.wait(self._commit_interval)
+                self.recorded += writer.write(self._drain(), self._metas)
+            self.recorded += writer.write(self._drain(), self._metas)
+            writer.finish()
+        except Exception as e:
+            logging.error("SessionRecorder: unable to record session {}: {}".format(self.session_id, e))
+            self._error = e
+        finally:
+            ds.close()
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except Queue.Empty:
+                return items
+
+class _SessionWriter(object):
+    """
+    Turns queued samples into blocks of desparsified records and writes
+    them the way an import does, on the writer thread
+    """
+    def __init__(self, datastore, session_id):
+        self._ds = datastore
+        self._session_id = session_id
+        self._channels = None
+        self._chunk = 0
+
+    def _init_channels(self, metas):
+        channels = [DatalogChannel(name, units, sample_rate) for name, units, sample_rate in metas]
+        if not 'ts' in [x.name for x in channels]:
+            channels.append(DatalogChannel('ts', 'ms', 0))
+        self._ds._register_channels(channels)
+
+        self._channels = channels
+        self._channel_ids = self._ds._get_channel_ids([x.name for x in channels])
+        self._index = dict((x.name, i) for i, x in enumerate(channels))
+        self._ts_index = self._index['ts']
+        self._last = [None] * len(channels)
+        self._stats = _ChannelStatsBuilder(len(channels))
+        self._laps = _LapIndexBuilder(channels)
+        self._pyramid = _PyramidBuilder(len(channels))
+
+    def write(self, items, metas):
+        if not items or not metas:
+            return 0
+        if self._channels is None:
+            self._init_channels(metas)
+
+        index = self._index
+        last = self._last
+        rows = []
+        #Sparse storage keeps only the values the samples carried
+        logged = [] if self._ds.storage == SPARSE_STORAGE else None
+        for tick, values in items:
+            for name, value in values.iteritems():
+                i = index.get(name)
+                if i is not None:
+                    last[i] = value
+            last[self._ts_index] = tick
+            rows.append(list(last))
+            if logged is not None:
+                row = [False] * len(last)
+                for name in values:
+                    if name in index:
+                        row[index[name]] = True
+                row[self._ts_index] = True
+                logged.append(row)
+
+        block = np.array(rows, dtype=np.float64) if np is not None else rows
+        if logged is not None:
+            logged = np.array(logged, dtype=bool)
+        first_sample_id = self._ds._insert_block(block, self._channels, self._session_id, self._chunk,
+                                                 commit=False, logged=logged)
+        self._chunk += 1
+
+        #The stats so far, the completed laps and the finished pyramid
+        #buckets go in with the samples, so neither memory nor what a
+        #crash would lose grows with the length of the recording
+        self._stats.add_block(block, first_sample_id)
+        self._laps.add_block(block, first_sample_id)
+        self._pyramid.add_block(block, first_sample_id)
+        conn = self._ds._conn
+        self._stats.write(conn, self._session_id, self._channel_ids)
+        self._laps.flush(conn, self._session_id)
+        self._pyramid.flush(conn, self._pyramid_table(), self._session_id, self._channel_ids)
+        conn.commit()
+        return len(rows)
+
+    def _pyramid_table(self):
+        return self._ds._partition_name('channel_pyramid', self._session_id)
+
+    def finish(self):
+        if self._channels is None:
+            return
+        self._laps.write(self._ds._conn, self._session_id)
+        self._pyramid.write(self._ds._conn, self._pyramid_table(), self._session_id, self._channel_ids)
+        self._ds._conn.commit()
+        self._ds._materialize_derived(self._session_id, [x.name for x in self._channels])
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""
+Binary sidecar files for imported datalogs
+
+A sidecar is written next to the database for every imported datalog and
+holds the desparsified channels of the session as plain little-endian
+arrays, so they can be memory mapped and served without going through
+sqlite. Layout:
+
+    header   '<4sHHQQQd' magic, version, channel count, row count,
+             first sample id, source size, source mtime
+             '<H' + utf-8 source path
+             per channel: '<H' + utf-8 name, '<H' + utf-8 units,
+             '<I' sample rate, '<c' dtype ('f' float32, 'd' float64)
+    padding  up to a multiple of SIDECAR_ALIGNMENT
+    columns  one array per channel, in channel order, each padded up to
+             a multiple of SIDECAR_ALIGNMENT
+
+A channel is stored as float32 only when that loses nothing. The sidecar
+records the size and mtime of the source datalog and is discarded once
+they change. Exports (see export.py) use the same layout with no source.
+"""
+import os
+import struct
+import tempfile
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SIDECAR_MAGIC = 'RCSC'
+SIDECAR_VERSION = 1
+SIDECAR_ALIGNMENT = 8
+
+_PREFIX = struct.Struct('<4sHHQQQd')
+_LENGTH = struct.Struct('<H')
+_CHANNEL = struct.Struct('<Ic')
+
+#Bytes copied at a time when the columns are assembled
+_COPY_SIZE = 1 << 20
+
+def _padding(size):
+    return -size % SIDECAR_ALIGNMENT
+
+def _pack_text(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return _LENGTH.pack(len(text)) + text
+
+def _unpack_text(data, offset):
+    length = _LENGTH.unpack_from(data, offset)[0]
+    offset += _LENGTH.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def _source_signature(source_path):
+    st = os.stat(source_path)
+    return st.st_size, st.st_mtime
+
+class SidecarChannel(object):
+    def __init__(self, name, units, sample_rate, dtype):
+        self.name = name
+        self.units = units
+        self.sample_rate = sample_rate
+        self.dtype = dtype
+
+class SidecarWriter(object):
+    """
+    Collects a datalog block by block while it is imported. Every channel
+    is spooled to its own temporary file as float64 until close() knows
+    the row count and which channels fit in float32. source_path may be
+    None for a file that isn't derived from a datalog
+    """
+    def __init__(self, path, source_path, channels):
+        if np is None:
+            raise Exception("Sidecar files require numpy")
+        self.path = path
+        self._source_path = source_path or ''
+        self._source_size, self._source_mtime = _source_signature(source_path) if source_path else (0, 0)
+        self._channels = channels
+        directory = os.path.dirname(os.path.abspath(path))
+        self._columns = [tempfile.TemporaryFile(dir=directory) for x in channels]
+        self._lossless = [True] * len(channels)
+        self._rows = 0
+
+    def add_block(self, block):
+        for i, column in enumerate(self._columns):
+            values = block[:, i]
+            if self._lossless[i]:
+                narrowed = values.astype(np.float32)
+                self._lossless[i] = bool(((narrowed == values) | np.isnan(values)).all())
+            column.write(values.astype('<f8').tostring())
+        self._rows += len(block)
+
+    def _header(self, first_sample_id):
+        header = _PREFIX.pack(SIDECAR_MAGIC, SIDECAR_VERSION, len(self._channels), self._rows,
+                              first_sample_id, self._source_size, self._source_mtime)
+        header += _pack_text(self._source_path)
+        for channel, lossless in zip(self._channels, self._lossless):
+            header += _pack_text(channel.name) + _pack_text(channel.units)
+            header += _CHANNEL.pack(channel.sample_rate, 'f' if lossless else 'd')
+        return header + '\0' * _padding(len(header))
+
+    def close(self, first_sample_id):
+        """
+        Writes the sidecar. It is assembled under a temporary name and
+        renamed into place so a reader never sees a partial file
+        """
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as sidecar:
+                sidecar.write(self._header(first_sample_id))
+                for column, lossless in zip(self._columns, self._lossless):
+                    column.seek(0)
+                    size = 0
+                    while True:
+                        data = column.read(_COPY_SIZE)
+                        if not data:
+                            break
+                        values = np.frombuffer(data, dtype='<f8')
+                        data = values.astype('<f4').tostring() if lossless else data
+                        sidecar.write(data)
+                        size += len(data)
+                    sidecar.write('\0' * _padding(size))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        finally:
+            self.abort()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def abort(self):
+        for column in self._columns:
+            column.close()
+        self._columns = []
+
+class Sidecar(object):
+    """
+    A memory mapped sidecar. Channel arrays are read only views of the
+    mapping, nothing is copied until they are used
+    """
+    def __init__(self, path):
+        if np is None:
+            raise Exception("Sidecar files require numpy")
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        header = self._data[:_PREFIX.size].tostring()
+        if len(header) < _PREFIX.size:
+            raise Exception("Truncated sidecar: {}".format(path))
+        magic, version, channel_count, self.row_count, self.first_sample_id, \
+            self.source_size, self.source_mtime = _PREFIX.unpack(header)
+        if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+            raise Exception("Not a sidecar file: {}".format(path))
+
+        #The header is small, but its length is only known once parsed
+        header = self._data[:min(len(self._data), 1 << 16)].tostring()
+        self.source_path, offset = _unpack_text(header, _PREFIX.size)
+        self.channels = []
+        for i in range(channel_count):
+            name, offset = _unpack_text(header, offset)
+            units, offset = _unpack_text(header, offset)
+            sample_rate, dtype = _CHANNEL.unpack_from(header, offset)
+            offset += _CHANNEL.size
+            self.channels.append(SidecarChannel(name, units, sample_rate, '<f4' if dtype == 'f' else '<f8'))
+
+        offset += _padding(offset)
+        self._offsets = {}
+        for channel in self.channels:
+            self._offsets[channel.name] = offset
+            size = self.row_count * np.dtype(channel.dtype).itemsize
+            offset += size + _padding(size)
+        if offset > len(self._data):
+            raise Exception("Truncated sidecar: {}".format(path))
+
+    def is_current(self):
+        """
+        True while the source datalog still has the size and mtime it had
+        when the sidecar was written
+        """
+        try:
+            return _source_signature(self.source_path) == (self.source_size, self.source_mtime)
+        except OSError:
+            return False
+
+    def get(self, name):
+        channel = [x for x in self.channels if x.name == name]
+        if not channel:
+            raise Exception("Unknown channel: {}".format(name))
+        offset = self._offsets[name]
+        size = self.row_count * np.dtype(channel[0].dtype).itemsize
+        return self._data[offset:offset + size].view(channel[0].dtype)
+
+    def close(self):
+        self._data = None
+
+def open_sidecar(path):
+    """
+    Opens the sidecar at path. Returns None if there is none, or deletes
+    it and returns None if it can't be read or its source datalog changed
+    """
+    if np is None or not os.path.exists(path):
+        return None
+
+    try:
+        sidecar = Sidecar(path)
+    except Exception:
+        sidecar = None
+
+    if sidecar is None or not sidecar.is_current():
+        if sidecar:
+            sidecar.close()
+        os.remove(path)
+        return None
+
+    return sidecar
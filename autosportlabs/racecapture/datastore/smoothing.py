@@ -0,0 +1,335 @@
+#!/usr/bin/python
+"""
+Channel smoothing kernels for the DataStore
+
+Every kernel is available as a streaming smoother (create_smoother) that
+is fed a channel piece by piece and returns the smoothed values once it
+has seen enough of the following samples, and as a one shot smooth() over
+a whole array. Both produce the same values.
+
+The kernels are vectorized with numpy, without numpy only the default
+decimate + linear interpolation kernel is available
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#Decimate to every nth sample and linearly interpolate in between
+INTERP_KERNEL = 'interp'
+#Exponential moving average with a span of n samples
+EMA_KERNEL = 'ema'
+#Centered moving average over n samples
+MOVING_AVERAGE_KERNEL = 'moving_average'
+#Centered quadratic Savitzky-Golay filter over n samples
+SAVITZKY_GOLAY_KERNEL = 'savgol'
+
+KERNELS = [INTERP_KERNEL, EMA_KERNEL, MOVING_AVERAGE_KERNEL, SAVITZKY_GOLAY_KERNEL]
+
+#Block size used to vectorize the exponential moving average recurrence
+EMA_BLOCK_SIZE = 256
+
+def _get_interp_slope(start, finish, num_samples):
+    #print "Start, finish, num_samples", start, finish, num_samples
+    if start == finish:
+        return 0
+
+    return float(start - finish) / float(1 - num_samples)
+
+def _interp_dpoints(start, finish, sample_skip):
+    slope = _get_interp_slope(start, finish, sample_skip + 1)
+
+    nlist = [start]
+    for i in range(sample_skip - 1):
+        nlist.append(float(nlist[-1] + slope))
+
+    nlist.append(finish)
+
+    return nlist
+
+def _smooth_dataset(dset, smoothing_rate):
+    #Throw an error if we got a bad smoothing rate
+    if not smoothing_rate or smoothing_rate < 2:
+        raise Exception("Invalid smoothing rate")
+
+    #This is the dataset that we'll be returning
+    new_dset = []
+
+    #Get every nth sample from the dataset where n==smoothing_rate
+    dpoints = dset[0::smoothing_rate]
+
+    #A dataset shorter than the smoothing rate is all tail
+    if len(dpoints) == 1:
+        new_dset.append(dpoints[0])
+
+    #Now, loop through the target datapoints, interpolate the values
+    #between, and store them to the new dataset that we'll be
+    #returning
+    for index, val in enumerate(dpoints[:-1]):
+        #Get the start and end points of the interpolation
+        start = val
+        end = dpoints[index+1]
+
+        #Generate the smoothed dataset
+        smoothed_samples = _interp_dpoints(start, end, smoothing_rate)
+
+        #Append everything but the last datapoint in the smoothed
+        #samples to the new dataset
+        #(This will be the first item in the next dataset)
+        new_dset.extend(smoothed_samples[:-1])
+
+        #If the end was the last datapoint in the original set, append
+        #it as well
+        if index + 1 == len(dpoints) - 1:
+            new_dset.append(end)
+
+    #Now we need to smooth out the tail end of the list (if necessary)
+    if len(new_dset) < len(dset):
+        #calculate the difference in lengths between the original and
+        #new datasets
+        len_diff = len(dset) - len(new_dset)
+
+        #generate a new smoothed dataset for the missing elements
+        tail_dset = _interp_dpoints(new_dset[-1], dset[-1], len_diff)
+
+        #Extend our return list with everything but the tail of the
+        #new_dataset (as this would cause a duplicate)
+        new_dset.extend(tail_dset[1:])
+
+    return new_dset
+
+def _interp_window(values, rate):
+    """
+    Vectorized equivalent of _smooth_dataset: every rate-th sample is
+    kept and the samples in between (and the tail) are interpolated
+    """
+    count = len(values)
+    if count < 2:
+        return values.copy()
+
+    smoothed = np.empty(count)
+
+    #Interpolate between every pair of anchors at once, one row per pair
+    intervals = (count - 1) // rate
+    anchors = values[0:intervals * rate + 1:rate]
+    steps = np.arange(rate) / float(rate)
+    smoothed[:intervals * rate].reshape(intervals, rate)[:] = \
+        anchors[:-1, None] + (anchors[1:] - anchors[:-1])[:, None] * steps[None, :]
+
+    #Then from the last anchor out to the last sample
+    last = intervals * rate
+    tail = count - last
+    smoothed[last:] = values[last] + (values[-1] - values[last]) * \
+        (np.arange(tail) / float(max(tail - 1, 1)))
+    return smoothed
+
+def _moving_average_window(values, half):
+    """
+    Centered moving average, the window shrinks at the edges. NaN values
+    are gaps: each average is taken over the values present in its
+    window, and the gaps stay NaN
+    """
+    count = len(values)
+    valid = ~np.isnan(values)
+    #Running sums of the values present and of how many there are, a gap
+    #only drops out of the windows it is in
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    index = np.arange(count)
+    low = np.maximum(index - half, 0)
+    high = np.minimum(index + half, count - 1) + 1
+    present = counts[high] - counts[low]
+    smoothed = (sums[high] - sums[low]) / np.maximum(present, 1)
+    smoothed[~valid | (present == 0)] = np.nan
+    return smoothed
+
+def _savgol_coefficients(half, order):
+    positions = np.arange(-half, half + 1, dtype=np.float64)
+    return np.linalg.pinv(np.vander(positions, order + 1, increasing=True))
+
+def _savgol_window(values, half, order=2):
+    """
+    Savitzky-Golay filter: a least squares polynomial fit over each
+    window of 2*half+1 samples. The edges are evaluated from the fit of
+    the first and last full window
+    """
+    count = len(values)
+    window = 2 * half + 1
+    if count < window:
+        #Not even one full window, fit everything we have
+        order = min(order, count - 1)
+        positions = np.arange(count, dtype=np.float64)
+        fit = np.linalg.lstsq(np.vander(positions, order + 1, increasing=True), values, rcond=-1)[0]
+        return np.vander(positions, order + 1, increasing=True).dot(fit)
+
+    order = min(order, window - 2)
+    coefficients = _savgol_coefficients(half, order)
+    smoothed = np.empty(count)
+    smoothed[half:count - half] = np.convolve(values, coefficients[0][::-1], 'valid')
+
+    #Evaluate the fits of the first and last window at their edges
+    head = np.vander(np.arange(-half, 0, dtype=np.float64), order + 1, increasing=True)
+    tail = np.vander(np.arange(1, half + 1, dtype=np.float64), order + 1, increasing=True)
+    smoothed[:half] = head.dot(coefficients.dot(values[:window]))
+    smoothed[count - half:] = tail.dot(coefficients.dot(values[count - window:]))
+    return smoothed
+
+def _ema_weights(alpha):
+    """
+    Returns the weights of each input of a block on each output of the
+    block, and the decay of the value carried into the block
+    """
+    index = np.arange(EMA_BLOCK_SIZE)
+    lag = index[:, None] - index[None, :]
+    weights = np.where(lag >= 0, alpha * (1.0 - alpha) ** np.maximum(lag, 0), 0.0)
+    decay = (1.0 - alpha) ** (index + 1)
+    return weights, decay
+
+def _ema(values, weights, decay, previous):
+    """
+    Exponential moving average y[n] = alpha * x[n] + (1 - alpha) * y[n-1]
+    The recurrence is solved EMA_BLOCK_SIZE samples at a time with a
+    matrix product, only the carry between blocks is sequential. NaN
+    values are gaps: they stay NaN and the average carries across them
+    """
+    valid = ~np.isnan(values)
+    if not valid.all():
+        smoothed = np.empty(len(values))
+        smoothed.fill(np.nan)
+        smoothed[valid] = _ema(values[valid], weights, decay, previous)
+        return smoothed
+
+    count = len(values)
+    if not count:
+        return np.empty(0)
+    block = EMA_BLOCK_SIZE
+    blocks = (count + block - 1) // block
+    padded = np.zeros(blocks * block)
+    padded[:count] = values
+
+    #Each block as if it started from zero, then add in the carry
+    local = padded.reshape(blocks, block).dot(weights.T)
+    carry = np.empty(blocks)
+    for b in range(blocks):
+        carry[b] = previous
+        previous = local[b, -1] + decay[-1] * previous
+
+    smoothed = local + decay[None, :] * carry[:, None]
+    return smoothed.ravel()[:count]
+
+class _InterpSmoother(object):
+    """
+    Values are held back until the next smoothing anchor (every 'rate'
+    samples) has arrived, so the output is identical to smoothing the
+    whole channel in one go
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lookahead = rate
+        self._pending = [] if np is None else np.empty(0)
+
+    def _smooth(self, values):
+        if np is None:
+            return _smooth_dataset(values, self.rate)
+        return _interp_window(values, self.rate)
+
+    def _append(self, values):
+        if np is None:
+            self._pending.extend(values)
+        else:
+            self._pending = np.concatenate((self._pending, np.asarray(values, dtype=np.float64)))
+
+    def process(self, values, final=False):
+        self._append(values)
+        pending = self._pending
+
+        if final:
+            self._pending = pending[:0]
+            return self._smooth(pending)
+
+        #Smooth up to the last anchor we have, and keep that anchor
+        #around as the start of the next window
+        anchor = (len(pending) - 1) // self.rate * self.rate
+        if anchor <= 0:
+            return pending[:0]
+
+        self._pending = pending[anchor:]
+        return self._smooth(pending[:anchor + 1])[:-1]
+
+class _ExponentialSmoother(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.lookahead = 0
+        self._weights, self._decay = _ema_weights(2.0 / (rate + 1))
+        self._previous = None
+
+    def process(self, values, final=False):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return values
+
+        present = values[~np.isnan(values)]
+        if not len(present):
+            return values.copy()
+        if self._previous is None:
+            self._previous = present[0]
+        smoothed = _ema(values, self._weights, self._decay, self._previous)
+        #The last value present is carried into the next call
+        self._previous = smoothed[~np.isnan(values)][-1]
+        return smoothed
+
+class _WindowedSmoother(object):
+    """
+    Runs a centered window kernel over a stream. The last 2*half samples
+    already returned are kept as history and values are returned once
+    half samples past them have arrived
+    """
+    def __init__(self, rate, window_fn):
+        self.rate = rate
+        self.half = max(rate // 2, 1)
+        self.lookahead = self.half
+        self._window_fn = window_fn
+        self._buffer = np.empty(0)
+        self._history = 0
+
+    def process(self, values, final=False):
+        buf = np.concatenate((self._buffer, np.asarray(values, dtype=np.float64)))
+        end = len(buf) if final else max(len(buf) - self.half, self._history)
+        #The head of the stream needs a full window before it can be fitted
+        if end <= self._history or (not final and len(buf) < 2 * self.half + 1):
+            self._buffer = buf
+            return buf[:0]
+
+        smoothed = self._window_fn(buf, self.half)[self._history:end]
+
+        keep = min(2 * self.half, end)
+        self._buffer = buf[end - keep:]
+        self._history = keep
+        return smoothed
+
+def create_smoother(rate, kernel=INTERP_KERNEL):
+    """
+    Returns a streaming smoother for the kernel. process(values, final)
+    returns the smoothed values that are ready, lagging at most
+    'lookahead' samples behind the input until final is set
+    """
+    if not kernel in KERNELS:
+        raise Exception("Unknown smoothing kernel: {}".format(kernel))
+    if not rate or rate < 2:
+        raise Exception("Invalid smoothing rate")
+    if np is None and kernel != INTERP_KERNEL:
+        raise Exception("Smoothing kernel {} requires numpy".format(kernel))
+
+    if kernel == EMA_KERNEL:
+        return _ExponentialSmoother(rate)
+    if kernel == MOVING_AVERAGE_KERNEL:
+        return _WindowedSmoother(rate, _moving_average_window)
+    if kernel == SAVITZKY_GOLAY_KERNEL:
+        return _WindowedSmoother(rate, _savgol_window)
+    return _InterpSmoother(rate)
+
+def smooth(values, rate, kernel=INTERP_KERNEL):
+    """
+    Smooths a whole channel in one go
+    """
+    return create_smoother(rate, kernel).process(values, final=True)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""
+Background compaction of DataStore databases
+
+Deleting a session frees its pages inside the database file, they aren't
+handed back to the file system. Databases created by DataStore.new() use
+auto_vacuum=INCREMENTAL, which lets PRAGMA incremental_vacuum release
+free pages a few at a time. The VacuumScheduler does that on a thread of
+its own, through its own connection, in short steps with a pause between
+them: each step is a small write transaction, so imports, recordings and
+queries carry on in between, and a step that finds the database busy is
+simply tried again later. Nothing ever waits on it.
+"""
+import logging
+import sqlite3
+import threading
+
+#Free pages released per step
+VACUUM_STEP_PAGES = 256
+
+#Seconds between steps
+VACUUM_STEP_INTERVAL = 0.05
+
+#Seconds to wait before trying again when the database is busy
+VACUUM_BUSY_DELAY = 1.0
+
+#PRAGMA auto_vacuum value of an incrementally vacuumed database
+_INCREMENTAL = 2
+
+class VacuumScheduler(object):
+    """
+    Releases the free pages of a database file in the background
+    """
+    def __init__(self, name, step_pages=VACUUM_STEP_PAGES, step_interval=VACUUM_STEP_INTERVAL,
+                 busy_delay=VACUUM_BUSY_DELAY):
+        self.name = name
+        self.step_pages = step_pages
+        self.step_interval = step_interval
+        self.busy_delay = busy_delay
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._requested = False
+        self._stopping = False
+        self._thread = None
+
+    def request(self):
+        """
+        Asks for the free pages to be released, returns right away
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            self._requested = True
+            self._idle.clear()
+            self._wake.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='DataStore vacuum')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the requested vacuuming to finish, returns whether it did
+        """
+        self._idle.wait(timeout)
+        return self._idle.is_set()
+
+    def stop(self):
+        """
+        Stops the background thread, after the step in progress if any
+        """
+        with self._lock:
+            self._stopping = True
+            self._wake.set()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _sleep(self, seconds):
+        #Cut short by stop()
+        self._wake.clear()
+        if not self._stopping:
+            self._wake.wait(seconds)
+
+    def _run(self):
+        #No busy timeout: a step that can't get the write lock right away
+        #makes way for the writer and is tried again later
+        conn = sqlite3.connect(self.name, timeout=0)
+        try:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != _INCREMENTAL:
+                logging.info("VacuumScheduler: {} is not incrementally vacuumed".format(self.name))
+                with self._lock:
+                    self._stopping = True
+                return
+
+            while not self._stopping:
+                with self._lock:
+                    if self._stopping:
+                        break
+                    if not self._requested:
+                        self._idle.set()
+                        self._wake.clear()
+                    self._requested = False
+                if self._idle.is_set():
+                    self._wake.wait()
+                    continue
+                self._vacuum(conn)
+        finally:
+            conn.close()
+            self._idle.set()
+
+    def _vacuum(self, conn):
+        """
+        Releases free pages a step at a time until there are none left
+        """
+        while not self._stopping:
+            try:
+                if not conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                    break
+                #The pragma does its work as its rows are stepped through
+                conn.execute('PRAGMA incremental_vacuum({})'.format(int(self.step_pages))).fetchall()
+                conn.commit()
+            except sqlite3.OperationalError as e:
+                #Busy, another connection is writing
+                logging.debug("VacuumScheduler: {}, trying again".format(e))
+                self._sleep(self.busy_delay)
+                continue
+            self._sleep(self.step_interval)
+
+        if not self._stopping:
+            #In WAL mode the file only shrinks once the WAL is checkpointed
+            try:
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+            except sqlite3.OperationalError as e:
+                logging.debug("VacuumScheduler: checkpoint skipped: {}".format(e))
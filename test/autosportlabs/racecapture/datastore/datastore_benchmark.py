@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Import and query benchmarks for the DataStore, run against a synthetic
+datalog so runs with different channel counts, sample rates and
+durations can be compared. Results are written as JSON; a previous
+results file can be given with --compare to flag scenarios that got
+slower.
+
+usage: python -m test.autosportlabs.racecapture.datastore.datastore_benchmark
+           [--channels N] [--rates 1,10,50] [--duration SECONDS]
+           [--storage row|columnar|compressed|sparse] [--runs N]
+           [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from autosportlabs.racecapture.datastore.datastore import DataStore, Filter, \
+    ROW_STORAGE, STORAGE_LAYOUTS
+
+DEFAULT_CHANNELS = 20
+DEFAULT_RATES = [1, 10, 50]
+DEFAULT_DURATION = 600
+DEFAULT_RUNS = 3
+
+#Sample rate of the GPS and lap channels
+TRACK_RATE = 10
+
+#Seconds per lap of the synthetic track
+LAP_DURATION = 90.0
+
+#Scenarios slower than the baseline by more than this fraction are regressions
+REGRESSION_TOLERANCE = 0.2
+
+#Records fetched at a time by the query scenarios
+FETCH_SIZE = 10000
+
+def _channel_names(channel_count):
+    return ['Channel{}'.format(i) for i in range(channel_count)]
+
+def write_datalog(path, channel_count=DEFAULT_CHANNELS, rates=DEFAULT_RATES,
+                  duration=DEFAULT_DURATION, seed=0):
+    """
+    Writes a synthetic RaceCapture datalog: ts, lap and GPS channels plus
+    channel_count random walk channels with sample rates taken in turn
+    from rates. Every row is one tick of the fastest rate, channels not
+    sampled on a tick are left blank, as the logger does
+
+    :returns: the number of rows written
+    """
+    names = _channel_names(channel_count)
+    channel_rates = [rates[i % len(rates)] for i in range(channel_count)]
+    tick_rate = max(channel_rates + [TRACK_RATE])
+    rng = random.Random(seed)
+    values = [rng.uniform(0, 100) for x in names]
+
+    headers = ['"ts"|"ms"|{}'.format(tick_rate),
+               '"LapCount"|""|{}'.format(TRACK_RATE), '"LapTime"|"seconds"|{}'.format(TRACK_RATE),
+               '"Latitude"|"deg"|{}'.format(TRACK_RATE), '"Longitude"|"deg"|{}'.format(TRACK_RATE)]
+    headers += ['"{}"|"units"|{}'.format(name, rate) for name, rate in zip(names, channel_rates)]
+
+    rows = int(duration * tick_rate)
+    with open(path, 'wb') as f:
+        f.write(','.join(headers) + '\r\n')
+        for tick in range(rows):
+            seconds = float(tick) / tick_rate
+            record = [str(int(seconds * 1000))]
+
+            if tick % (tick_rate // TRACK_RATE) == 0:
+                lap, lap_seconds = divmod(seconds, LAP_DURATION)
+                angle = 2 * math.pi * lap_seconds / LAP_DURATION
+                record += [str(int(lap)), '{:.3f}'.format(LAP_DURATION / 60.0 if lap else 0),
+                           '{:.6f}'.format(47.25 + 0.005 * math.sin(angle)),
+                           '{:.6f}'.format(-123.19 + 0.005 * math.cos(angle))]
+            else:
+                record += [''] * 4
+
+            for i, rate in enumerate(channel_rates):
+                if tick % (tick_rate // rate) == 0:
+                    values[i] += rng.uniform(-1, 1)
+                    record.append('{:.2f}'.format(values[i]))
+                else:
+                    record.append('')
+            f.write(','.join(record) + '\r\n')
+    return rows
+
+def _best_of(fn, runs):
+    best = None
+    result = None
+    for i in range(runs):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def _fetch_count(dataset):
+    count = 0
+    while True:
+        records = dataset.fetch_records(FETCH_SIZE)
+        if not records:
+            return count
+        count += len(records)
+
+def _median_read(ds, channel, reads=None, while_alive=None):
+    """
+    Times a 10 second window query of channel, reads times or, at least
+    once, as long as the while_alive thread runs, and returns the median
+    time and the number of reads
+    """
+    times = []
+    while not times or (while_alive.is_alive() if while_alive else len(times) < reads):
+        start = time.time()
+        _fetch_count(ds.query(channels=[channel], start_ms=60000, end_ms=70000))
+        times.append(time.time() - start)
+        #Leave the import thread its share of the interpreter
+        time.sleep(0.005)
+    times.sort()
+    return times[len(times) // 2], len(times)
+
+def run(channel_count=DEFAULT_CHANNELS, rates=DEFAULT_RATES, duration=DEFAULT_DURATION,
+        storage=ROW_STORAGE, runs=DEFAULT_RUNS):
+    """
+    Runs every scenario and returns the results as a dict of the
+    benchmark configuration and, per scenario, the best time in seconds
+    and the rows it handled
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(work_dir, 'synthetic.log')
+        rows = write_datalog(log_path, channel_count, rates, duration)
+        names = _channel_names(channel_count)
+        results = {}
+
+        def record(name, elapsed, row_count):
+            results[name] = {'seconds': elapsed, 'rows': row_count,
+                             'rows_per_sec': row_count / elapsed if elapsed else None}
+
+        def import_once():
+            db_path = os.path.join(work_dir, 'import.sql3')
+            for path in [db_path, db_path + '-wal', db_path + '-shm']:
+                if os.path.exists(path):
+                    os.remove(path)
+            ds = DataStore()
+            ds.new(db_path, storage=storage)
+            try:
+                ds.import_datalog(log_path, 'benchmark')
+            finally:
+                ds.close()
+            return db_path
+        elapsed, db_path = _best_of(import_once, runs)
+        record('import', elapsed, rows)
+
+        ds = DataStore()
+        ds.open_db(db_path)
+        try:
+            query_channels = ['ts'] + names
+            elapsed, count = _best_of(lambda: _fetch_count(ds.query(channels=query_channels)), runs)
+            record('full_scan', elapsed, count)
+
+            data_filter = Filter().gt(names[0], ds.get_channel_average(names[0])).and_().lt('LapCount', 3)
+            elapsed, count = _best_of(
+                lambda: _fetch_count(ds.query(channels=query_channels, data_filter=data_filter)), runs)
+            record('filtered_query', elapsed, count)
+
+            elapsed, count = _best_of(
+                lambda: len([(ds.get_channel_min(x), ds.get_channel_max(x)) for x in names]), runs)
+            record('min_max', elapsed, count)
+
+            ds.set_channel_smoothing(names[0], 10)
+            elapsed, count = _best_of(lambda: _fetch_count(ds.query(channels=[names[0]])), runs)
+            record('smoothing', elapsed, count)
+
+            #Reads while another import writes, against reads on their own;
+            #WAL mode should keep them close
+            ds.set_channel_smoothing(names[0], 1)
+            ds.set_result_cache_size(0)
+            elapsed, count = _median_read(ds, names[0], reads=50)
+            record('window_read', elapsed, count)
+            #An import of the same file would be found already imported
+            concurrent_path = os.path.join(work_dir, 'concurrent.log')
+            write_datalog(concurrent_path, channel_count, rates, duration, seed=1)
+            writer = threading.Thread(target=ds.import_datalog, args=(concurrent_path, 'concurrent'))
+            writer.start()
+            elapsed, count = _median_read(ds, names[0], while_alive=writer)
+            writer.join()
+            record('window_read_during_import', elapsed, count)
+        finally:
+            ds.close()
+
+        config = {'channels': channel_count, 'rates': rates, 'duration': duration,
+                  'storage': storage, 'runs': runs, 'rows': rows}
+        return {'config': config, 'results': results}
+    finally:
+        shutil.rmtree(work_dir)
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Returns the names of the scenarios that took longer than in baseline
+    by more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous and result['seconds'] > previous['seconds'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='DataStore benchmarks')
+    parser.add_argument('--channels', type=int, default=DEFAULT_CHANNELS, help='Synthetic channels')
+    parser.add_argument('--rates', default=','.join(str(x) for x in DEFAULT_RATES),
+                        help='Comma separated sample rates, in Hz, assigned to channels in turn')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='Datalog duration in seconds')
+    parser.add_argument('--storage', default=ROW_STORAGE,
+                        choices=STORAGE_LAYOUTS)
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help='Runs per scenario, the best is kept')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='Baseline JSON results to check for regressions')
+    args = parser.parse_args(argv)
+
+    #The datastore prints as it imports, keep stdout for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = run(args.channels, [int(x) for x in args.rates.split(',')], args.duration,
+                      args.storage, args.runs)
+    finally:
+        sys.stdout = stdout
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for name in regressions:
+            sys.stderr.write('REGRESSION: {}\n'.format(name))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""
+Compares the vectorized smoothing kernels against the original list based
+_smooth_dataset on a single long channel
+
+usage: python -m test.autosportlabs.racecapture.datastore.smoothing_benchmark [points] [rate]
+"""
+import sys
+import time
+import numpy as np
+from autosportlabs.racecapture.datastore.smoothing import smooth, _smooth_dataset, \
+    KERNELS, INTERP_KERNEL
+
+def _best_of(fn, runs=3):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(points=1000000, rate=10):
+    values = np.cumsum(np.random.RandomState(0).uniform(-1, 1, points))
+    value_list = values.tolist()
+
+    baseline = _best_of(lambda: _smooth_dataset(value_list, rate), runs=1)
+    print '{} points, smoothing rate {}'.format(points, rate)
+    print '{:<16}{:>10.1f} ms'.format('_smooth_dataset', baseline * 1000.0)
+
+    results = {}
+    for kernel in KERNELS:
+        elapsed = _best_of(lambda: smooth(values, rate, kernel))
+        results[kernel] = baseline / elapsed
+        print '{:<16}{:>10.1f} ms {:>8.1f}x'.format(kernel, elapsed * 1000.0, baseline / elapsed)
+
+    return results
+
+if __name__ == '__main__':
+    points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    results = run(points, rate)
+    if results[INTERP_KERNEL] < 20:
+        print 'WARNING: interp kernel is less than 20x faster than _smooth_dataset'
+        sys.exit(1)
@@ -0,0 +1,47 @@
+import unittest
+import os
+import tempfile
+from autosportlabs.racecapture.datastore.datastore import DataStore
+from test.autosportlabs.racecapture.datastore.datastore_benchmark import write_datalog, run, compare
+
+class BenchmarkTest(unittest.TestCase):
+    def test_synthetic_datalog(self):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        ds = DataStore()
+        try:
+            rows = write_datalog(path, channel_count=5, rates=[1, 10, 50], duration=200)
+            self.assertEqual(rows, 10000)
+
+            ds.new()
+            ds.import_datalog(path, 'synthetic')
+            max_rate = ds._conn.execute("SELECT max_sample_rate FROM datalog_info").fetchone()[0]
+            self.assertEqual(max_rate, 50)
+
+            records = ds.query(channels=['ts', 'LapCount', 'Channel0']).fetch_records(rows)
+            self.assertEqual(len(records), rows)
+            self.assertEqual(records[-1][0], 199980)
+            self.assertEqual(records[-1][1], 2)
+            #1Hz channel is carried forward between samples
+            changes = [i for i in range(1, rows) if records[i][2] != records[i - 1][2]]
+            self.assertTrue(len(changes) > 100)
+            self.assertTrue(all(i % 50 == 0 for i in changes))
+
+            laps = ds._conn.execute("SELECT COUNT(*) FROM lap").fetchone()[0]
+            self.assertEqual(laps, 3)
+        finally:
+            ds.close()
+            os.remove(path)
+
+    def test_run_and_compare(self):
+        results = run(channel_count=3, rates=[10], duration=30, runs=1)
+        self.assertEqual(sorted(results['results'].keys()),
+                         ['filtered_query', 'full_scan', 'import', 'min_max', 'smoothing',
+                          'window_read', 'window_read_during_import'])
+        self.assertEqual(results['results']['full_scan']['rows'], 300)
+        self.assertEqual(compare(results, results), [])
+
+        baseline = {'results': dict((name, {'seconds': result['seconds'] / 2})
+                                    for name, result in results['results'].items()
+                                    if result['seconds'])}
+        self.assertEqual(compare(results, baseline), sorted(baseline['results'].keys()))
@@ -0,0 +1,67 @@
+import unittest
+import os.path
+import time
+from autosportlabs.racecapture.datastore.datastore import _desparsify_blocks, np
+from autosportlabs.racecapture.datastore.codec import encode, decode, _HEADER, \
+    RAW_ENCODING, DELTA_ENCODING, ZLIB_FLAG
+
+fqp = os.path.dirname(os.path.realpath(__file__))
+log_path = os.path.join(fqp, 'rc_adj.log')
+
+@unittest.skipIf(np is None, "the codec requires numpy")
+class CodecTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        with open(log_path, 'rb') as data_file:
+            data_file.readline()
+            self.blocks = list(_desparsify_blocks(data_file))
+
+    def _encoding(self, data):
+        return _HEADER.unpack_from(data)[0] & ~ZLIB_FLAG
+
+    def _check(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        data = encode(values)
+        decoded = decode(data)
+        self.assertEqual(decoded.dtype, np.float64)
+        self.assertEqual(len(decoded), len(values))
+        self.assertTrue(((decoded == values) | (np.isnan(decoded) & np.isnan(values))).all())
+        return data
+
+    def test_round_trip(self):
+        for values in [[], [1.5], [0, 0, 0, 0], [1, 2, 3, 4, 5, 100, -100],
+                       [-1.25, -1.25, 3.5, 3.5, 3.5, 3.75], [0.1, 0.2, 0.3],
+                       [2 ** 40, -2 ** 40, 7], [34.123456789, 34.123456788]]:
+            data = self._check(values)
+            if values:
+                self.assertEqual(self._encoding(data), DELTA_ENCODING)
+
+    def test_run_lengths(self):
+        values = np.repeat(np.arange(100) * 0.5, 50)
+        data = self._check(values)
+        self.assertTrue(len(data) < 100)
+
+    def test_raw_fallback(self):
+        for values in [[1.0, float('nan'), 2.0], [1.0 / 3, 2.0 / 3], [1e300, 1.0]]:
+            data = self._check(values)
+            self.assertEqual(self._encoding(data), RAW_ENCODING)
+
+    def test_datalog_round_trip(self):
+        raw_size = 0
+        size = 0
+        for block in self.blocks:
+            for i in range(block.shape[1]):
+                data = self._check(block[:, i])
+                raw_size += block.shape[0] * 8
+                size += len(data)
+        self.assertTrue(float(raw_size) / size >= 5)
+
+    def test_decode_speed(self):
+        chunks = [encode(block[:, i]) for block in self.blocks for i in range(block.shape[1])]
+        count = sum(block.size for block in self.blocks)
+        start = time.time()
+        for chunk in chunks:
+            decode(chunk)
+        elapsed = time.time() - start
+        #Loose bound, the figure on a desktop is several tens of millions
+        self.assertTrue(count / elapsed > 5e6)
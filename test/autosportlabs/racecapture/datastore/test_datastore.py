@@ -1,12 +1,78 @@
 import unittest
+import hashlib
+import multiprocessing
 import os, os.path
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 from autosportlabs.racecapture.datastore.datastore import DataStore, Filter, \
-    DataSet, _interp_dpoints, _smooth_dataset
+    DataSet, _interp_dpoints, _smooth_dataset, _desparsify_blocks, _distance_m, \
+    ROW_STORAGE, COLUMNAR_STORAGE, COMPRESSED_STORAGE, SPARSE_STORAGE, SESSION_ID_BLOCK, \
+    RESULT_VALUE_BYTES, IMPORT_CHUNK_SIZE, np
+import autosportlabs.racecapture.datastore.datastore as datastore_module
+from autosportlabs.racecapture.datastore.smoothing import smooth, EMA_KERNEL
+from autosportlabs.racecapture.geo.geopoint import GeoPoint
 
 fqp = os.path.dirname(os.path.realpath(__file__))
 db_path = os.path.join(fqp, 'rctest.sql3')
 log_path = os.path.join(fqp, 'rc_adj.log')
 
+def _reference_desparsify(path):
+    """
+    Straightforward carry forward / back fill of a whole datalog, used to
+    check the block based desparsifier
+    """
+    with open(path, 'rb') as f:
+        f.readline()
+        rows = [[None if x == '' else float(x) for x in l.strip().split(',')]
+                for l in f if l.strip()]
+
+    for c in range(len(rows[0])):
+        last = next(r[c] for r in rows if r[c] is not None)
+        for r in rows:
+            if r[c] is None:
+                r[c] = last
+            last = r[c]
+    return rows
+
+def _copy_log(path):
+    """
+    Copies a datalog with a trailing blank line, so it holds the same
+    records but isn't recognized as the same file
+    """
+    fd, copy_path = tempfile.mkstemp(suffix='.log')
+    with os.fdopen(fd, 'wb') as f:
+        with open(path, 'rb') as source:
+            f.write(source.read())
+        f.write('\r\n')
+    return copy_path
+
+def _desparsified_rows(path, block_size):
+    with open(path, 'rb') as f:
+        f.readline()
+        rows = []
+        for block in _desparsify_blocks(f, block_size):
+            rows.extend(block.tolist() if hasattr(block, 'tolist') else block)
+    return rows
+
+class DesparsifyTest(unittest.TestCase):
+    def test_matches_reference(self):
+        expected = _reference_desparsify(log_path)
+        #Small and large blocks exercise the carry between blocks as
+        #well as the back fill held across several pending blocks
+        for block_size in [7, 500, 100000]:
+            rows = _desparsified_rows(log_path, block_size)
+            self.assertEqual(len(rows), len(expected))
+            self.assertEqual(rows, expected)
+
+    def test_trailing_rows_flushed(self):
+        with open(log_path, 'rb') as f:
+            line_count = len([l for l in f if l.strip()]) - 1
+
+        self.assertEqual(len(_desparsified_rows(log_path, 1000)), line_count)
+
 #NOTE! that
 class DataStoreTest(unittest.TestCase):
     @classmethod
@@ -22,6 +88,9 @@ class DataStoreTest(unittest.TestCase):
     def tearDownClass(self):
         self.ds.close()
         os.remove(db_path)
+        sidecar_path = self.ds._get_sidecar_path(1)
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
 
     def test_aaa_valid_import(self):
         #HACK
@@ -43,6 +112,27 @@ class DataStoreTest(unittest.TestCase):
 
         self.assertEqual(success, True)
 
+    def test_import_progress(self):
+        ds = DataStore()
+        ds.new()
+        progress = []
+        ds.import_datalog(log_path, 'rc_adj',
+                          progress_listener=lambda pct, rate: progress.append((pct, rate)))
+
+        #One callback per committed chunk, ending with the whole file
+        self.assertTrue(len(progress) > 1)
+        self.assertAlmostEqual(progress[-1][0], 100.0, places=0)
+        self.assertTrue(all(rate > 0 for pct, rate in progress))
+
+        #Sample IDs are handed out contiguously in memory
+        c = ds._conn.cursor()
+        c.execute("SELECT COUNT(*), MIN(sample_id), MAX(sample_id) FROM datapoint_1")
+        count, min_id, max_id = c.fetchone()
+        self.assertEqual(min_id, 1)
+        self.assertEqual(max_id, count)
+        self.assertEqual(ds._get_session_range(1), (1, count))
+        ds.close()
+
     def test_basic_filter(self):
         f = Filter().lt('LapCount', 1)
 
@@ -67,6 +157,45 @@ class DataStoreTest(unittest.TestCase):
 
         self.assertSequenceEqual(filter_text, expected_output)
 
+    def test_compiled_filter(self):
+        f = Filter().lt('LapCount', 1).group(Filter().gt('Coolant', 212).or_().gt('RPM', 9000))
+        sql, params = f.compile()
+
+        self.assertEqual(sql.strip(), 'datapoint.LapCount < ? AND (datapoint.Coolant > ? OR datapoint.RPM > ?)')
+        self.assertEqual(params, [1, 212, 9000])
+
+        #Same structure with different values has the same shape
+        same = Filter().lt('LapCount', 5).group(Filter().gt('Coolant', 100).or_().gt('RPM', 1))
+        other = Filter().lt('LapCount', 5).group(Filter().gt('Coolant', 100).gt('RPM', 1))
+        self.assertEqual(f.shape, same.shape)
+        self.assertEqual(hash(f.shape), hash(same.shape))
+        self.assertNotEqual(f.shape, other.shape)
+
+    def test_query_cache(self):
+        ds = DataStore()
+        ds.new()
+        ds.import_datalog(log_path, 'rc_adj')
+
+        for lap in range(1, 6):
+            records = ds.query(channels=['RPM', 'Speed'],
+                               data_filter=Filter().eq('LapCount', lap)).fetch_records(10)
+            self.assertEqual(len(records), 10)
+
+        stats = ds.get_query_cache_stats()
+        self.assertEqual(stats['statements']['misses'], 1)
+        self.assertEqual(stats['statements']['hits'], 4)
+        self.assertEqual(stats['channel_metadata']['hits'], 4)
+        self.assertAlmostEqual(stats['statements']['hit_rate'], 0.8)
+
+        #Changing smoothing drops the cached channel metadata
+        ds.set_channel_smoothing('RPM', 4)
+        dataset = ds.query(channels=['RPM', 'Speed'], data_filter=Filter().eq('LapCount', 1))
+        self.assertEqual(dataset._smoothing_map['RPM'], 4)
+        self.assertEqual(ds.get_query_cache_stats()['channel_metadata']['misses'], 2)
+
+        self.assertRaises(Exception, ds.query, ['RPM'], Filter().eq('RPM; DROP TABLE sample', 1))
+        ds.close()
+
     def test_dataset_columns(self):
         f = Filter().lt('LapCount', 1)
         dataset = self.ds.query(channels=['Coolant', 'RPM', 'MAP'],
@@ -100,13 +229,182 @@ class DataStoreTest(unittest.TestCase):
 
         self.assertEqual(len(records), 100)
 
+    def test_dataset_chunked_smoothing(self):
+        f = Filter().lt('LapCount', 3)
+        raw = self.ds.query(channels=['RPM', 'Speed'], data_filter=f).fetch_columns(100000)
+        expected = smooth(raw['RPM'], 7)
+        expected = expected.tolist() if hasattr(expected, 'tolist') else expected
+        for a, b in zip(expected, _smooth_dataset(raw['RPM'], 7)):
+            self.assertAlmostEqual(a, b)
+
+        self.ds.set_channel_smoothing('RPM', 7)
+        try:
+            for chunk_size in [1, 5, 100, 333]:
+                dataset = self.ds.query(channels=['RPM', 'Speed'], data_filter=f)
+                rpm = []
+                speed = []
+                for chunk in dataset.iter_chunks(chunk_size):
+                    self.assertTrue(len(chunk['RPM']) <= chunk_size)
+                    self.assertEqual(len(chunk['RPM']), len(chunk['Speed']))
+                    rpm.extend(chunk['RPM'])
+                    speed.extend(chunk['Speed'])
+                self.assertEqual(rpm, expected)
+                self.assertEqual(speed, raw['Speed'])
+        finally:
+            self.ds.set_channel_smoothing('RPM', 1)
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_dataset_arrays(self):
+        f = Filter().lt('LapCount', 3)
+        columns = self.ds.query(channels=['RPM', 'Speed'], data_filter=f).fetch_columns(100000)
+
+        dataset = self.ds.query(channels=['RPM', 'Speed'], data_filter=f)
+        head = dataset.fetch_arrays(10)
+        self.assertEqual(head['RPM'].dtype, np.float64)
+        self.assertEqual(head['RPM'].tolist(), columns['RPM'][:10])
+
+        rest = dataset.fetch_all()
+        self.assertEqual(len(rest['Speed']), len(columns['Speed']) - 10)
+        self.assertEqual(rest['Speed'].tolist(), columns['Speed'][10:])
+        self.assertTrue(rest['Speed'].flags['C_CONTIGUOUS'])
+        self.assertEqual(len(dataset.fetch_all()['RPM']), 0)
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_dataset_blanks(self):
+        def dataset():
+            c = sqlite3.connect(':memory:').cursor()
+            c.execute("""WITH RECURSIVE r(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM r WHERE x < 24999)
+            SELECT x * 1.0 AS a, CASE WHEN x % 3 THEN x * 2.0 END AS b FROM r""")
+            return DataSet(c, row_count=lambda: 25000)
+
+        records = dataset().fetch_records(30000)
+        self.assertEqual(records[:4], [(0.0, None), (1.0, 2.0), (2.0, 4.0), (3.0, None)])
+
+        #Arrays are filled from the rows as float64, blanks as NaN,
+        #without going through lists
+        as_list = datastore_module._as_list
+        datastore_module._as_list = None
+        try:
+            data = dataset()
+            arrays = data.fetch_all()
+            self.assertEqual(data._buffers['b'].dtype, np.float64)
+        finally:
+            datastore_module._as_list = as_list
+        self.assertEqual(len(arrays['a']), 25000)
+        self.assertTrue(np.isnan(arrays['b'][::3]).all())
+        self.assertEqual(arrays['b'][1:3].tolist(), [2.0, 4.0])
+
+    def test_lap_index(self):
+        c = self.ds._conn.cursor()
+        c.execute("""SELECT lap, start_sample_id, end_sample_id, lap_time FROM lap
+        ORDER BY lap""")
+        laps = c.fetchall()
+        self.assertEqual(len(laps), 38)
+        self.assertEqual(laps[1], (1, 1025, 1699, 2.257))
+        self.assertEqual(laps[2][1], 1700)
+        #The last lap never completed
+        self.assertEqual(laps[-1][3], None)
+        for prev, lap in zip(laps, laps[1:]):
+            self.assertEqual(lap[1], prev[2] + 1)
+
+    def test_query_lap(self):
+        for lap in [0, 1, 12, 37]:
+            expected = self.ds.query(channels=['RPM', 'LapCount'],
+                                     data_filter=Filter().eq('LapCount', lap)).fetch_records(100000)
+            records = self.ds.query_lap(1, lap, channels=['RPM', 'LapCount']).fetch_records(100000)
+            self.assertEqual(records, expected)
+
+        f = Filter().gt('RPM', 5000)
+        expected = self.ds.query(channels=['RPM'],
+                                 data_filter=Filter().eq('LapCount', 3).and_().gt('RPM', 5000)).fetch_records(100000)
+        self.assertEqual(self.ds.query_lap(1, 3, channels=['RPM'], data_filter=f).fetch_records(100000), expected)
+
+        self.assertRaises(Exception, self.ds.query_lap, 1, 99, ['RPM'])
+
+    def test_time_window(self):
+        channels = ['ts', 'RPM']
+        expected = self.ds.query(channels=channels,
+                                 data_filter=Filter().gteq('ts', 2000000).lteq('ts', 2010000)).fetch_records(100000)
+        records = self.ds.query(channels=channels, start_ms=2000000, end_ms=2010000).fetch_records(100000)
+        self.assertEqual(len(records), 51)
+        self.assertEqual(records, expected)
+        self.assertEqual(self.ds.query(channels=channels, start_ms=2000000, end_ms=2010000,
+                                       session=1).fetch_records(100000), expected)
+
+        #Open ended windows, combined with a filter
+        records = self.ds.query(channels=channels, data_filter=Filter().gt('RPM', 6000),
+                                end_ms=1000000).fetch_records(100000)
+        self.assertTrue(len(records) > 0)
+        self.assertTrue(all(x[0] <= 1000000 and x[1] > 6000 for x in records))
+        records = self.ds.query(channels=channels, start_ms=5130000).fetch_records(100000)
+        self.assertEqual(records[0][0], 5130000)
+        self.assertEqual(records[-1][0], 5138000)
+
+        #The time window is served from the session's (session_id, ts) index
+        sel_st = self.ds._bind_partition(self.ds._build_select(channels, None, session=True, time_range=True), 1)
+        plan = ' '.join(str(x[-1]) for x in
+                        self.ds._conn.execute('EXPLAIN QUERY PLAN ' + sel_st, (1, 0, 1)))
+        self.assertTrue('datapoint_index_session_ts' in plan)
+
+        self.assertRaises(Exception, self.ds.query, channels, None, 0, 1000, 99)
+
+    def test_query_decimated(self):
+        rpm = self.ds.query(channels=['RPM']).fetch_columns(100000)['RPM']
+
+        #Whole session, the peaks survive decimation
+        envelope = self.ds.query_decimated(['RPM', 'Coolant'], 1, 25691, 500)['RPM']
+        self.assertTrue(500 <= len(envelope) < 1000)
+        self.assertEqual(envelope.factor % 16, 0)
+        self.assertEqual(max(envelope.max), max(rpm))
+        self.assertEqual(min(envelope.min), min(rpm))
+
+        #Every bucket envelopes the samples it covers
+        ids = list(envelope.sample_ids) + [25692]
+        for i in range(len(envelope)):
+            values = rpm[ids[i] - 1:ids[i + 1] - 1]
+            self.assertEqual(envelope.min[i], min(values))
+            self.assertEqual(envelope.max[i], max(values))
+            self.assertEqual(envelope.first[i], values[0])
+            self.assertEqual(envelope.last[i], values[-1])
+
+        #Zoomed in past the finest level the raw samples come back
+        envelope = self.ds.query_decimated(['RPM'], 100, 299, 500)['RPM']
+        self.assertEqual(envelope.factor, 1)
+        self.assertEqual(list(envelope.sample_ids), range(100, 300))
+        self.assertEqual(list(envelope.max), rpm[99:299])
+
+        self.assertRaises(Exception, self.ds.query_decimated, ['NoSuchChannel'], 1, 100, 10)
+
     def test_channel_min_max(self):
         rpm_min = self.ds.get_channel_min('RPM')
         rpm_max = self.ds.get_channel_max('RPM')
 
-        self.assertEqual(rpm_min, 776.0)
+        self.assertEqual(rpm_min, 498.0)
         self.assertEqual(rpm_max, 6246.0)
 
+    def test_channel_stats(self):
+        c = self.ds._conn.cursor()
+        c.execute("""SELECT COUNT(Coolant), MIN(Coolant), MAX(Coolant), AVG(Coolant),
+        AVG(Coolant * Coolant), MIN(sample_id), MAX(sample_id) FROM datapoint_1""")
+        count, min_val, max_val, mean, mean_sq, first_id, last_id = c.fetchone()
+
+        stats = self.ds.get_channel_stats('Coolant')
+        self.assertEqual(stats.count, count)
+        self.assertEqual(stats.min, min_val)
+        self.assertEqual(stats.max, max_val)
+        self.assertAlmostEqual(stats.mean, mean)
+        self.assertAlmostEqual(stats.stddev, (mean_sq - mean * mean) ** 0.5, places=4)
+        self.assertEqual(stats.first_sample_id, first_id)
+        self.assertEqual(stats.last_sample_id, last_id)
+        self.assertAlmostEqual(self.ds.get_channel_average('Coolant'), mean)
+
+        #Only one session, so it should be the same as the overall stats
+        session_stats = self.ds.get_channel_stats('Coolant', session=1)
+        self.assertEqual(session_stats.count, count)
+        self.assertEqual(self.ds.get_channel_stats('Coolant', session=2).count, 0)
+
+        self.assertRaises(Exception, self.ds.get_channel_stats, 'AverageSpeedOfASwallow')
+
     def test_interpolation(self):
         dset = [1., 1., 1., 1., 5.]
 
@@ -128,6 +426,10 @@ class DataStoreTest(unittest.TestCase):
         self.assertListEqual(smooth_list, [1., 2., 3., 4., 5., 4., 3., 2.])
 
 
+    def test_smoothing_short_dataset(self):
+        self.assertListEqual(_smooth_dataset([1., 3., 5.], 4), [1., 3., 5.])
+        self.assertListEqual(_smooth_dataset([2.], 4), [2.])
+
     def test_channel_set_get_smoothing(self):
         success = None
         smoothing_rate = 0
@@ -146,6 +448,14 @@ class DataStoreTest(unittest.TestCase):
         self.assertEqual(smoothing_rate, 1)
         
 
+        #The kernel is kept unless a new one is specified
+        self.assertEqual(self.ds.get_channel_smoothing_kernel('RPM'), 'interp')
+        self.ds.set_channel_smoothing('RPM', 5, EMA_KERNEL)
+        self.ds.set_channel_smoothing('RPM', 3)
+        self.assertEqual(self.ds.get_channel_smoothing_kernel('RPM'), EMA_KERNEL)
+        self.ds.set_channel_smoothing('RPM', 1, 'interp')
+        self.assertRaises(Exception, self.ds.set_channel_smoothing, 'RPM', 5, 'gaussian')
+
         #Negative case, this would return an error
         try:
             self.ds.set_channel_smoothing('AverageSpeedOfASwallow', 9001)
@@ -154,3 +464,1112 @@ class DataStoreTest(unittest.TestCase):
             success = False
 
         self.assertEqual(success, False)
+
+
+class ChannelStatsTest(unittest.TestCase):
+    def test_sessions_combined(self):
+        ds = DataStore()
+        ds.new()
+        second_log = _copy_log(log_path)
+        ds.import_datalog(log_path, 'first')
+        ds.import_datalog(second_log, 'second')
+        os.remove(second_log)
+
+        single = ds.get_channel_stats('RPM', session=1)
+        combined = ds.get_channel_stats('RPM')
+        self.assertEqual(combined.count, 2 * single.count)
+        self.assertEqual(combined.min, single.min)
+        self.assertEqual(combined.max, single.max)
+        self.assertAlmostEqual(combined.mean, single.mean)
+        self.assertAlmostEqual(combined.stddev, single.stddev)
+        self.assertEqual(combined.first_sample_id, 1)
+        #The second session has a block of sample ids of its own
+        self.assertEqual(combined.last_sample_id, SESSION_ID_BLOCK + single.count)
+        ds.close()
+
+class BatchImportTest(unittest.TestCase):
+    def test_import_datalogs(self):
+        fd, bad_log = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(fd, 'wb') as f:
+            f.write('"RPM"|"RPM",Speed\r\n1,2\r\n')
+
+        ds = DataStore()
+        ds.new()
+        progress = {}
+        def listener(path, pct, rate):
+            progress.setdefault(path, []).append(pct)
+
+        second_log = _copy_log(log_path)
+        try:
+            paths = [log_path, bad_log, second_log, '/no/such/datalog.log']
+            results = ds.import_datalogs(paths, names=['a', 'bad', 'b', 'missing'],
+                                         progress_listener=listener, processes=2)
+        finally:
+            os.remove(bad_log)
+            os.remove(second_log)
+
+        self.assertEqual([x.path for x in results], paths)
+        self.assertEqual(results[0].error, None)
+        self.assertEqual(results[2].error, None)
+        self.assertNotEqual(results[1].error, None)
+        self.assertNotEqual(results[3].error, None)
+        self.assertEqual(sorted([results[0].session_id, results[2].session_id]), [1, 2])
+        self.assertAlmostEqual(progress[log_path][-1], 100.0)
+
+        #Both good files are complete and nothing is left of the bad ones
+        c = ds._conn.cursor()
+        self.assertEqual([(x.session_id, x.samples) for x in ds.list_sessions()], [(1, 25691), (2, 25691)])
+        c.execute("SELECT COUNT(*) FROM session")
+        self.assertEqual(c.fetchone()[0], 2)
+        self.assertEqual(ds.get_channel_stats('RPM').count, 2 * 25691)
+        ds.close()
+
+    def _short_logs(self, count):
+        """
+        Writes count datalogs of the first few hundred records of the
+        test datalog, each a different length
+        """
+        with open(log_path, 'rb') as f:
+            lines = f.readlines()
+        paths = []
+        for i in range(count):
+            fd, path = tempfile.mkstemp(suffix='.log')
+            with os.fdopen(fd, 'wb') as f:
+                f.writelines(lines[:300 + i])
+            paths.append(path)
+        return paths
+
+    def test_files_in_flight_bounded(self):
+        ds = DataStore()
+        ds.new()
+        paths = self._short_logs(6)
+        written = []
+        ahead = []
+
+        limit = datastore_module._InFlightLimit
+
+        class Limit(limit):
+            def __iter__(self):
+                for i, item in enumerate(limit.__iter__(self)):
+                    #Files handed to the pool that haven't been written yet
+                    ahead.append(i + 1 - len(written))
+                    yield item
+
+        import_parsed = ds._import_parsed_datalog
+        def counting_import(*args):
+            session_id = import_parsed(*args)
+            written.append(session_id)
+            return session_id
+
+        datastore_module._InFlightLimit = Limit
+        ds._import_parsed_datalog = counting_import
+        try:
+            results = ds.import_datalogs(paths, processes=2)
+        finally:
+            datastore_module._InFlightLimit = limit
+            for path in paths:
+                os.remove(path)
+
+        self.assertEqual([x.error for x in results], [None] * 6)
+        self.assertEqual(sorted(written), range(1, 7))
+        self.assertEqual(len(ahead), 6)
+        self.assertTrue(max(ahead) <= 3, ahead)
+        ds.close()
+
+    def test_no_process_pool(self):
+        def unavailable(*args):
+            raise OSError("Function not implemented")
+
+        ds = DataStore()
+        ds.new()
+        paths = self._short_logs(2)
+        pool = multiprocessing.Pool
+        multiprocessing.Pool = unavailable
+        try:
+            results = ds.import_datalogs(paths, processes=2)
+        finally:
+            multiprocessing.Pool = pool
+            for path in paths:
+                os.remove(path)
+
+        self.assertEqual([x.error for x in results], [None, None])
+        self.assertEqual(sorted(x.session_id for x in results), [1, 2])
+        ds.close()
+
+class _Crash(BaseException):
+    pass
+
+class ResumableImportTest(unittest.TestCase):
+    def _crash_import(self, ds, path, checkpoints):
+        """
+        Imports until the given number of checkpoints were written, then
+        fails the next one the way a killed process would
+        """
+        written = []
+        checkpoint = ds._checkpoint_datalog
+        def failing_checkpoint(datalog_id, offset, sample_id, complete=False):
+            if len(written) == checkpoints:
+                raise _Crash()
+            written.append(sample_id)
+            checkpoint(datalog_id, offset, sample_id, complete)
+
+        ds._checkpoint_datalog = failing_checkpoint
+        try:
+            self.assertRaises(_Crash, ds.import_datalog, path, 'interrupted')
+        finally:
+            ds._checkpoint_datalog = checkpoint
+        return written[-1]
+
+    def _assert_same_session(self, ds, expected):
+        channels = ['ts', 'RPM', 'LapCount', 'Latitude', 'Coolant']
+        self.assertEqual(ds.query(channels=channels).fetch_records(100000),
+                         expected.query(channels=channels).fetch_records(100000))
+        stats, expected_stats = ds.get_channel_stats('RPM', 1), expected.get_channel_stats('RPM', 1)
+        self.assertEqual((stats.count, stats.min, stats.max, stats.first_sample_id, stats.last_sample_id),
+                         (expected_stats.count, expected_stats.min, expected_stats.max,
+                          expected_stats.first_sample_id, expected_stats.last_sample_id))
+        self.assertAlmostEqual(stats.mean, expected_stats.mean)
+        self.assertAlmostEqual(stats.stddev, expected_stats.stddev)
+        for table in ['lap', 'channel_pyramid_1', 'sample_geo_1']:
+            sql = "SELECT * FROM {} ORDER BY 1, 2, 3, 4".format(table)
+            self.assertEqual(ds._conn.execute(sql).fetchall(), expected._conn.execute(sql).fetchall())
+
+    def _check_resume(self, storage):
+        expected = DataStore()
+        expected.new(storage=storage)
+        expected.import_datalog(log_path, 'rc_adj')
+
+        ds = DataStore()
+        ds.new(storage=storage)
+        checkpoint_id = self._crash_import(ds, log_path, 2)
+        c = ds._conn.cursor()
+        c.execute("SELECT session_id, checkpoint_offset, checkpoint_sample_id, complete FROM datalog_info")
+        session_id, offset, sample_id, complete = c.fetchone()
+        self.assertEqual((session_id, sample_id, complete), (1, checkpoint_id, 0))
+        self.assertTrue(0 < offset < os.path.getsize(log_path))
+        #The block after the checkpoint made it in before the crash
+        self.assertTrue(ds._get_session_range(1)[1] > checkpoint_id)
+
+        progress = []
+        self.assertEqual(ds.import_datalog(log_path, 'resumed',
+                                           progress_listener=lambda pct, rate: progress.append(pct)), 1)
+        #Picked up at the checkpoint rather than the start of the file
+        self.assertTrue(progress[0] > 100.0 * offset / os.path.getsize(log_path))
+        c.execute("SELECT COUNT(*) FROM session")
+        self.assertEqual(c.fetchone()[0], 1)
+        c.execute("SELECT complete FROM datalog_info")
+        self.assertEqual(c.fetchone()[0], 1)
+        self._assert_same_session(ds, expected)
+        ds.close()
+        expected.close()
+
+    def test_resume(self):
+        self._check_resume(ROW_STORAGE)
+
+    @unittest.skipIf(np is None, "columnar storage requires numpy")
+    def test_resume_columnar(self):
+        self._check_resume(COLUMNAR_STORAGE)
+
+    def test_duplicate_import(self):
+        ds = DataStore()
+        ds.new()
+        session_id = ds.import_datalog(log_path, 'rc_adj')
+        self.assertEqual(ds.import_datalog(log_path, 'again'), session_id)
+        results = ds.import_datalogs([log_path], processes=1)
+        self.assertEqual(results[0].session_id, session_id)
+
+        c = ds._conn.cursor()
+        c.execute("SELECT COUNT(*) FROM session")
+        self.assertEqual(c.fetchone()[0], 1)
+        c.execute("SELECT fingerprint, complete FROM datalog_info")
+        with open(log_path, 'rb') as f:
+            self.assertEqual(c.fetchone(), (hashlib.sha1(f.read()).hexdigest(), 1))
+        self.assertEqual(ds.get_channel_stats('RPM').count, 25691)
+        ds.close()
+
+    def test_resume_after_other_imports(self):
+        ds = DataStore()
+        ds.new()
+        self._crash_import(ds, log_path, 1)
+        other_log = _copy_log(log_path)
+        try:
+            self.assertEqual(ds.import_datalog(other_log, 'other'), 2)
+        finally:
+            os.remove(other_log)
+
+        #The interrupted session continues in its own block of sample ids
+        self.assertEqual(ds.import_datalog(log_path, 'resumed'), 1)
+        self.assertEqual([(x.session_id, x.samples) for x in ds.list_sessions()], [(1, 25691), (2, 25691)])
+        channels = ['ts', 'RPM', 'Latitude']
+        self.assertEqual(ds.query(channels=channels, session=1).fetch_records(100000),
+                         ds.query(channels=channels, session=2).fetch_records(100000))
+        ds.close()
+
+class DerivedChannelTest(unittest.TestCase):
+    def _stores(self):
+        for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE, COMPRESSED_STORAGE, SPARSE_STORAGE]
+                                        if np is not None else []):
+            ds = DataStore()
+            ds.new(storage=storage)
+            ds.import_datalog(log_path, 'rc_adj')
+            self.addCleanup(ds.close)
+            yield ds
+
+    def _expected(self, ds, channels, fn):
+        records = ds.query(channels=channels).fetch_records(100000)
+        return [None if None in x else fn(*x) for x in records]
+
+    def _values(self, values):
+        values = values.tolist() if hasattr(values, 'tolist') else values
+        return [None if x is None or x != x else x for x in values]
+
+    def test_evaluate_expression(self):
+        for ds in self._stores():
+            values = ds.evaluate_expression('AccelX^2 + AccelY^2', 1)
+            expected = self._expected(ds, ['AccelX', 'AccelY'], lambda x, y: x ** 2 + y ** 2)
+            self.assertEqual(self._values(values), expected)
+
+            #Cached until the datastore changes
+            self.assertTrue(ds.evaluate_expression('AccelX^2 + AccelY^2', 1) is values or np is None)
+            other_log = _copy_log(log_path)
+            try:
+                ds.import_datalog(other_log, 'copy')
+            finally:
+                os.remove(other_log)
+            self.assertEqual(len(ds.evaluate_expression('AccelX^2 + AccelY^2')), 2 * 25691)
+            self.assertEqual(len(ds.evaluate_expression('AccelX^2 + AccelY^2', 2)), 25691)
+
+            self.assertRaises(Exception, ds.evaluate_expression, 'Nope * 2', 1)
+            self.assertRaises(Exception, ds.evaluate_expression, 'RPM', 3)
+
+    def test_derived_channel(self):
+        for ds in self._stores():
+            ds.add_derived_channel('RpmPerMph', 'RPM / Speed', 'rpm/mph')
+            ds.add_derived_channel('Braking', 'Brake > 50')
+            self.assertRaises(Exception, ds.add_derived_channel, 'RPM', 'Speed * 2')
+            self.assertRaises(Exception, ds.add_derived_channel, 'Bad Name', 'Speed * 2')
+            self.assertRaises(Exception, ds.add_derived_channel, 'Other', 'Nope * 2')
+
+            records = ds.query(channels=['RPM', 'Speed', 'RpmPerMph']).fetch_records(100000)
+            for rpm, speed, ratio in records:
+                if speed:
+                    self.assertAlmostEqual(ratio, rpm / speed)
+                else:
+                    self.assertEqual(ratio, None)
+
+            #Filtered on like a logged channel, with stats computed for it
+            braking = ds.query(channels=['Brake'], data_filter=Filter().eq('Braking', 1)).fetch_records(100000)
+            self.assertTrue(len(braking) > 0)
+            self.assertTrue(all(x[0] > 50 for x in braking))
+            self.assertEqual(ds.get_channel_max('Braking'), 1.0)
+            self.assertEqual(ds.get_channel_min('Braking'), 0.0)
+
+            #Sessions imported later get it too
+            other_log = _copy_log(log_path)
+            try:
+                ds.import_datalog(other_log, 'copy')
+            finally:
+                os.remove(other_log)
+            self.assertEqual(ds.query(channels=['Braking'], data_filter=Filter().eq('Braking', 1),
+                                      session=2).fetch_records(100000), [(1.0,)] * len(braking))
+            self.assertEqual(ds.get_channel_stats('RpmPerMph', 2).count, ds.get_channel_stats('RpmPerMph', 1).count)
+
+    def test_derived_channel_reopened(self):
+        work_dir = tempfile.mkdtemp()
+        path = os.path.join(work_dir, 'derived.sql3')
+        ds = DataStore()
+        try:
+            ds.new(path)
+            ds.import_datalog(log_path, 'rc_adj')
+            ds.add_derived_channel('Double', 'RPM * 2')
+            ds.close()
+
+            ds.open_db(path)
+            other_log = _copy_log(log_path)
+            try:
+                ds.import_datalog(other_log, 'copy')
+            finally:
+                os.remove(other_log)
+            records = ds.query(channels=['RPM', 'Double'], session=2).fetch_records(100000)
+            self.assertTrue(all(double == rpm * 2 for rpm, double in records))
+        finally:
+            ds.close()
+            shutil.rmtree(work_dir)
+
+class AggregateQueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        other_log = _copy_log(log_path)
+        self.stores = []
+        try:
+            for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE, COMPRESSED_STORAGE] if np is not None else []):
+                ds = DataStore()
+                ds.new(storage=storage)
+                ds.import_datalog(log_path, 'rc_adj')
+                ds.import_datalog(other_log, 'copy')
+                self.stores.append(ds)
+        finally:
+            os.remove(other_log)
+
+    @classmethod
+    def tearDownClass(self):
+        for ds in self.stores:
+            ds.close()
+
+    def _list(self, values):
+        values = values.tolist() if hasattr(values, 'tolist') else values
+        return [None if x is None or x != x else x for x in values]
+
+    def test_histogram(self):
+        for ds in self.stores:
+            rpm = [x[0] for x in ds.query(channels=['RPM'], session=1).fetch_records(100000)
+                   if x[0] is not None]
+            low, high = min(rpm), max(rpm)
+            expected = [0] * 60
+            for value in rpm:
+                expected[min(int((value - low) * 60 / (high - low)), 59)] += 1
+
+            counts, edges = ds.histogram('RPM', 60, session=1)
+            self.assertEqual(self._list(counts), expected)
+            self.assertEqual(len(edges), 61)
+            self.assertEqual((edges[0], edges[-1]), (low, high))
+
+            #Both sessions hold the same values
+            counts, edges = ds.histogram('RPM', 60)
+            self.assertEqual(self._list(counts), [x * 2 for x in expected])
+
+            data_filter = Filter().gt('Coolant', 170)
+            filtered = [x[0] for x in ds.query(channels=['RPM'], data_filter=data_filter,
+                                               session=1).fetch_records(100000)]
+            counts, edges = ds.histogram('RPM', 4, data_filter, 1, (1000, 5000))
+            expected = [len([x for x in filtered if 1000 + i * 1000 <= x < 2000 + i * 1000 or
+                             (i == 3 and x == 5000)]) for i in range(4)]
+            self.assertEqual(self._list(counts), expected)
+            self.assertTrue(0 < sum(expected) < len(rpm))
+            self.assertEqual(self._list(edges), [1000, 2000, 3000, 4000, 5000])
+
+            self.assertRaises(Exception, ds.histogram, 'Nope', 10)
+            self.assertRaises(Exception, ds.histogram, 'RPM', 0)
+            self.assertRaises(Exception, ds.histogram, 'RPM', 10, session=3)
+
+    def test_aggregate_laps(self):
+        for ds in self.stores:
+            aggregates = ds.aggregate(['RPM', 'Coolant'], 'lap', ['min', 'max', 'avg', 'count'], session=1)
+            laps = ds.query_lap
+            self.assertEqual(len(aggregates), 38)
+            self.assertEqual(aggregates.keys, ['session', 'lap'])
+            self.assertEqual(self._list(aggregates.groups['session']), [1] * 38)
+            for i, lap in enumerate(self._list(aggregates.groups['lap'])):
+                rpm = [x[0] for x in laps(1, lap, ['RPM']).fetch_records(100000) if x[0] is not None]
+                self.assertEqual(aggregates.get('RPM', 'min')[i], min(rpm))
+                self.assertEqual(aggregates.get('RPM', 'max')[i], max(rpm))
+                self.assertEqual(aggregates.get('RPM', 'count')[i], len(rpm))
+                self.assertAlmostEqual(aggregates.get('RPM', 'avg')[i], sum(rpm) / len(rpm), 6)
+
+            self.assertEqual(len(ds.aggregate(['RPM'], 'lap')), 2 * 38)
+
+    def test_aggregate_sessions(self):
+        for ds in self.stores:
+            data_filter = Filter().gt('RPM', 3000)
+            aggregates = ds.aggregate(['RPM', 'Coolant'], 'session', ['sum', 'count'], data_filter)
+            self.assertEqual(self._list(aggregates.groups['session']), [1, 2])
+            records = ds.query(channels=['RPM', 'Coolant'], data_filter=data_filter, session=1).fetch_records(100000)
+            for i, channel in enumerate(['RPM', 'Coolant']):
+                values = [x[i] for x in records if x[i] is not None]
+                self.assertEqual(self._list(aggregates.get(channel, 'count')), [len(values)] * 2)
+                self.assertAlmostEqual(aggregates.get(channel, 'sum')[1], sum(values), 3)
+
+            self.assertRaises(Exception, ds.aggregate, [], 'session')
+            self.assertRaises(Exception, ds.aggregate, ['RPM'], 'week')
+            self.assertRaises(Exception, ds.aggregate, ['RPM'], 'session', ['median'])
+            self.assertRaises(Exception, ds.aggregate, ['Nope'], 'session')
+
+    def test_aggregate_time_buckets(self):
+        for ds in self.stores:
+            aggregates = ds.aggregate(['RPM'], 60000, ['max'], session=2)
+            self.assertEqual(aggregates.keys, ['session', 'bucket'])
+            records = ds.query(channels=['ts', 'RPM'], session=2).fetch_records(100000)
+            expected = {}
+            for ts, rpm in records:
+                if ts is not None and rpm is not None:
+                    bucket = int(ts / 60000) * 60000
+                    expected[bucket] = max(expected.get(bucket, rpm), rpm)
+            self.assertEqual(self._list(aggregates.groups['bucket']), sorted(expected))
+            self.assertEqual(self._list(aggregates.get('RPM', 'max')), [expected[x] for x in sorted(expected)])
+
+    def test_query_plans(self):
+        ds = self.stores[0]
+        data_filter = Filter().gt('Coolant', 170)
+        #A session's histogram only walks that session's own table
+        sel_st = ds._bind_partition(ds._build_histogram_select('RPM', data_filter), 1)
+        plan = str(ds._conn.execute('EXPLAIN QUERY PLAN ' + sel_st, [0] * 6).fetchall())
+        self.assertTrue('FROM datapoint_1 ' in sel_st)
+        self.assertTrue('SCAN datapoint' in plan)
+
+        #Each lap is a range of the sample id index
+        sel_st = ds._bind_partition(ds._build_aggregate_select(['RPM'], 'lap', ['max'], data_filter, session=True), 1)
+        plan = str(ds._conn.execute('EXPLAIN QUERY PLAN ' + sel_st, [0] * 2).fetchall())
+        self.assertTrue('datapoint_index_sample_id' in plan)
+
+class ResultCacheTest(unittest.TestCase):
+    channels = ['ts', 'RPM', 'Coolant', 'Speed']
+
+    def _stores(self):
+        for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE] if np is not None else []):
+            ds = DataStore()
+            ds.new(storage=storage)
+            ds.import_datalog(log_path, 'rc_adj')
+            self.addCleanup(ds.close)
+            yield ds
+
+    def _stats(self, ds):
+        return ds.get_query_cache_stats()['results']
+
+    def test_repeated_query(self):
+        for ds in self._stores():
+            ds.set_channel_smoothing('RPM', 10)
+            data_filter = Filter().gt('Coolant', 165)
+            first = ds.query(channels=self.channels, data_filter=data_filter).fetch_records(100000)
+            self.assertEqual(self._stats(ds)['entries'], 1)
+
+            dataset = ds.query(channels=self.channels, data_filter=data_filter)
+            self.assertEqual(dataset.fetch_records(100), first[:100])
+            self.assertEqual(dataset.fetch_records(100000), first[100:])
+            stats = self._stats(ds)
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+            self.assertEqual(stats['bytes'], RESULT_VALUE_BYTES * len(self.channels) * len(first))
+
+            if np is not None:
+                #Kept as float64 arrays, blanks as NaN
+                cached = ds._result_cache._entries.values()[0]
+                self.assertEqual(cached['RPM'].dtype, np.float64)
+                arrays = ds.query(channels=self.channels, data_filter=data_filter).fetch_all()
+                self.assertEqual(len(arrays['RPM']), len(first))
+
+            #Different parameters are a different result
+            other = ds.query(channels=self.channels, data_filter=Filter().gt('Coolant', 170)).fetch_records(100000)
+            self.assertTrue(len(other) < len(first))
+            self.assertEqual(self._stats(ds)['entries'], 2)
+
+    def test_partial_read_not_cached(self):
+        for ds in self._stores():
+            ds.query(channels=self.channels).fetch_records(100)
+            self.assertEqual(self._stats(ds)['entries'], 0)
+            records = ds.query(channels=self.channels).fetch_records(100000)
+            self.assertEqual(len(records), 25691)
+            self.assertEqual(self._stats(ds)['hits'], 0)
+
+    def test_invalidation(self):
+        for ds in self._stores():
+            raw = ds.query(channels=['RPM']).fetch_records(100000)
+            ds.set_channel_smoothing('RPM', 10)
+            self.assertEqual(self._stats(ds)['entries'], 0)
+            smoothed = ds.query(channels=['RPM']).fetch_records(100000)
+            self.assertNotEqual(smoothed, raw)
+
+            other_log = _copy_log(log_path)
+            try:
+                ds.import_datalog(other_log, 'copy')
+            finally:
+                os.remove(other_log)
+            self.assertEqual(len(ds.query(channels=['RPM']).fetch_records(100000)), 2 * 25691)
+            self.assertEqual(self._stats(ds)['hits'], 0)
+
+            ds.query(channels=['RPM'], session=2).fetch_records(100000)
+            ds._discard_session(2)
+            self.assertRaises(Exception, ds.query, ['RPM'], None, None, None, 2)
+
+    def test_size_bound(self):
+        for ds in self._stores():
+            ds.set_result_cache_size(RESULT_VALUE_BYTES * 25691 * 2)
+            ds.query(channels=['RPM']).fetch_records(100000)
+            ds.query(channels=['Speed']).fetch_records(100000)
+            self.assertEqual(self._stats(ds)['entries'], 2)
+            ds.query(channels=['Coolant']).fetch_records(100000)
+            self.assertEqual(self._stats(ds)['entries'], 2)
+            self.assertEqual(self._stats(ds)['bytes'], RESULT_VALUE_BYTES * 25691 * 2)
+
+            #RPM went first, Speed is still there
+            ds.query(channels=['Speed']).fetch_records(100000)
+            ds.query(channels=['RPM']).fetch_records(100000)
+            self.assertEqual(self._stats(ds)['hits'], 1)
+
+            #Too big to keep at all, what was read stops being kept once
+            #past the bound
+            dataset = ds.query(channels=self.channels)
+            dataset.fetch_records(20000)
+            self.assertEqual(dataset._recorded, None)
+            dataset.fetch_records(100000)
+            self.assertEqual(self._stats(ds)['entries'], 2)
+
+            ds.set_result_cache_size(0)
+            ds.query(channels=['RPM']).fetch_records(100000)
+            self.assertEqual(self._stats(ds)['entries'], 0)
+
+    def test_changes_from_other_connections(self):
+        work_dir = tempfile.mkdtemp()
+        path = os.path.join(work_dir, 'cache.sql3')
+        ds = DataStore()
+        writer = DataStore()
+        try:
+            ds.new(path)
+            ds.import_datalog(log_path, 'rc_adj')
+            self.assertEqual(len(ds.query(channels=['RPM']).fetch_records(100000)), 25691)
+
+            writer.open_db(path)
+            other_log = _copy_log(log_path)
+            try:
+                writer.import_datalog(other_log, 'copy')
+            finally:
+                os.remove(other_log)
+            self.assertEqual(len(ds.query(channels=['RPM']).fetch_records(100000)), 2 * 25691)
+
+            #Smoothing set through the other connection applies here too
+            raw = ds.query(channels=['RPM'], session=1).fetch_records(100000)
+            writer.set_channel_smoothing('RPM', 10)
+            smoothed = ds.query(channels=['RPM'], session=1).fetch_records(100000)
+            self.assertNotEqual(smoothed, raw)
+            self.assertEqual(smoothed, writer.query(channels=['RPM'], session=1).fetch_records(100000))
+        finally:
+            writer.close()
+            ds.close()
+            shutil.rmtree(work_dir)
+
+class GeoQueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.other_log = _copy_log(log_path)
+        self.stores = []
+        for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE] if np is not None else []):
+            ds = DataStore()
+            ds.new(storage=storage)
+            ds.import_datalog(log_path, 'rc_adj')
+            ds.import_datalog(self.other_log, 'copy')
+            self.stores.append(ds)
+        #A point on the track in rc_adj.log
+        self.point = GeoPoint.fromPoint(47.2545, -123.1966)
+
+    @classmethod
+    def tearDownClass(self):
+        for ds in self.stores:
+            ds.close()
+        os.remove(self.other_log)
+
+    def _scan(self, ds, include, session=None):
+        records = ds.query(channels=['Latitude', 'Longitude', 'LapCount'], session=session).fetch_records(100000)
+        return [x for x in records if x[0] is not None and include(x[0], x[1])]
+
+    def test_distance(self):
+        self.assertAlmostEqual(_distance_m(47.0, -123.0, 47.0, -123.0), 0)
+        #One minute of latitude is a nautical mile
+        self.assertAlmostEqual(_distance_m(47.0, -123.0, 47.0 + 1 / 60.0, -123.0), 1853, delta=2)
+        self.assertEqual(_distance_m(None, -123.0, 47.0, -123.0), None)
+
+    def test_query_near(self):
+        lat, lon = self.point.latitude, self.point.longitude
+        for ds in self.stores:
+            for radius in [5, 30, 200]:
+                records = ds.query_near(self.point, radius, ['Latitude', 'Longitude', 'LapCount']).fetch_records(100000)
+                expected = self._scan(ds, lambda a, b: _distance_m(a, b, lat, lon) <= radius)
+                self.assertTrue(len(records) > 0)
+                self.assertEqual(records, expected)
+
+            records = ds.query_near(self.point, 30, ['LapCount'], session=2).fetch_records(100000)
+            expected = self._scan(ds, lambda a, b: _distance_m(a, b, lat, lon) <= 30, session=2)
+            self.assertEqual(records, [x[2:] for x in expected])
+            #Passes from most of the 38 laps
+            self.assertTrue(len(set(records)) > 30)
+
+    def test_query_bbox(self):
+        south_west = GeoPoint.fromPoint(47.254, -123.197)
+        north_east = GeoPoint.fromPoint(47.255, -123.196)
+        for ds in self.stores:
+            records = ds.query_bbox(south_west, north_east, ['Latitude', 'Longitude', 'LapCount'],
+                                    data_filter=Filter().gt('LapCount', 10)).fetch_records(100000)
+            expected = self._scan(ds, lambda a, b: 47.254 <= a <= 47.255 and -123.197 <= b <= -123.196)
+            expected = [x for x in expected if x[2] > 10]
+            self.assertTrue(len(records) > 0)
+            self.assertEqual(records, expected)
+
+            nowhere = ds.query_bbox(GeoPoint.fromPoint(10, 10), GeoPoint.fromPoint(11, 11), ['RPM'])
+            self.assertEqual(nowhere.fetch_records(100), [])
+
+    def test_uses_index(self):
+        ds = self.stores[0]
+        sel_st = ds._bind_partition(ds._build_select(['RPM'], None, area=True, near=True), 1)
+        plan = ' '.join(str(x[-1]) for x in
+                        ds._conn.execute('EXPLAIN QUERY PLAN ' + sel_st, [0] * 11))
+        self.assertTrue('sample_geo' in plan)
+        self.assertTrue('datapoint_index_sample_id' in plan)
+
+    def test_index_follows_sessions(self):
+        ds = DataStore()
+        ds.new()
+        try:
+            ds.import_datalog(log_path, 'rc_adj')
+            c = ds._conn.cursor()
+            c.execute("SELECT COUNT(*), MIN(id), MAX(id) FROM sample_geo_1")
+            self.assertEqual(c.fetchone(), (25691, 1, 25691))
+            ds._discard_session(1)
+            self.assertEqual(ds._get_partitions('sample_geo'), [])
+        finally:
+            ds.close()
+
+    def test_requires_position_channels(self):
+        ds = DataStore()
+        ds.new()
+        try:
+            self.assertRaises(Exception, ds.query_near, self.point, 30)
+        finally:
+            ds.close()
+
+class SessionManagementTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.other_log = _copy_log(log_path)
+
+    def tearDown(self):
+        os.remove(self.other_log)
+        shutil.rmtree(self.dir)
+
+    def _stores(self):
+        for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE] if np is not None else []):
+            ds = DataStore()
+            ds.new(os.path.join(self.dir, '{}.sql3'.format(storage)), storage=storage)
+            ds.import_datalog(log_path, 'rc_adj')
+            ds.import_datalog(self.other_log, 'copy')
+            yield ds
+            ds.close()
+
+    def test_list_sessions(self):
+        for ds in self._stores():
+            sessions = ds.list_sessions()
+            self.assertEqual([(x.session_id, x.name, x.samples) for x in sessions],
+                             [(1, 'rc_adj', 25691), (2, 'copy', 25691)])
+            self.assertTrue(all(x.bytes > 25691 for x in sessions))
+            self.assertAlmostEqual(sessions[0].bytes, sessions[1].bytes, delta=sessions[0].bytes * 0.1)
+
+    def test_query_decimated_sessions(self):
+        for ds in self._stores():
+            last_id = ds._get_session_range(2)[1]
+            single = ds.query_decimated(['RPM'], 1, 25691, 1000)['RPM']
+            #The level is picked from the samples in the range, not from
+            #the ids between the sessions
+            both = ds.query_decimated(['RPM'], 1, last_id, 2000)['RPM']
+            self.assertEqual((single.factor, both.factor), (16, 16))
+            self.assertEqual(len(both), 2 * len(single))
+            self.assertEqual(list(both.max[:len(single)]), list(single.max))
+            self.assertEqual(list(both.max[len(single):]), list(single.max))
+            self.assertEqual(both.sample_ids[len(single)], SESSION_ID_BLOCK + 1)
+
+    def test_delete_session(self):
+        for ds in self._stores():
+            rpm = ds.query(channels=['RPM'], session=1).fetch_records(100000)
+            ds.delete_session(2)
+            self.assertEqual([x.session_id for x in ds.list_sessions()], [1])
+            self.assertEqual(ds.query(channels=['RPM']).fetch_records(100000), rpm)
+            self.assertRaises(Exception, ds.query, ['RPM'], None, None, None, 2)
+            self.assertRaises(Exception, ds.delete_session, 2)
+
+            #Nothing of the session is left, its partitions are gone
+            c = ds._conn.cursor()
+            for table in ['channel_stats', 'lap', 'channel_data']:
+                c.execute("SELECT COUNT(*) FROM {} WHERE session_id=2".format(table))
+                self.assertEqual(c.fetchone()[0], 0)
+            c.execute("SELECT COUNT(*) FROM datalog_info")
+            self.assertEqual(c.fetchone()[0], 1)
+            c.execute("""SELECT COUNT(*) FROM sqlite_master
+            WHERE name GLOB 'datapoint*_2' OR name GLOB 'sample_geo_2*' OR name GLOB 'channel_pyramid*_2'""")
+            self.assertEqual(c.fetchone()[0], 0)
+            c.execute("SELECT COUNT(*), MAX(id) FROM sample_geo_1")
+            self.assertEqual(c.fetchone(), (25691, 25691))
+            self.assertFalse(os.path.exists(ds._get_sidecar_path(2)))
+
+            #The file can be imported again, after a gap in the sample ids
+            self.assertEqual(ds.import_datalog(self.other_log, 'again'), 3)
+            self.assertEqual(ds.query(channels=['RPM']).fetch_records(100000), rpm * 2)
+            near = ds.query_near(GeoPoint.fromPoint(47.2545, -123.1966), 30, ['RPM'], session=3)
+            self.assertEqual(len(near.fetch_records(100000)) * 2,
+                             len(ds.query_near(GeoPoint.fromPoint(47.2545, -123.1966), 30,
+                                               ['RPM']).fetch_records(100000)))
+            counts = ds.histogram('RPM', 10)[0]
+            self.assertEqual(sum(counts), 2 * len([x for x in rpm if x[0] is not None]))
+
+    def test_many_sessions(self):
+        #More sessions than sqlite allows terms in a compound SELECT, and
+        #than there are statements cached
+        with open(log_path, 'rb') as f:
+            lines = f.readlines()[:40]
+        sessions = 520
+        for storage in [ROW_STORAGE] + ([COLUMNAR_STORAGE] if np is not None else []):
+            ds = DataStore()
+            ds.new(storage=storage)
+            try:
+                path = os.path.join(self.dir, 'short.log')
+                for i in range(sessions):
+                    #Files differing in their last line, so none is taken
+                    #for one imported before
+                    with open(path, 'wb') as f:
+                        f.writelines(lines + [lines[-1].rstrip() + str(i) + '\n'])
+                    ds.import_datalog(path, 'short {}'.format(i))
+                self.assertEqual(len(ds.list_sessions()), sessions)
+                if storage == ROW_STORAGE:
+                    self.assertEqual(len(ds._get_partitions('datapoint')), sessions)
+
+                ds.set_result_cache_size(0)
+                rpm = ds.query(channels=['RPM']).fetch_records(100000)
+                self.assertEqual(len(rpm), sessions * 40)
+                self.assertEqual(ds.query(channels=['RPM'], session=sessions).fetch_records(100), rpm[-40:])
+                self.assertEqual(ds.query(channels=['RPM'], session=1).fetch_records(100), rpm[:40])
+                if storage == ROW_STORAGE:
+                    #One statement for the shape, whatever the sessions it reads
+                    self.assertEqual(ds.get_query_cache_stats()['statements']['misses'], 1)
+
+                counts = ds.histogram('RPM', 10)[0]
+                self.assertEqual(sum(counts), len([x for x in rpm if x[0] is not None]))
+                aggregates = ds.aggregate(['RPM'], funcs=['max'])
+                self.assertEqual(list(aggregates.groups['session']), range(1, sessions + 1))
+                envelope = ds.query_decimated(['RPM'], 1, ds._get_session_range(sessions)[1], 10)['RPM']
+                self.assertEqual(max(envelope.max), max(x[0] for x in rpm))
+
+                ds.delete_session(2)
+                self.assertEqual(len(ds.query(channels=['RPM']).fetch_records(100000)), (sessions - 1) * 40)
+            finally:
+                ds.close()
+
+    def test_vacuum(self):
+        for ds in self._stores():
+            c = ds._conn.cursor()
+            page_count = c.execute('PRAGMA page_count').fetchone()[0]
+            self.assertEqual(c.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+            ds.delete_session(1)
+            self.assertTrue(ds.wait_for_vacuum(60))
+            self.assertEqual(c.execute('PRAGMA freelist_count').fetchone()[0], 0)
+            self.assertTrue(c.execute('PRAGMA page_count').fetchone()[0] < page_count * 0.7)
+
+    def test_vacuum_waits_for_writers(self):
+        ds = DataStore()
+        path = os.path.join(self.dir, 'busy.sql3')
+        ds.new(path)
+        ds.import_datalog(log_path, 'rc_adj')
+        ds.import_datalog(self.other_log, 'copy')
+        vacuum, ds._vacuum = ds._vacuum, None
+        ds.delete_session(1)
+        ds._vacuum = vacuum
+        vacuum.busy_delay = 0.05
+        writer = DataStore()
+        writer.open_db(path)
+        try:
+            #Scheduling doesn't wait on the vacuum, and the vacuum stays
+            #out of the way of another connection's write
+            writer._conn.execute("UPDATE session SET notes='busy' WHERE id=2")
+            ds.schedule_vacuum()
+            self.assertFalse(ds.wait_for_vacuum(0.5))
+            self.assertTrue(ds._conn.execute('PRAGMA freelist_count').fetchone()[0] > 0)
+            writer._conn.commit()
+            self.assertTrue(ds.wait_for_vacuum(60))
+            self.assertEqual(ds._conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+        finally:
+            writer.close()
+            ds.close()
+
+@unittest.skipIf(np is None, "columnar storage requires numpy")
+class ColumnarDataStoreTest(unittest.TestCase):
+    storage = COLUMNAR_STORAGE
+
+    @classmethod
+    def setUpClass(self):
+        self.row_ds = DataStore()
+        self.row_ds.new()
+        self.row_ds.import_datalog(log_path, 'rc_adj')
+
+        self.ds = DataStore()
+        self.ds.new(storage=self.storage)
+        self.ds.import_datalog(log_path, 'rc_adj')
+
+    @classmethod
+    def tearDownClass(self):
+        self.row_ds.close()
+        self.ds.close()
+
+    def _records(self, ds, channels, f=None):
+        return ds.query(channels=channels, data_filter=f).fetch_records(100000)
+
+    def test_no_datapoint_columns(self):
+        c = self.ds._conn.cursor()
+        c.execute("SELECT * FROM datapoint_template LIMIT 1")
+        self.assertEqual([x[0] for x in c.description], ['id', 'sample_id', 'session_id'])
+
+    def test_query_matches_row_storage(self):
+        channels = ['Coolant', 'RPM', 'MAP']
+        filters = [None,
+                   Filter().lt('LapCount', 2),
+                   Filter().lt('LapCount', 3).gt('Coolant', 150).or_().eq('RPM', 1120),
+                   Filter().gteq('LapCount', 5).group(Filter().gt('RPM', 5000).or_().lteq('TPS', 10))]
+
+        for f in filters:
+            expected = self._records(self.row_ds, channels, f)
+            records = self._records(self.ds, channels, f)
+            self.assertTrue(len(records) > 0)
+            self.assertEqual(records, expected)
+
+    def test_dataset_chunked_smoothing(self):
+        f = Filter().lt('LapCount', 3)
+        raw = self.ds.query(channels=['RPM', 'Speed'], data_filter=f).fetch_columns(100000)
+        expected = smooth(raw['RPM'], 7)
+        expected = expected.tolist() if hasattr(expected, 'tolist') else expected
+        for a, b in zip(expected, _smooth_dataset(raw['RPM'], 7)):
+            self.assertAlmostEqual(a, b)
+
+        self.ds.set_channel_smoothing('RPM', 7)
+        try:
+            for chunk_size in [1, 5, 100, 333]:
+                dataset = self.ds.query(channels=['RPM', 'Speed'], data_filter=f)
+                rpm = []
+                speed = []
+                for chunk in dataset.iter_chunks(chunk_size):
+                    self.assertTrue(len(chunk['RPM']) <= chunk_size)
+                    self.assertEqual(len(chunk['RPM']), len(chunk['Speed']))
+                    rpm.extend(chunk['RPM'])
+                    speed.extend(chunk['Speed'])
+                self.assertEqual(rpm, expected)
+                self.assertEqual(speed, raw['Speed'])
+        finally:
+            self.ds.set_channel_smoothing('RPM', 1)
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_dataset_arrays(self):
+        f = Filter().lt('LapCount', 3)
+        columns = self.ds.query(channels=['RPM', 'Speed'], data_filter=f).fetch_columns(100000)
+
+        dataset = self.ds.query(channels=['RPM', 'Speed'], data_filter=f)
+        head = dataset.fetch_arrays(10)
+        self.assertEqual(head['RPM'].dtype, np.float64)
+        self.assertEqual(head['RPM'].tolist(), columns['RPM'][:10])
+
+        rest = dataset.fetch_all()
+        self.assertEqual(len(rest['Speed']), len(columns['Speed']) - 10)
+        self.assertEqual(rest['Speed'].tolist(), columns['Speed'][10:])
+        self.assertTrue(rest['Speed'].flags['C_CONTIGUOUS'])
+        self.assertEqual(len(dataset.fetch_all()['RPM']), 0)
+
+    def test_channel_min_max(self):
+        self.assertEqual(self.ds.get_channel_min('RPM'), 498.0)
+        self.assertEqual(self.ds.get_channel_max('RPM'), 6246.0)
+
+    def test_query_lap_matches_row_storage(self):
+        for lap in [0, 5, 37]:
+            expected = self.row_ds.query_lap(1, lap, channels=['RPM', 'MAP']).fetch_records(100000)
+            records = self.ds.query_lap(1, lap, channels=['RPM', 'MAP']).fetch_records(100000)
+            self.assertTrue(len(records) > 0)
+            self.assertEqual(records, expected)
+
+    def test_query_decimated_matches_row_storage(self):
+        for start, end, points in [(1, 25691, 300), (2000, 2400, 1000)]:
+            expected = self.row_ds.query_decimated(['RPM', 'MAP'], start, end, points)
+            envelopes = self.ds.query_decimated(['RPM', 'MAP'], start, end, points)
+            for channel in ['RPM', 'MAP']:
+                self.assertEqual(envelopes[channel].sample_ids.tolist(), expected[channel].sample_ids.tolist())
+                self.assertEqual(envelopes[channel].max.tolist(), expected[channel].max.tolist())
+                self.assertEqual(envelopes[channel].last.tolist(), expected[channel].last.tolist())
+
+    def test_time_window_matches_row_storage(self):
+        for start, end, session in [(2000000, 2010000, None), (None, 300000, 1), (5000000, None, 1)]:
+            expected = self.row_ds.query(channels=['ts', 'RPM'], start_ms=start, end_ms=end,
+                                         session=session).fetch_records(100000)
+            records = self.ds.query(channels=['ts', 'RPM'], start_ms=start, end_ms=end,
+                                    session=session).fetch_records(100000)
+            self.assertTrue(len(records) > 0)
+            self.assertEqual(records, expected)
+
+    def test_time_window_reads_overlapping_chunks(self):
+        self.ds._columnar_bytes_read = 0
+        records = self.ds.query(channels=['RPM'], start_ms=2000000, end_ms=2010000).fetch_records(1000)
+        self.assertEqual(len(records), 51)
+        #At most two chunks of ts and of RPM hold the window
+        self.assertTrue(self.ds._columnar_bytes_read <= 2 * 2 * 8 * IMPORT_CHUNK_SIZE)
+
+        self.ds._columnar_bytes_read = 0
+        self.assertEqual(self.ds.query(channels=['RPM'], start_ms=-2000, end_ms=-1000).fetch_records(1000), [])
+        self.assertEqual(self.ds._columnar_bytes_read, 0)
+
+    def test_reopen_keeps_layout(self):
+        fd, path = tempfile.mkstemp(suffix='.sql3')
+        os.close(fd)
+        os.remove(path)
+        ds = DataStore()
+        try:
+            ds.new(path, storage=self.storage)
+            ds.close()
+            ds.open_db(path)
+            self.assertEqual(ds.storage, self.storage)
+        finally:
+            ds.close()
+            os.remove(path)
+
+    def test_reads_only_requested_channels(self):
+        channel_count = 100
+        fd, wide_log = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(','.join('"C{}"|"u"|10'.format(i) for i in range(channel_count)) + '\r\n')
+            for row in range(2000):
+                f.write(','.join(str(row + i) for i in range(channel_count)) + '\r\n')
+
+        ds = DataStore()
+        ds.new(storage=self.storage)
+        try:
+            ds.import_datalog(wide_log, 'wide')
+            c = ds._conn.cursor()
+            c.execute("SELECT SUM(LENGTH(data)) FROM channel_data")
+            total_bytes = c.fetchone()[0]
+
+            ds._columnar_bytes_read = 0
+            records = ds.query(channels=['C3', 'C42']).fetch_records(5000)
+            self.assertEqual(len(records), 2000)
+            self.assertEqual(records[10], (13.0, 52.0))
+            self.assertAlmostEqual(float(ds._columnar_bytes_read) / total_bytes, 0.02)
+        finally:
+            ds.close()
+            os.remove(wide_log)
+
+@unittest.skipIf(np is None, "compressed storage requires numpy")
+class CompressedDataStoreTest(ColumnarDataStoreTest):
+    storage = COMPRESSED_STORAGE
+
+    def test_compressed_size(self):
+        c = self.ds._conn.cursor()
+        c.execute("SELECT SUM(LENGTH(data)), SUM(count) FROM channel_data")
+        size, count = c.fetchone()
+        self.assertTrue(count * 8 / size >= 5)
+
+@unittest.skipIf(np is None, "sparse storage requires numpy")
+class SparseDataStoreTest(ColumnarDataStoreTest):
+    storage = SPARSE_STORAGE
+
+    def test_sparse_chunks(self):
+        c = self.ds._conn.cursor()
+        #Coolant is logged at 1Hz of the 5Hz rows, only the samples
+        #logged are kept, and the first of every chunk
+        c.execute("""SELECT SUM(LENGTH(data)) / 8, COUNT(*), SUM(offsets IS NULL)
+        FROM channel_data JOIN channel ON channel_data.channel_id=channel.id
+        WHERE channel.name='Coolant'""")
+        stored, chunks, dense_chunks = c.fetchone()
+        self.assertEqual(dense_chunks, 0)
+        with open(log_path, 'rb') as f:
+            f.readline()
+            logged = sum(1 for line in f if line.strip() and line.split(',')[1] != '')
+        self.assertTrue(logged <= stored <= logged + chunks, (logged, stored, chunks))
+
+        #ts changes on every sample, a plain array is smaller
+        c.execute("""SELECT SUM(LENGTH(data)), SUM(count), SUM(offsets IS NOT NULL)
+        FROM channel_data JOIN channel ON channel_data.channel_id=channel.id
+        WHERE channel.name='ts'""")
+        size, count, sparse_chunks = c.fetchone()
+        self.assertEqual(sparse_chunks, 0)
+        self.assertEqual(size, count * 8)
+
+    def test_sparse_import_datalogs(self):
+        ds = DataStore()
+        ds.new(storage=self.storage)
+        try:
+            results = ds.import_datalogs([log_path], processes=1)
+            self.assertEqual([x.error for x in results], [None])
+            stored = "SELECT SUM(LENGTH(data)), SUM(offsets IS NOT NULL) FROM channel_data"
+            self.assertEqual(ds._conn.execute(stored).fetchone(), self.ds._conn.execute(stored).fetchone())
+            channels = ['Coolant', 'RPM', 'ts']
+            self.assertEqual(self._records(ds, channels), self._records(self.row_ds, channels))
+        finally:
+            ds.close()
+
+    def test_empty_chunk(self):
+        data, offsets = self.ds._pack_column(np.empty(0), np.empty(0, dtype=bool))
+        self.assertEqual((len(data), offsets), (0, None))
+
+    def test_sparse_values(self):
+        channels = ['Coolant', 'LapCount', 'ts']
+        self.assertEqual(self._records(self.ds, channels), self._records(self.row_ds, channels))
+        self.assertEqual(self.ds.query(channels=['Coolant'], start_ms=2000000, end_ms=2010000).fetch_records(1000),
+                         self.row_ds.query(channels=['Coolant'], start_ms=2000000, end_ms=2010000).fetch_records(1000))
+
+class ConcurrentAccessTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ds = DataStore()
+        self.ds.new(os.path.join(self.dir, 'datastore.sql3'))
+        self.ds.import_datalog(log_path, 'rc_adj')
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dir)
+
+    def _write_log(self, rows):
+        path = os.path.join(self.dir, 'long.log')
+        with open(path, 'wb') as f:
+            f.write(','.join(['"ts"|"ms"|10'] + ['"C{}"|"u"|10'.format(i) for i in range(10)]) + '\r\n')
+            for row in range(rows):
+                f.write(','.join([str(row * 100)] + [str(row + i) for i in range(10)]) + '\r\n')
+        return path
+
+    def _window_query(self):
+        records = self.ds.query(channels=['RPM'], start_ms=2000000, end_ms=2010000,
+                                session=1).fetch_records(1000)
+        self.assertEqual(len(records), 51)
+
+    def test_wal_mode(self):
+        mode = self.ds._conn.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+        self.assertEqual(self.ds._get_reader().execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertTrue(self.ds._get_reader() is not self.ds._conn)
+        self.assertRaises(Exception, DataStore().new, os.path.join(self.dir, 'x.sql3'),
+                          synchronous='SOMETIMES')
+
+    def test_reader_per_thread(self):
+        readers = []
+        worker = threading.Thread(target=lambda: readers.append(self.ds._get_reader()))
+        worker.start()
+        worker.join()
+        self.assertTrue(readers[0] is not self.ds._get_reader())
+        self.assertTrue(self.ds._get_reader() is self.ds._get_reader())
+
+    def test_reads_during_import(self):
+        long_log = self._write_log(100000)
+        #Cached results would leave nothing to read
+        self.ds.set_result_cache_size(0)
+        #Any wait on the writer's locks fails the read at once
+        self.ds._get_reader().execute('PRAGMA busy_timeout=0')
+
+        errors = []
+        def import_log():
+            try:
+                self.ds.import_datalog(long_log, 'long')
+            except Exception as e:
+                errors.append(e)
+
+        imported = []
+        writer = threading.Thread(target=import_log)
+        writer.start()
+        while writer.is_alive():
+            self._window_query()
+            imported.append(self.ds._get_session_range(2)[1])
+            time.sleep(0.005)
+        writer.join()
+
+        self.assertEqual(errors, [])
+        #The reads saw the import progressing rather than waiting it out
+        self.assertTrue(len(set(imported)) > 2)
+
+    def test_reader_released_with_thread(self):
+        main_reader = self.ds._get_reader()
+        readers = []
+        for i in range(20):
+            worker = threading.Thread(target=lambda: readers.append(self.ds._get_reader()))
+            worker.start()
+            worker.join()
+        #join() can return just before a thread's locals are dropped
+        for i in range(100):
+            if len(self.ds._reader_conns) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.ds._reader_conns), 1)
+        self.assertRaises(sqlite3.ProgrammingError, readers[0].execute, 'SELECT 1')
+        self.assertEqual(main_reader.execute('SELECT 1').fetchone()[0], 1)
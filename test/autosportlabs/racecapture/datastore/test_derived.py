@@ -0,0 +1,64 @@
+import unittest
+import math
+from autosportlabs.racecapture.datastore import derived
+from autosportlabs.racecapture.datastore.derived import compile_expression, np
+
+COLUMNS = {'A': [1.0, 2.0, 3.0, None, -4.0],
+           'B': [2.0, 0.0, 1.0, 1.0, 0.5]}
+
+EXPECTED = [
+    ('A^2 + B^2', [5.0, 4.0, 10.0, None, 16.25]),
+    ('A / B', [0.5, None, 3.0, None, -8.0]),
+    ('-A * 2 + 1', [-1.0, -3.0, -5.0, None, 9.0]),
+    ('A % 2', [1.0, 0.0, 1.0, None, 0.0]),
+    ('A > 1', [0.0, 1.0, 1.0, None, 0.0]),
+    ('A > 1 and B > 0', [0.0, 0.0, 1.0, None, 0.0]),
+    ('A > 2 or B == 0', [0.0, 1.0, 1.0, None, 0.0]),
+    ('not A >= 2', [1.0, 0.0, 0.0, None, 1.0]),
+    ('0 < A <= 2', [1.0, 1.0, 0.0, None, 0.0]),
+    ('if(A > 1, A, B)', [2.0, 2.0, 3.0, None, 0.5]),
+    ('sqrt(abs(A))', [1.0, math.sqrt(2), math.sqrt(3), None, 2.0]),
+    ('max(A, B) - min(A, B)', [1.0, 2.0, 2.0, None, 4.5]),
+    ('log(A)', [0.0, math.log(2), math.log(3), None, None]),
+    ('atan2(A, B)', [math.atan2(1, 2), math.atan2(2, 0), math.atan2(3, 1), None, math.atan2(-4, 0.5)]),
+    ('7', [7.0] * 5),
+]
+
+class DerivedExpressionTest(unittest.TestCase):
+    def _check(self, results, expected, text):
+        self.assertEqual(len(results), len(expected), text)
+        for result, value in zip(results, expected):
+            if value is None:
+                self.assertTrue(result is None or math.isnan(result), text)
+            else:
+                self.assertAlmostEqual(result, value, msg=text)
+
+    def test_channels(self):
+        self.assertEqual(compile_expression('AccelX^2 + AccelY^2 + AccelX').channels, ['AccelX', 'AccelY'])
+        self.assertEqual(compile_expression('if (Brake > 50, 1, 0)').channels, ['Brake'])
+
+    def test_power(self):
+        #^ binds like ** rather than as an exclusive or
+        self.assertEqual(compile_expression('2^3 + 1').evaluate({'A': [0.0]})[0], 9.0)
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_evaluate_arrays(self):
+        columns = dict((k, np.array([np.nan if x is None else x for x in v])) for k, v in COLUMNS.items())
+        for text, expected in EXPECTED:
+            results = compile_expression(text).evaluate(columns)
+            self.assertEqual(results.dtype, np.float64)
+            self._check(results.tolist(), expected, text)
+
+    def test_evaluate_lists(self):
+        saved = derived.np
+        derived.np = None
+        try:
+            for text, expected in EXPECTED:
+                self._check(compile_expression(text).evaluate(COLUMNS), expected, text)
+        finally:
+            derived.np = saved
+
+    def test_rejects_unsafe(self):
+        for text in ['__import__("os")', 'open("x")', 'A.real', 'A[0]', 'lambda: 1',
+                     'A if B else 1', '"text"', 'A in B', 'A is B', 'f(A)', 'abs(x=A)', 'A +']:
+            self.assertRaises(Exception, compile_expression, text)
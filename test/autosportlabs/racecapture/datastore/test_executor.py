@@ -0,0 +1,196 @@
+import unittest
+import os, os.path
+import shutil
+import tempfile
+import threading
+import time
+from autosportlabs.racecapture.datastore.datastore import DataStore, Filter, COLUMNAR_STORAGE, np
+from autosportlabs.racecapture.datastore.executor import QueryExecutor, CancelledError
+
+fqp = os.path.dirname(os.path.realpath(__file__))
+log_path = os.path.join(fqp, 'rc_adj.log')
+
+#Never finishes, unless interrupted
+ENDLESS_SQL = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c'
+
+class _UIThread(object):
+    """
+    Stands in for the Kivy clock: queues the callbacks dispatched to it
+    until run() is called from the test's thread
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def __call__(self, fn):
+        with self._lock:
+            self._pending.append(fn)
+
+    def run(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for fn in pending:
+            fn()
+        return len(pending)
+
+def _wait_until(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise Exception("Timed out")
+        time.sleep(0.01)
+
+class QueryExecutorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.dir = tempfile.mkdtemp()
+        self.ds = DataStore()
+        self.ds.new(os.path.join(self.dir, 'executor.sql3'))
+        self.ds.import_datalog(log_path, 'rc_adj')
+
+    @classmethod
+    def tearDownClass(self):
+        self.ds.close()
+        shutil.rmtree(self.dir)
+
+    def setUp(self):
+        self.ui = _UIThread()
+        self.executor = QueryExecutor(self.ds, dispatch=self.ui)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _endless(self):
+        return self.ds._get_reader().execute(ENDLESS_SQL).fetchone()
+
+    def test_query(self):
+        data_filter = Filter().gt('LapCount', 1)
+        future = self.executor.query(channels=['Speed', 'RPM'], data_filter=data_filter)
+        result = future.result(10)
+
+        expected = self.ds.query(channels=['Speed', 'RPM'], data_filter=data_filter)
+        expected = expected.fetch_all() if np is not None else expected.fetch_columns(100000)
+        for c in ['Speed', 'RPM']:
+            self.assertEqual(list(result[c]), list(expected[c]))
+
+    def test_callbacks_on_ui_thread(self):
+        threads = []
+        future = self.executor.submit(lambda: 42)
+        future.add_done_callback(lambda x: threads.append((threading.current_thread(), x.result())))
+        future.result(10)
+        self.assertEqual(threads, [])
+
+        self.assertEqual(self.ui.run(), 1)
+        self.assertEqual(threads, [(threading.current_thread(), 42)])
+
+        #Added once done, still delivered through the UI thread
+        future.add_done_callback(lambda x: threads.append(x.result()))
+        self.assertEqual(self.ui.run(), 1)
+        self.assertEqual(threads[-1], 42)
+
+    def test_error(self):
+        future = self.executor.submit(self.ds.query, channels=['NoSuchChannel'])
+        self.assertIsNotNone(future.exception(10))
+        self.assertRaises(Exception, future.result)
+        self.assertFalse(future.cancelled())
+
+    def test_cancel_running(self):
+        future = self.executor.submit(self._endless)
+        _wait_until(future.running)
+        self.assertTrue(future.cancel())
+        self.assertRaises(CancelledError, future.result, 10)
+        self.assertTrue(future.cancelled())
+
+        #The worker's connection is usable again
+        self.assertEqual(self.executor.submit(lambda: 1).result(10), 1)
+        self.assertEqual(self.executor.query(channels=['LapCount']).result(10)['LapCount'][0], 0)
+
+    def test_cancel_pending(self):
+        executor = QueryExecutor(self.ds, workers=1, dispatch=self.ui)
+        try:
+            release = threading.Event()
+            ran = []
+            blocker = executor.submit(release.wait)
+            pending = executor.submit(lambda: ran.append(True))
+            cancelled = []
+            pending.add_done_callback(lambda x: cancelled.append(x.cancelled()))
+
+            self.assertTrue(pending.cancel())
+            self.assertTrue(pending.done())
+            release.set()
+            blocker.result(10)
+            executor.submit(lambda: None).result(10)
+
+            self.ui.run()
+            self.assertEqual(ran, [])
+            self.assertEqual(cancelled, [True])
+            self.assertFalse(blocker.cancel())
+        finally:
+            executor.shutdown()
+
+    def test_supersede(self):
+        first = self.executor.submit_latest('slider', self._endless)
+        _wait_until(first.running)
+        second = self.executor.submit_latest('slider', self._endless)
+        third = self.executor.query(channels=['Speed'], key='slider')
+
+        self.assertRaises(CancelledError, first.result, 10)
+        self.assertRaises(CancelledError, second.result, 10)
+        self.assertIn('Speed', third.result(10))
+        self.assertEqual(self.executor.query(channels=['Speed'], key='other').result(10).keys(), ['Speed'])
+
+    def test_shutdown(self):
+        executor = QueryExecutor(self.ds, dispatch=self.ui)
+        running = executor.submit(self._endless)
+        _wait_until(running.running)
+        executor.shutdown()
+        self.assertTrue(running.cancelled())
+        self.assertRaises(Exception, executor.submit, lambda: None)
+
+    @unittest.skipIf(np is None, "columnar storage requires numpy")
+    def test_cancel_columnar(self):
+        ds = DataStore()
+        ds.new(storage=COLUMNAR_STORAGE)
+        ds.import_datalog(log_path, 'rc_adj')
+        #In memory no sqlite statement is interrupted, only the reads
+        #done in numpy can be
+        executor = QueryExecutor(ds, dispatch=self.ui)
+        try:
+            for cancel_after_query in [False, True]:
+                started = threading.Event()
+                reads = []
+                def query():
+                    started.wait()
+                    if not cancel_after_query:
+                        future.cancel()
+                    dataset = ds.query(channels=['RPM', 'Speed'])
+                    reads.append('query')
+                    if cancel_after_query:
+                        future.cancel()
+                    dataset.fetch_all()
+                    reads.append('fetch_all')
+                future = executor.submit(query)
+                started.set()
+                self.assertRaises(CancelledError, future.result, 10)
+                self.assertEqual(reads, ['query'] if cancel_after_query else [])
+
+            #Reads on the worker are no longer checked once the call is over
+            self.assertEqual(list(executor.query(channels=['RPM']).result(10)['RPM']),
+                             list(ds.query(channels=['RPM']).fetch_all()['RPM']))
+        finally:
+            executor.shutdown()
+            ds.close()
+
+    def test_memory_datastore(self):
+        ds = DataStore()
+        ds.new()
+        try:
+            executor = QueryExecutor(ds, dispatch=self.ui)
+            try:
+                self.assertEqual(len(executor._threads), 1)
+                self.assertEqual(executor.submit(lambda: 1).result(10), 1)
+            finally:
+                executor.shutdown()
+        finally:
+            ds.close()
@@ -0,0 +1,97 @@
+import unittest
+import os
+import shutil
+import tempfile
+from autosportlabs.racecapture.datastore.datastore import DataStore, COLUMNAR_STORAGE, np
+from autosportlabs.racecapture.datastore.export import CSV_EXPORT, BINARY_EXPORT
+from autosportlabs.racecapture.datastore.sidecar import Sidecar
+
+fqp = os.path.dirname(os.path.realpath(__file__))
+log_path = os.path.join(fqp, 'rc_adj.log')
+
+class ExportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.ds = DataStore()
+        self.ds.new()
+        self.ds.import_datalog(log_path, 'rc_adj')
+
+    @classmethod
+    def tearDownClass(self):
+        self.ds.close()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _reimport(self, path, channels):
+        ds = DataStore()
+        ds.new()
+        try:
+            ds.import_datalog(path, 'exported')
+            return ds.query(channels=channels).fetch_records(100000), ds._channels
+        finally:
+            ds.close()
+
+    def test_csv_header(self):
+        path = os.path.join(self.work_dir, 'export.log')
+        self.assertEqual(self.ds.export(1, ['RPM', 'LapCount'], path), 25691)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.readline(), '"ts"|"milliseconds"|200,"RPM"|"RPM"|5,"LapCount"|""|1\r\n')
+            self.assertEqual(f.readline(), '0,1120,0\r\n')
+
+    def test_csv_round_trip(self):
+        channels = ['ts', 'Coolant', 'RPM', 'AccelX', 'Latitude', 'LapTime']
+        expected = self.ds.query(channels=channels).fetch_records(100000)
+        for native_rates in [False, True]:
+            path = os.path.join(self.work_dir, 'export{}.log'.format(native_rates))
+            self.ds.export(1, [], path, native_rates=native_rates)
+            records, reimported_channels = self._reimport(path, channels)
+            self.assertEqual(records, expected)
+            self.assertEqual([(x.name, x.sample_rate) for x in reimported_channels],
+                             [(x.name, x.sample_rate) for x in self.ds._channels])
+
+    def test_native_rates(self):
+        dense_path = os.path.join(self.work_dir, 'dense.log')
+        sparse_path = os.path.join(self.work_dir, 'sparse.log')
+        self.ds.export(1, ['Coolant', 'RPM'], dense_path)
+        self.ds.export(1, ['Coolant', 'RPM'], sparse_path, native_rates=True)
+        with open(sparse_path, 'rb') as f:
+            f.readline()
+            records = [x.strip().split(',') for x in f]
+        self.assertEqual(len(records), 25691)
+        #ts at 5Hz, Coolant at 1Hz: roughly one value in five, RPM on every row
+        coolant = len([x for x in records if x[1]])
+        self.assertTrue(25691 / 5 <= coolant < 25691 / 4)
+        self.assertEqual(len([x for x in records if x[2]]), 25691)
+        self.assertTrue(os.path.getsize(sparse_path) < os.path.getsize(dense_path))
+
+    @unittest.skipIf(np is None, "binary export requires numpy")
+    def test_binary(self):
+        path = os.path.join(self.work_dir, 'export.rcs')
+        for ds in [self.ds, self._columnar()]:
+            self.assertEqual(ds.export(1, ['RPM', 'Latitude'], path, BINARY_EXPORT), 25691)
+            exported = Sidecar(path)
+            try:
+                self.assertEqual([x.name for x in exported.channels], ['ts', 'RPM', 'Latitude'])
+                self.assertEqual(exported.channels[1].sample_rate, 5)
+                self.assertEqual(exported.get('RPM').tolist(), ds.get_channel_array('RPM', 1).tolist())
+                self.assertFalse(exported.is_current())
+            finally:
+                exported.close()
+
+    def _columnar(self):
+        ds = DataStore()
+        ds.new(storage=COLUMNAR_STORAGE)
+        ds.import_datalog(log_path, 'rc_adj')
+        self.addCleanup(ds.close)
+        return ds
+
+    def test_errors(self):
+        path = os.path.join(self.work_dir, 'export.log')
+        self.assertRaises(Exception, self.ds.export, 2, [], path)
+        self.assertRaises(Exception, self.ds.export, 1, ['Nope'], path)
+        self.assertRaises(Exception, self.ds.export, 1, [], path, 'xml')
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,255 @@
+import unittest
+import os, os.path
+import tempfile
+import threading
+import time
+from autosportlabs.racecapture.datastore.datastore import DataStore, Filter, \
+    ROW_STORAGE, COLUMNAR_STORAGE, SPARSE_STORAGE, np
+from autosportlabs.racecapture.datastore.recorder import SessionRecorder, _SessionWriter
+
+fqp = os.path.dirname(os.path.realpath(__file__))
+log_path = os.path.join(fqp, 'rc_adj.log')
+
+class _Meta(object):
+    def __init__(self, name, units, sampleRate):
+        self.name = name
+        self.units = units
+        self.sampleRate = sampleRate
+
+class _Metas(object):
+    def __init__(self, metas):
+        self.channel_metas = metas
+
+class _Value(object):
+    def __init__(self, value, meta):
+        self.value = value
+        self.channelMeta = meta
+
+class _Sample(object):
+    """
+    Stands in for sampledata.Sample, which needs kivy
+    """
+    def __init__(self, metas):
+        self.metas = _Metas(metas)
+        self.tick = 0
+        self.samples = []
+
+class _Pump(object):
+    def __init__(self):
+        self.listeners = []
+
+    def add_sample_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_sample_listener(self, callback):
+        self.listeners.remove(callback)
+
+class SessionRecorderTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sql3')
+        os.close(fd)
+        os.remove(self.path)
+        self.ds = DataStore()
+        self.ds.new(self.path)
+        self.metas = [_Meta('RPM', 'RPM', 50), _Meta('LapCount', '', 1), _Meta('Speed', 'MPH', 10)]
+        self.sample = _Sample(self.metas)
+
+    def tearDown(self):
+        self.ds.close()
+        os.remove(self.path)
+
+    def _send(self, listener, count, start=0):
+        sample = self.sample
+        for i in range(start, start + count):
+            sample.tick = i * 20
+            del sample.samples[:]
+            sample.samples.append(_Value(1000 + i, self.metas[0]))
+            if i % 5 == 0:
+                sample.samples.append(_Value(i / 100, self.metas[1]))
+                sample.samples.append(_Value(i % 200, self.metas[2]))
+            listener(sample)
+
+    def test_records_session(self):
+        pump = _Pump()
+        recorder = SessionRecorder(self.ds, 'stint', data_bus_pump=pump, commit_interval=20)
+        session = recorder.start()
+        self.assertEqual(pump.listeners, [recorder.on_sample])
+
+        self._send(pump.listeners[0], 1000)
+        #Rows become queryable while still recording
+        deadline = time.time() + 5
+        while recorder.recorded < 1000 and time.time() < deadline:
+            time.sleep(0.01)
+        self.ds.refresh()
+        self.assertEqual(len(self.ds.query(channels=['RPM'], session=session).fetch_records(5000)), 1000)
+
+        self._send(pump.listeners[0], 500, 1000)
+        recorder.stop()
+        self.assertEqual(pump.listeners, [])
+        self.assertEqual(recorder.recorded, 1500)
+        self.assertEqual(recorder.dropped, 0)
+
+        records = self.ds.query(channels=['ts', 'RPM', 'LapCount', 'Speed'],
+                                session=session).fetch_records(5000)
+        self.assertEqual(len(records), 1500)
+        self.assertEqual(records[0], (0, 1000, 0, 0))
+        #Channels carry forward between the samples that update them
+        self.assertEqual(records[7], (140, 1007, 0, 5))
+        self.assertEqual(records[-1], (1499 * 20, 2499, 14, 95))
+
+        self.assertEqual(self.ds.get_channel_max('RPM', session), 2499)
+        laps = self.ds.query_lap(session, 3, channels=['LapCount']).fetch_records(5000)
+        self.assertEqual(len(laps), 100)
+        self.assertEqual(len(self.ds.query_decimated(['RPM'], 1, 1500, 50)['RPM']), 94)
+
+    def test_writes_summaries_with_batches(self):
+        ds = DataStore()
+        ds.open_db(self.path)
+        try:
+            session = ds._create_session('stint')
+            writer = _SessionWriter(ds, session)
+            metas = [(x.name, x.units, x.sampleRate) for x in self.metas]
+            for batch in range(15):
+                items = [(i * 20, {'RPM': 1000 + i, 'LapCount': i / 100, 'Speed': i % 200})
+                         for i in range(batch * 100, batch * 100 + 100)]
+                writer.write(items, metas)
+
+            #Committed with the samples, nothing piles up until finish()
+            self.ds.refresh()
+            self.assertEqual(self.ds.get_channel_stats('RPM', session).max, 2499)
+            laps = self.ds._conn.execute("SELECT COUNT(*) FROM lap WHERE session_id=?", (session,))
+            self.assertEqual(laps.fetchone()[0], 14)
+            pyramid = self.ds._conn.execute("SELECT COUNT(*) FROM channel_pyramid_{}".format(session))
+            self.assertTrue(pyramid.fetchone()[0] > 0)
+            self.assertEqual(writer._laps.laps, [])
+            self.assertEqual(writer._pyramid._levels, [[] for x in writer._pyramid._levels])
+
+            writer.finish()
+            self.ds.refresh()
+            laps = self.ds._conn.execute("SELECT COUNT(*) FROM lap WHERE session_id=?", (session,))
+            self.assertEqual(laps.fetchone()[0], 15)
+            self.assertEqual(len(self.ds.query_decimated(['RPM'], 1, 1500, 50)['RPM']), 94)
+        finally:
+            ds.close()
+
+    @unittest.skipIf(np is None, "sparse storage requires numpy")
+    def test_sparse_storage(self):
+        fd, path = tempfile.mkstemp(suffix='.sql3')
+        os.close(fd)
+        os.remove(path)
+        ds = DataStore()
+        ds.new(path, storage=SPARSE_STORAGE)
+        try:
+            recorder = SessionRecorder(ds, 'stint', commit_interval=20)
+            session = recorder.start()
+            self._send(recorder.on_sample, 1500)
+            recorder.stop()
+
+            ds.refresh()
+            records = ds.query(channels=['ts', 'RPM', 'LapCount', 'Speed'], session=session).fetch_records(5000)
+            self.assertEqual(records[7], (140, 1007, 0, 5))
+            self.assertEqual(records[-1], (1499 * 20, 2499, 14, 95))
+            #Speed came with every fifth sample, only those are kept, and
+            #the first of every chunk
+            c = ds._conn.execute("""SELECT SUM(LENGTH(data)) / 8, COUNT(*) FROM channel_data
+            JOIN channel ON channel_data.channel_id=channel.id WHERE channel.name='Speed'""")
+            stored, chunks = c.fetchone()
+            self.assertTrue(300 <= stored <= 300 + chunks, (stored, chunks))
+            self.assertTrue(stored < 1500)
+        finally:
+            ds.close()
+            os.remove(path)
+
+    def test_drops_when_full(self):
+        recorder = SessionRecorder(self.ds, 'stint', commit_interval=60000, queue_size=100)
+        recorder.start()
+        self._send(recorder.on_sample, 250)
+        self.assertEqual(recorder.dropped, 150)
+        self.assertEqual(recorder.queued, 100)
+        recorder.stop()
+        self.assertEqual(recorder.recorded, 100)
+
+    def _record_during_import(self, storage):
+        fd, path = tempfile.mkstemp(suffix='.sql3')
+        os.close(fd)
+        os.remove(path)
+        ds = DataStore()
+        ds.new(path, storage=storage)
+        try:
+            pump = _Pump()
+            recorder = SessionRecorder(ds, 'stint', data_bus_pump=pump, commit_interval=1)
+            session = recorder.start()
+
+            imported = threading.Event()
+            sent = []
+            def feed():
+                #Keeps recording until the import is done
+                while not imported.is_set() or not sent:
+                    self._send(pump.listeners[0], 50, 50 * len(sent))
+                    sent.append(50)
+                    time.sleep(0.002)
+
+            feeder = threading.Thread(target=feed)
+            feeder.start()
+            try:
+                imported_session = ds.import_datalog(log_path, 'rc_adj')
+                recorded_during_import = recorder.recorded
+            finally:
+                imported.set()
+                feeder.join()
+            recorder.stop()
+            self.assertTrue(recorded_during_import > 0)
+
+            count = sum(sent)
+            self.assertEqual(recorder.recorded, count)
+            ds.refresh()
+            self.assertEqual([(x.session_id, x.samples) for x in ds.list_sessions()],
+                             [(session, count), (imported_session, 25691)])
+            records = ds.query(channels=['ts', 'RPM'], session=session).fetch_records(count + 1)
+            self.assertEqual(records, [(i * 20, 1000 + i) for i in range(count)])
+            self.assertEqual(ds.get_channel_stats('RPM', session).count, count)
+
+            expected = DataStore()
+            expected.new(storage=storage)
+            expected.import_datalog(log_path, 'rc_adj')
+            channels = ['ts', 'RPM', 'Latitude']
+            self.assertEqual(ds.query(channels=channels, session=imported_session).fetch_records(100000),
+                             expected.query(channels=channels).fetch_records(100000))
+            self.assertEqual(ds.get_channel_stats('RPM', imported_session).count, 25691)
+            expected.close()
+        finally:
+            ds.close()
+            os.remove(path)
+
+    def test_record_during_import(self):
+        self._record_during_import(ROW_STORAGE)
+
+    @unittest.skipIf(np is None, "columnar storage requires numpy")
+    def test_record_during_import_columnar(self):
+        self._record_during_import(COLUMNAR_STORAGE)
+
+    def test_import_after_recording(self):
+        #Opened before the recording added its channels
+        other = DataStore()
+        other.open_db(self.path)
+        try:
+            recorder = SessionRecorder(self.ds, 'stint', commit_interval=20)
+            session = recorder.start()
+            self._send(recorder.on_sample, 100)
+            recorder.stop()
+
+            imported_session = other.import_datalog(log_path, 'rc_adj')
+            self.assertEqual(len(other.query(channels=['RPM', 'ts'], session=session).fetch_records(1000)), 100)
+            self.assertEqual(len(other.query(channels=['RPM'], session=imported_session).fetch_records(100000)),
+                             25691)
+            self.ds.refresh()
+            self.assertEqual(len(self.ds.query(channels=['ts', 'Coolant']).fetch_records(100000)),
+                             25691 + 100)
+        finally:
+            other.close()
+
+    def test_requires_database_file(self):
+        ds = DataStore()
+        ds.new()
+        self.assertRaises(Exception, SessionRecorder, ds, 'stint')
+        ds.close()
@@ -0,0 +1,92 @@
+import unittest
+import os, os.path
+import shutil
+import tempfile
+from autosportlabs.racecapture.datastore.datastore import DataStore, COLUMNAR_STORAGE, np
+from autosportlabs.racecapture.datastore.sidecar import Sidecar, open_sidecar
+
+fqp = os.path.dirname(os.path.realpath(__file__))
+log_path = os.path.join(fqp, 'rc_adj.log')
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.dir, 'rc_adj.log')
+        shutil.copy(log_path, self.log_path)
+        self.ds = DataStore()
+        self.ds.new(os.path.join(self.dir, 'datastore.sql3'))
+        self.ds.import_datalog(self.log_path, 'rc_adj')
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.dir)
+
+    def test_written_at_import(self):
+        sidecar = self.ds.get_sidecar(1)
+        self.assertTrue(isinstance(sidecar, Sidecar))
+        self.assertEqual(sidecar.row_count, 25691)
+        self.assertEqual(sidecar.first_sample_id, 1)
+        self.assertEqual([x.name for x in sidecar.channels], [x.name for x in self.ds._channels])
+        rpm = [x for x in sidecar.channels if x.name == 'RPM'][0]
+        self.assertEqual(rpm.units, 'RPM')
+        self.assertEqual(rpm.sample_rate, 5)
+
+    def test_matches_database(self):
+        sidecar = self.ds.get_sidecar(1)
+        for channel in ['RPM', 'Latitude', 'ts', 'LapTime']:
+            values = self.ds._read_raw_buckets([channel], 1, 25691)[channel][2][:, 0]
+            mapped = sidecar.get(channel)
+            self.assertTrue(isinstance(mapped, np.memmap))
+            self.assertEqual(mapped.tolist(), values.tolist())
+
+    def test_float32_when_lossless(self):
+        dtypes = dict((x.name, x.dtype) for x in self.ds.get_sidecar(1).channels)
+        self.assertEqual(dtypes['RPM'], '<f4')
+        self.assertEqual(dtypes['Latitude'], '<f8')
+
+    def test_get_channel_array(self):
+        array = self.ds.get_channel_array('Coolant', 1)
+        self.assertTrue(isinstance(array, np.memmap))
+        self.assertEqual(len(array), 25691)
+
+    def test_invalidated_by_source_change(self):
+        sidecar_path = self.ds._get_sidecar_path(1)
+        expected = self.ds.get_channel_array('RPM', 1).tolist()
+
+        stat = os.stat(self.log_path)
+        os.utime(self.log_path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(self.ds.get_sidecar(1), None)
+        self.assertFalse(os.path.exists(sidecar_path))
+
+        #Falls back to the database
+        array = self.ds.get_channel_array('RPM', 1)
+        self.assertFalse(isinstance(array, np.memmap))
+        self.assertEqual(array.tolist(), expected)
+
+    def test_invalidated_by_corruption(self):
+        sidecar_path = self.ds._get_sidecar_path(1)
+        with open(sidecar_path, 'r+b') as f:
+            f.truncate(100)
+        self.assertEqual(open_sidecar(sidecar_path), None)
+        self.assertFalse(os.path.exists(sidecar_path))
+
+    def test_columnar_storage(self):
+        ds = DataStore()
+        ds.new(os.path.join(self.dir, 'columnar.sql3'), storage=COLUMNAR_STORAGE)
+        try:
+            ds.import_datalog(self.log_path, 'rc_adj')
+            self.assertEqual(ds.get_channel_array('MAP', 1).tolist(),
+                             self.ds.get_channel_array('MAP', 1).tolist())
+        finally:
+            ds.close()
+
+    def test_in_memory_has_no_sidecar(self):
+        ds = DataStore()
+        ds.new()
+        try:
+            ds.import_datalog(self.log_path, 'rc_adj')
+            self.assertEqual(ds.get_sidecar(1), None)
+            self.assertEqual(len(ds.get_channel_array('RPM', 1)), 25691)
+        finally:
+            ds.close()
@@ -0,0 +1,133 @@
+import unittest
+import random
+from autosportlabs.racecapture.datastore.smoothing import create_smoother, smooth, \
+    _smooth_dataset, np, KERNELS, INTERP_KERNEL, EMA_KERNEL, MOVING_AVERAGE_KERNEL, \
+    SAVITZKY_GOLAY_KERNEL
+
+def _random_channel(count):
+    random.seed(42)
+    value = 100.0
+    values = []
+    for i in range(count):
+        value += random.uniform(-5, 5)
+        values.append(value)
+    return values
+
+@unittest.skipIf(np is None, "smoothing kernels require numpy")
+class SmoothingTest(unittest.TestCase):
+    def setUp(self):
+        self.values = np.array(_random_channel(1000))
+
+    def test_interp_matches_reference(self):
+        for rate in [2, 4, 7, 50]:
+            expected = _smooth_dataset(self.values.tolist(), rate)
+            smoothed = smooth(self.values, rate, INTERP_KERNEL)
+            self.assertTrue(np.allclose(smoothed, expected))
+
+    def test_ema(self):
+        rate = 9
+        alpha = 2.0 / (rate + 1)
+        expected = [self.values[0]]
+        for x in self.values[1:]:
+            expected.append(alpha * x + (1 - alpha) * expected[-1])
+
+        self.assertTrue(np.allclose(smooth(self.values, rate, EMA_KERNEL), expected))
+
+    def test_moving_average(self):
+        smoothed = smooth(self.values, 5, MOVING_AVERAGE_KERNEL)
+        self.assertAlmostEqual(smoothed[10], self.values[8:13].mean())
+        self.assertAlmostEqual(smoothed[0], self.values[:3].mean())
+        self.assertAlmostEqual(smoothed[-1], self.values[-3:].mean())
+
+    def test_savgol(self):
+        smoothed = smooth(self.values, 9, SAVITZKY_GOLAY_KERNEL)
+
+        window = np.arange(-4, 5)
+        fit = np.polyfit(window, self.values[100:109], 2)
+        self.assertAlmostEqual(smoothed[104], np.polyval(fit, 0))
+
+        #The edges come from the first and last full window
+        fit = np.polyfit(window, self.values[:9], 2)
+        self.assertAlmostEqual(smoothed[1], np.polyval(fit, -3))
+
+        #A quadratic passes through unchanged
+        quadratic = 0.5 * np.arange(100.0) ** 2 - 3 * np.arange(100.0)
+        self.assertTrue(np.allclose(smooth(quadratic, 9, SAVITZKY_GOLAY_KERNEL), quadratic))
+
+    def test_streaming_matches_whole(self):
+        for kernel in KERNELS:
+            for rate in [2, 5, 16]:
+                expected = smooth(self.values, rate, kernel)
+                for chunk_size in [3, 100, 1000]:
+                    smoother = create_smoother(rate, kernel)
+                    parts = [smoother.process(self.values[i:i + chunk_size])
+                             for i in range(0, len(self.values), chunk_size)]
+                    parts.append(smoother.process([], final=True))
+                    streamed = np.concatenate(parts)
+                    self.assertEqual(len(streamed), len(self.values))
+                    self.assertTrue(np.allclose(streamed, expected), (kernel, rate, chunk_size))
+
+    def _with_gaps(self):
+        #A gap in the middle, and one across the chunk boundary at 100
+        values = self.values.copy()
+        values[[40, 41, 42, 98, 99, 100, 101, 500]] = np.nan
+        return values
+
+    def test_ema_gaps(self):
+        values = self._with_gaps()
+        rate = 9
+        alpha = 2.0 / (rate + 1)
+        expected = []
+        previous = values[0]
+        for x in values:
+            if np.isnan(x):
+                expected.append(np.nan)
+                continue
+            previous = alpha * x + (1 - alpha) * previous
+            expected.append(previous)
+
+        smoothed = smooth(values, rate, EMA_KERNEL)
+        self.assertTrue(np.allclose(smoothed, expected, equal_nan=True))
+        self.assertEqual(np.isnan(smoothed).sum(), 8)
+
+    def test_moving_average_gaps(self):
+        values = self._with_gaps()
+        smoothed = smooth(values, 5, MOVING_AVERAGE_KERNEL)
+        for i in range(len(values)):
+            if np.isnan(values[i]):
+                self.assertTrue(np.isnan(smoothed[i]))
+            else:
+                window = values[max(i - 2, 0):i + 3]
+                self.assertAlmostEqual(smoothed[i], window[~np.isnan(window)].mean())
+        self.assertEqual(np.isnan(smoothed).sum(), 8)
+
+        #A window with nothing in it stays a gap
+        self.assertTrue(np.isnan(smooth(np.array([np.nan] * 10), 5, MOVING_AVERAGE_KERNEL)).all())
+
+    def test_streaming_gaps(self):
+        values = self._with_gaps()
+        for kernel in [EMA_KERNEL, MOVING_AVERAGE_KERNEL]:
+            for rate in [2, 5, 16]:
+                expected = smooth(values, rate, kernel)
+                for chunk_size in [3, 100, 1000]:
+                    smoother = create_smoother(rate, kernel)
+                    parts = [smoother.process(values[i:i + chunk_size])
+                             for i in range(0, len(values), chunk_size)]
+                    parts.append(smoother.process([], final=True))
+                    streamed = np.concatenate(parts)
+                    self.assertTrue(np.allclose(streamed, expected, equal_nan=True),
+                                    (kernel, rate, chunk_size))
+                    self.assertEqual(np.isnan(streamed).sum(), 8)
+
+        #A stream that starts with a gap
+        smoother = create_smoother(5, EMA_KERNEL)
+        self.assertTrue(np.isnan(smoother.process([np.nan, np.nan])).all())
+        self.assertEqual(smoother.process([3.0, 3.0]).tolist(), [3.0, 3.0])
+
+    def test_short_channel(self):
+        for kernel in KERNELS:
+            self.assertEqual(len(smooth(self.values[:3], 10, kernel)), 3)
+
+    def test_invalid(self):
+        self.assertRaises(Exception, create_smoother, 1, INTERP_KERNEL)
+        self.assertRaises(Exception, create_smoother, 5, 'gaussian')